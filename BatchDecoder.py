@@ -0,0 +1,96 @@
+"""
+
+BatchDecoder decodes many PTR records at once into typed NumPy columns.
+
+PTR bodies of a die are gathered into one contiguous buffer while parsing,
+then decoded in a single pass when the die's PRR arrives. The fixed-layout
+prefix (TEST_NUM .. RESULT) is read through a structured dtype, the test
+limits are located by walking the variable length TEST_TXT and ALARM_ID
+fields for all records at once.
+
+"""
+import numpy as np
+
+# Fixed-layout prefix shared by every PTR record (12 bytes)
+PTR_PREFIX_DTYPE = np.dtype([
+    ('TEST_NUM', '<u4'),
+    ('HEAD_NUM', 'u1'),
+    ('SITE_NUM', 'u1'),
+    ('TEST_FLG', 'u1'),
+    ('PARM_FLG', 'u1'),
+    ('RESULT', '<f4'),
+])
+
+# Decoded test results. The first five fields follow the DieInfo test result
+# tuple layout: (test_num, LO_LIMIT, HI_LIMIT, result, PARAM_FLG)
+TEST_RESULT_DTYPE = np.dtype([
+    ('TestNumber', '<u4'),
+    ('LowerLimit', '<f4'),
+    ('UpperLimit', '<f4'),
+    ('Result', '<f4'),
+    ('TestFlag', 'u1'),
+    ('SiteNum', 'u1'),
+])
+
+
+def _gather(data, positions, width):
+    """ Gather `width` bytes starting at each position, clipped to the buffer. """
+    index = positions[:, None] + np.arange(width)
+    np.clip(index, 0, len(data) - 1, out=index)
+    return data[index]
+
+
+def decode_ptr_batch(buffer, starts):
+    """
+    Decode concatenated PTR record bodies into a structured array.
+
+    Args:
+    buffer [bytes-like]: PTR bodies stored back to back
+    starts [bytes-like]: uint32 offsets of each body within buffer
+
+    Returns:
+    results [numpy.ndarray]: TEST_RESULT_DTYPE array, missing limits are NaN
+    """
+    data = np.frombuffer(buffer, dtype=np.uint8)
+    starts = np.frombuffer(starts, dtype=np.uint32).astype(np.int64)
+    results = np.empty(len(starts), dtype=TEST_RESULT_DTYPE)
+    if not len(starts):
+        return results
+    ends = np.append(starts[1:], len(data))
+
+    # Fixed-layout prefix
+    prefix = _gather(data, starts, PTR_PREFIX_DTYPE.itemsize).view(PTR_PREFIX_DTYPE).ravel()
+    results['TestNumber'] = prefix['TEST_NUM']
+    results['SiteNum'] = prefix['SITE_NUM']
+    results['TestFlag'] = prefix['PARM_FLG']
+    results['Result'] = prefix['RESULT']
+
+    # Skip TEST_TXT  C*n
+    position = starts + 12
+    position += 1 + np.where(position < ends, _gather(data, position, 1)[:, 0], 0)
+
+    # Skip ALARM_ID  C*n
+    position += 1 + np.where(position < ends, _gather(data, position, 1)[:, 0], 0)
+
+    # Skip OPT_FLAG, RES_SCAL, LLM_SCAL and HLM_SCAL
+    position += 4
+
+    # Extract LO_LIMIT and HI_LIMIT  R*4 when present
+    limits = _gather(data, position, 8).view('<f4')
+    has_limits = position + 8 <= ends
+    results['LowerLimit'] = np.where(has_limits, limits[:, 0], np.nan)
+    results['UpperLimit'] = np.where(has_limits, limits[:, 1], np.nan)
+
+    return results
+
+
+def to_test_array(test_results, site):
+    """
+    Convert DieInfo test result tuples (test_num, LO_LIMIT, HI_LIMIT, result, PARAM_FLG)
+    into a TEST_RESULT_DTYPE array, missing limits become NaN.
+    """
+    if not isinstance(test_results, list):
+        return test_results
+    nan = float('nan')
+    return np.array([(test_num, nan if lo is None else lo, nan if hi is None else hi, result, flag, site)
+                     for test_num, lo, hi, result, flag in test_results], dtype=TEST_RESULT_DTYPE)
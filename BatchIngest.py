@@ -0,0 +1,339 @@
+"""
+
+BatchIngest backfills a database from many STDF files at once.
+
+Files are parsed and loaded by a pool of worker processes. By default every
+file is loaded into its own staging database, written without journaling or
+syncs since it is thrown away, and the main process merges the staging
+databases into the target one with ATTACH and INSERT ... SELECT, in the
+order the files were given. The target database therefore has one writer,
+a wafer found in several files ends up as its last file has it, just like
+loading the files one after the other, and a file that fails to parse leaves
+the target database untouched.
+
+Retest merges and test blocks restricted to a subset of tests need the
+target's stored data while loading; those batches load straight into the
+target database instead, one load writing at a time.
+
+Files already loaded and unchanged, according to the ingest ledger, are
+skipped. Per-file and aggregate throughput and the failures are printed.
+
+Usage:
+    python BatchIngest.py database.db "archive/2023/*.stdf" archive/2024 [--workers 16] [--test-storage npy]
+
+"""
+import os
+import sys
+import glob
+import time
+import shutil
+import sqlite3
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import Schema
+import TestStore
+import WaferMap
+import IngestLedger
+import ShardRouter
+from Parser import STDF_SUFFIXES
+from RecordIndex import fingerprint
+
+# Staging databases are disposable, nothing has to survive a crash
+STAGING_PRAGMAS = (
+    ("journal_mode", "MEMORY"),
+    ("synchronous", "OFF"),
+    ("cache_size", -65536),     # 64 MiB
+    ("temp_store", "MEMORY"),
+)
+
+# Columns copied from a staging database, MasterID aside
+WAFER_CONFIG_COLUMNS = "WaferSize, DieHeight, DieWidth, WaferFlat, CenterX, CenterY, PositiveX, PositiveY"
+DIE_INFO_COLUMNS = "DieID, DieX, DieY, SiteNum, HardwareBin, SoftwareBin, PartFlg, Passing, Generation"
+TEST_RESULTS_COLUMNS = "DieID, TestNumber, LowerLimit, UpperLimit, Result, TestFlag"
+
+# Write lock of the target database in direct mode, set in each worker process by _init_worker
+_write_lock = None
+
+
+def _init_worker(write_lock):
+    global _write_lock
+    _write_lock = write_lock
+
+
+def _load_file(file_name, db_name, staging_db, options):
+    """
+    Load one file in a worker process, into its staging database when one is given.
+
+    Returns:
+    result [dict]: {"ids", "complete", "unchanged", "seconds"}
+    """
+    start_time = time.time()
+    try:
+        if staging_db:
+            IDs = WaferMap.main(file_name, staging_db, force=True, **options)
+        else:
+            IDs = WaferMap.main(file_name, db_name, write_lock=_write_lock, **options)
+    finally:
+        # Workers outlive their files, and staging databases are removed once merged
+        ShardRouter.close_router(staging_db or db_name)
+    return {"ids": [wafer[0] for wafer in IDs], "unchanged": WaferMap.UNCHANGED,
+            "complete": bool(IDs) and (WaferMap.UNCHANGED or WaferMap.COMPLETE), "seconds": time.time() - start_time}
+
+
+def collect_files(sources, recursive=False):
+    """
+    Args:
+    sources [list]: STDF files, directories or glob patterns
+    recursive [bool]: also scan the subdirectories of directories, and let ** match them in patterns
+
+    Returns:
+    files [list]: absolute paths of the STDF files, sorted and without duplicates
+    """
+    files = set()
+    for source in sources:
+        if os.path.isdir(source):
+            pattern = os.path.join(source, "**", "*") if recursive else os.path.join(source, "*")
+            paths = [path for path in glob.glob(pattern, recursive=recursive) if path.lower().endswith(STDF_SUFFIXES)]
+        else:
+            paths = glob.glob(source, recursive=recursive)
+        files.update(os.path.abspath(path) for path in paths if os.path.isfile(path))
+    return sorted(files)
+
+
+def merge_staging(db_name, staging_db, test_filter=None, test_dir=None):
+    """
+    Copy the wafers of a staging database into db_name, or into their shards when it is
+    sharded, replacing the stored data of wafers loaded before, together with the staging
+    ledger entries.
+
+    Args:
+    db_name [string]: target database
+    staging_db [string]: database a single file was loaded into
+    test_filter [iterable]: tests the file was parsed for, the stored results of the other tests are
+                            kept; None for all tests and an empty set keeps every stored result
+    test_dir [string]: block directory of db_name, see Loader test_dir
+
+    Returns:
+    mids [dict]: staging MasterID -> MasterID in db_name
+    """
+    mids = {}
+    staging_dir = os.path.dirname(os.path.abspath(staging_db))
+    catalog = os.path.abspath(db_name)
+    router = ShardRouter.ShardRouter(db_name)
+    targets = {}    # database path -> connection with the staging database attached
+    try:
+        staging = sqlite3.connect(staging_db)
+        wafers = staging.execute("SELECT MasterID, LotID, WaferID FROM wafer_info").fetchall()
+        ledger = staging.execute("SELECT Path, Size, MTime, Hash, MasterIDs, Content FROM ingest_ledger").fetchall()
+        staging.close()
+
+        # The catalog assigns the MasterIDs, a wafer's data goes to its shard when sharded
+        assigned = [(staged, lot_id, wafer_id, *router.assign(lot_id, wafer_id)) for staged, lot_id, wafer_id in wafers]
+
+        for staged, lot_id, wafer_id, mid, path in assigned:
+            mids[staged] = mid
+            if path not in targets:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                conn = sqlite3.connect(path)
+                Schema.migrate(conn)
+                conn.execute("ATTACH DATABASE ? AS staging", (staging_db,))
+                conn.execute("BEGIN")
+                targets[path] = conn
+            cursor = targets[path].cursor()
+            if path != catalog:
+                cursor.execute("INSERT OR IGNORE INTO main.wafer_info (MasterID, LotID, WaferID) VALUES (?, ?, ?)", (mid, lot_id, wafer_id))
+
+            # Data of a previous load of the wafer is replaced, same as Loader._start_wafer
+            for table in ("wafer_config", "die_info"):
+                cursor.execute(f"DELETE FROM main.{table} WHERE MasterID = ?", (mid,))
+            if test_filter is None:
+                cursor.execute("DELETE FROM main.test_results WHERE MasterID = ?", (mid,))
+            elif test_filter:
+                placeholders = ', '.join('?' * len(test_filter))
+                cursor.execute(f"DELETE FROM main.test_results WHERE MasterID = ? AND TestNumber IN ({placeholders})", (mid, *test_filter))
+
+            for table, columns in (("wafer_config", WAFER_CONFIG_COLUMNS), ("die_info", DIE_INFO_COLUMNS), ("test_results", TEST_RESULTS_COLUMNS)):
+                cursor.execute(f"INSERT INTO main.{table} (MasterID, {columns}) SELECT ?, {columns} FROM staging.{table} WHERE MasterID = ?", (mid, staged))
+
+            block = cursor.execute("SELECT Path, Format, Dies, Tests FROM staging.test_blocks WHERE MasterID = ?", (staged,)).fetchone()
+            if block:
+                TestStore.import_block(cursor, path, mid, os.path.join(staging_dir, block[0]), block[1], block[2], block[3],
+                                       test_dir if path == catalog else None)
+            else:
+                TestStore.drop_tests(cursor, mid, test_filter)
+
+        for conn in targets.values():
+            conn.commit()
+            conn.execute("DETACH DATABASE staging")
+    finally:
+        for conn in targets.values():
+            conn.close()
+        router.close()
+
+    # Ledger entries point at the staging MasterIDs
+    for path, size, mtime, file_hash, _, content in ledger:
+        IDs = [(mid,) for mid in mids.values()]
+        IngestLedger.record(db_name, path, {"size": size, "mtime": mtime, "hash": file_hash}, IDs, content)
+    return mids
+
+
+def _remove_staging(staging_db):
+    for path in (staging_db, staging_db + "-journal", staging_db + "-wal", staging_db + "-shm"):
+        if os.path.exists(path):
+            os.remove(path)
+    shutil.rmtree(TestStore.store_dir(staging_db), ignore_errors=True)
+
+
+def _report(index, total, file_name, state, size, seconds, mids, error=None):
+    rate = size / 1e6 / seconds if seconds else 0.0
+    line = f"[{index}/{total}] {os.path.basename(file_name)}: {state}, {size / 1e6:.1f} MB in {seconds:.1f}s ({rate:.2f} MB/s)"
+    if mids:
+        line += f", wafers {mids}"
+    if error:
+        line += f", {error}"
+    print(line)
+
+
+def ingest(files, db_name, workers=None, parser_options=None, loader_options=None, staging=True, staging_dir=None, force=False):
+    """
+    Load many STDF files into a database.
+
+    Args:
+    files [list]: STDF file paths, see collect_files; with staging, later files win for wafers found in several
+    db_name [string]: target database
+    workers [int]: worker processes, defaults to one per core
+    parser_options [dict]: forwarded to WaferMap.main, e.g. {"die_store": True}
+    loader_options [dict]: forwarded to WaferMap.main, e.g. {"test_storage": "npy"}
+    staging [bool]: load into per-file staging databases merged by this process, falls back to direct
+                    loads for retest merges and for test blocks of a subset of tests
+    staging_dir [string]: directory of the staging databases, defaults to <database>.staging next to db_name
+    force [bool]: reload files the ingest ledger shows as loaded and unchanged
+
+    Returns:
+    results [list]: {"file", "state", "size", "seconds", "ids", "error"} of every file, state is
+                    "done", "unchanged" or "failed"
+    """
+    start_time = time.time()
+    parser_options = dict(parser_options or {})
+    loader_options = dict(loader_options or {})
+    Schema.migrate(db_name)
+
+    # Same content key as WaferMap.main
+    test_filter = set() if parser_options.get("skip_ptr") else parser_options.get("test_filter")
+    content = IngestLedger.content_key(test_filter, loader_options.get("test_storage"), loader_options.get("merge", False))
+
+    # Staged loads cannot see the target's stored dies and tests
+    if loader_options.get("merge") or (loader_options.get("test_storage") and test_filter is not None):
+        staging = False
+    test_dir = loader_options.get("test_dir")
+    if staging:
+        staging_dir = staging_dir or os.path.splitext(os.path.abspath(db_name))[0] + ".staging"
+        os.makedirs(staging_dir, exist_ok=True)
+        staging_options = dict(loader_options, bulk=True, pragmas=STAGING_PRAGMAS)
+        staging_options.pop("test_dir", None)
+        options = {"parser_options": parser_options, "loader_options": staging_options}
+    else:
+        options = {"parser_options": parser_options, "loader_options": loader_options}
+
+    results = [{"file": file_name, "state": "queued", "size": 0, "seconds": 0.0, "ids": [], "error": None} for file_name in files]
+    total = len(files)
+    write_lock = multiprocessing.Lock()
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count() or 1, initializer=_init_worker, initargs=(write_lock,)) as executor:
+        futures = {}
+        for index, result in enumerate(results):
+            file_name = result["file"]
+            try:
+                file_fingerprint = fingerprint(file_name)
+            except OSError as e:
+                result.update(state="failed", error=str(e))
+                continue
+            result["size"] = file_fingerprint["size"]
+            if not force and IngestLedger.lookup(db_name, file_name, file_fingerprint, content):
+                result["state"] = "unchanged"
+                continue
+            staging_db = os.path.join(staging_dir, f"{index}-{os.path.basename(file_name)}.db") if staging else None
+            if staging_db:
+                _remove_staging(staging_db)
+            futures[executor.submit(_load_file, file_name, db_name, staging_db, options)] = (index, staging_db)
+
+        # Staging databases are merged in file order as soon as their predecessors are
+        loaded, merge_next, merge_seconds = {}, 0, 0.0
+        for future in as_completed(futures):
+            index, staging_db = futures[future]
+            result = results[index]
+            try:
+                outcome = future.result()
+                result["seconds"] = outcome["seconds"]
+                if outcome["complete"]:
+                    result.update(state="done", ids=outcome["ids"])
+                else:
+                    result.update(state="failed", error="incomplete load")
+            except Exception as e:
+                result.update(state="failed", error=f"{type(e).__name__}: {e}")
+            loaded[index] = staging_db
+
+            while merge_next < total and (merge_next in loaded or results[merge_next]["state"] in ("unchanged", "failed")):
+                result = results[merge_next]
+                staging_db = loaded.pop(merge_next, None)
+                if staging_db and result["state"] == "done":
+                    merge_start = time.time()
+                    try:
+                        mids = merge_staging(db_name, staging_db, test_filter, test_dir)
+                        result["ids"] = [mids[mid] for mid in result["ids"]]
+                    except (sqlite3.Error, OSError) as e:
+                        result.update(state="failed", error=f"merge failed: {e}", ids=[])
+                    merge_seconds += time.time() - merge_start
+                if staging_db:
+                    _remove_staging(staging_db)
+                if result["state"] != "unchanged":
+                    _report(merge_next + 1, total, result["file"], result["state"], result["size"], result["seconds"], result["ids"], result["error"])
+                merge_next += 1
+
+    # The ledger lookups above opened the database's router
+    ShardRouter.close_router(db_name)
+
+    if staging:
+        try:
+            os.rmdir(staging_dir)
+        except OSError:
+            pass
+
+    # Aggregate throughput
+    wall = time.time() - start_time
+    done = [result for result in results if result["state"] == "done"]
+    failed = [result for result in results if result["state"] == "failed"]
+    unchanged = sum(result["state"] == "unchanged" for result in results)
+    size = sum(result["size"] for result in done)
+    busy = sum(result["seconds"] for result in done)
+    print(f"{len(done)} loaded, {unchanged} unchanged, {len(failed)} failed | {size / 1e6:.1f} MB in {wall:.1f}s: "
+          f"{size / 1e6 / wall if wall else 0.0:.2f} MB/s, {len(done) / wall * 60 if wall else 0.0:.1f} files/min, "
+          f"{busy / wall if wall else 0.0:.1f} loads in parallel" + (f", {merge_seconds:.1f}s merging" if staging else ""))
+    for result in failed:
+        print(f"FAILED {result['file']}: {result['error']}")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load many STDF files into a database")
+    parser.add_argument("database")
+    parser.add_argument("sources", nargs="+", help="STDF files, directories or glob patterns")
+    parser.add_argument("--recursive", action="store_true", help="scan subdirectories too")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--direct", action="store_true", help="load straight into the database instead of staging databases")
+    parser.add_argument("--staging-dir", default=None)
+    parser.add_argument("--test-storage", choices=("npy", "npz"), default=None)
+    parser.add_argument("--skip-ptr", action="store_true", help="bin maps only")
+    parser.add_argument("--force", action="store_true", help="reload files that are already loaded and unchanged")
+    args = parser.parse_args()
+
+    files = collect_files(args.sources, args.recursive)
+    if not files:
+        print("No STDF files found")
+        sys.exit(1)
+    results = ingest(files, args.database, workers=args.workers,
+                     parser_options={"die_store": True, "skip_ptr": args.skip_ptr},
+                     loader_options={"bulk": True, "test_storage": args.test_storage},
+                     staging=not args.direct, staging_dir=args.staging_dir, force=args.force)
+    sys.exit(1 if any(result["state"] == "failed" for result in results) else 0)
@@ -0,0 +1,106 @@
+"""
+
+BatchChannel is the handoff between the parser and the loader.
+
+The parser puts records one at a time, as it would into a Queue; they are
+grouped into batches and moved through a bounded queue. When the loader
+falls behind, the queue fills up and the parser blocks (backpressure), so
+at most maxsize * batch_size records are buffered. The loader iterates the
+channel with blocking gets until the end-of-stream sentinel put by close().
+
+"""
+import time
+import queue
+import threading
+
+
+class BatchChannel:
+    # End-of-stream sentinel
+    _END = object()
+
+    # Records flushed immediately so the loader can commit without waiting for a full batch
+    FLUSH_RECORDS = ("wafer_end", "checkpoint")
+
+    def __init__(self, maxsize=64, batch_size=256):
+        """
+        Args:
+        maxsize [int]: batches buffered before the producer blocks
+        batch_size [int]: records per batch
+        """
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._batch = []
+        self._batch_size = batch_size
+        self._cancelled = threading.Event()
+
+        # Metrics
+        self._batches = 0
+        self._records = 0
+        self._depth_total = 0
+        self._max_depth = 0
+        self._put_wait = 0.0
+        self._get_wait = 0.0
+
+    def put(self, record):
+        """ Add a record to the current batch (producer side). """
+        if self._cancelled.is_set():
+            return
+        self._batch.append(record)
+        if len(self._batch) >= self._batch_size or record[0] in self.FLUSH_RECORDS:
+            self.flush()
+
+    def flush(self):
+        """ Send the current batch, blocking while the channel is full. """
+        if not self._batch:
+            return
+        batch, self._batch = self._batch, []
+        depth = self._queue.qsize()
+        self._depth_total += depth
+        self._max_depth = max(self._max_depth, depth)
+        self._batches += 1
+        self._records += len(batch)
+        self._send(batch)
+
+    def close(self):
+        """ Send the pending batch and the end-of-stream sentinel. """
+        self.flush()
+        self._send(self._END)
+
+    def cancel(self):
+        """ Stop the stream from the consumer side: pending and future puts are dropped. """
+        self._cancelled.set()
+
+    def _send(self, item):
+        start = time.perf_counter()
+        while not self._cancelled.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                continue
+        self._put_wait += time.perf_counter() - start
+
+    def __iter__(self):
+        """ Yield records until the end-of-stream sentinel (consumer side). """
+        while True:
+            start = time.perf_counter()
+            batch = self._queue.get()
+            self._get_wait += time.perf_counter() - start
+            if batch is self._END:
+                return
+            yield from batch
+
+    def metrics(self):
+        """
+        Returns:
+        metrics [dict]: batches, records, mean batch size, mean and max queue depth
+                        seen by the producer, producer blocked time and consumer wait time
+        """
+        return {
+            "batches": self._batches,
+            "records": self._records,
+            "mean_batch_size": self._records / self._batches if self._batches else 0,
+            "mean_queue_depth": self._depth_total / self._batches if self._batches else 0,
+            "max_queue_depth": self._max_depth,
+            "producer_blocked_seconds": self._put_wait,
+            "consumer_wait_seconds": self._get_wait,
+        }
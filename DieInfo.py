@@ -6,13 +6,41 @@ DieInfo instances are inserted into a queue. The
 data within each instance is extracted then inserted
 into the database. 
 
+Test results are either a list of tuples, or, when PTR records are
+batch decoded, a structured NumPy array (see BatchDecoder).
+
+DieStore is the compact alternative to queuing one DieInfo per die: a
+wafer-scoped struct-of-arrays holding one DIE_DTYPE row per die, an
+offsets array and one flat TEST_RESULT_DTYPE block with the test results
+of every die. Die i owns tests[offsets[i]:offsets[i + 1]].
+
 """
+from array import array
+
+import numpy as np
+
+from BatchDecoder import decode_ptr_batch, to_test_array, TEST_RESULT_DTYPE
+
+# One row per die, in the column order of the die_info table
+DIE_DTYPE = np.dtype([
+    ('DieID', '<u4'),
+    ('SiteNum', 'u1'),
+    ('HardwareBin', '<u2'),
+    ('SoftwareBin', '<u2'),
+    ('DieX', '<i2'),
+    ('DieY', '<i2'),
+    ('PartFlg', 'u1'),
+    ('Passing', 'u1'),
+])
+
 class DieInfo:
     def __init__(self, number, site):
         self.info = None        # Store wafer configuration data
         self.number = number;   # Store part id
         self.site = site        # Store site number
         self.test_results = []  # Store test results
+        self._ptr_buffer = None # Raw PTR bodies awaiting batch decoding
+        self._ptr_starts = None # Offset of each PTR body within _ptr_buffer
 
     def set_info(self, info):
         self.info = info
@@ -23,6 +51,20 @@ class DieInfo:
     def add_test_result(self, test_result):
         self.test_results.append(test_result)
 
+    def add_ptr_record(self, record):
+        """ Append a raw PTR body for later batch decoding. """
+        if self._ptr_buffer is None:
+            self._ptr_buffer = bytearray()
+            self._ptr_starts = array('I')
+        self._ptr_starts.append(len(self._ptr_buffer))
+        self._ptr_buffer += record
+
+    def decode_ptr_records(self):
+        """ Decode the gathered PTR bodies into test result columns and free the raw buffer. """
+        if self._ptr_buffer is not None:
+            self.test_results = decode_ptr_batch(self._ptr_buffer, self._ptr_starts)
+            self._ptr_buffer = self._ptr_starts = None
+
     def get_test_results(self):
         return self.test_results
 
@@ -33,4 +75,83 @@ class DieInfo:
         return self.site
 
 
+class DieStore:
+    def __init__(self, die_capacity=1024, test_capacity=1 << 16):
+        self._dies = np.empty(die_capacity, dtype=DIE_DTYPE)
+        self._offsets = np.zeros(die_capacity + 1, dtype=np.uint64)
+        self._tests = np.empty(test_capacity, dtype=TEST_RESULT_DTYPE)
+        self.die_count = 0
+
+    @classmethod
+    def from_arrays(cls, dies, offsets, tests):
+        """ Wrap existing columns, offsets must start at 0 and hold len(dies) + 1 entries. """
+        store = cls.__new__(cls)
+        store._dies, store._offsets, store._tests = dies, offsets, tests
+        store.die_count = len(dies)
+        return store
+
+    @classmethod
+    def concat(cls, stores):
+        """ Merge stores, e.g. the chunks of one wafer, into a single store. """
+        stores = [store for store in stores if len(store)]
+        if not stores:
+            return cls()
+        bases = np.cumsum([0] + [len(store.tests) for store in stores[:-1]], dtype=np.uint64)
+        offsets = np.concatenate([[0]] + [store.offsets[1:] + base for store, base in zip(stores, bases)]).astype(np.uint64)
+        return cls.from_arrays(np.concatenate([store.dies for store in stores]), offsets,
+                               np.concatenate([store.tests for store in stores]))
+
+    def __len__(self):
+        return self.die_count
+
+    @property
+    def dies(self):
+        return self._dies[:self.die_count]
+
+    @property
+    def offsets(self):
+        return self._offsets[:self.die_count + 1]
+
+    @property
+    def tests(self):
+        return self._tests[:int(self._offsets[self.die_count])]
+
+    @property
+    def nbytes(self):
+        return self.dies.nbytes + self.offsets.nbytes + self.tests.nbytes
+
+    def test_counts(self):
+        """ Number of test results of each die. """
+        return np.diff(self.offsets).astype(np.int64)
+
+    def get_test_results(self, index):
+        """ Test results of the die stored at index. """
+        return self._tests[int(self._offsets[index]):int(self._offsets[index + 1])]
+
+    def add_die(self, number, site, info, test_results):
+        """
+        Append a die.
+
+        Args:
+        number [int]: DieID
+        site [int]: site number
+        info [tuple]: (HARD_Bin, SOFT_Bin, X_COORD, Y_COORD, PART_FLG, PassFail)
+        test_results [list or numpy.ndarray]: see DieInfo
+        """
+        tests = to_test_array(test_results, site)
+        index = self.die_count
+        start = int(self._offsets[index])
+        end = start + len(tests)
+
+        # Grow the columns by doubling
+        if index == len(self._dies):
+            self._dies = np.resize(self._dies, 2 * index)
+            self._offsets = np.resize(self._offsets, 2 * index + 1)
+        if end > len(self._tests):
+            self._tests = np.resize(self._tests, max(2 * len(self._tests), end))
 
+        hard_bin, soft_bin, x, y, part_flg, passing = info
+        self._dies[index] = (number, site, hard_bin, soft_bin, x, y, part_flg, passing)
+        self._tests[start:end] = tests
+        self._offsets[index + 1] = end
+        self.die_count += 1
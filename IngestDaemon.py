@@ -0,0 +1,365 @@
+"""
+
+IngestDaemon loads the STDF files dropped into watched folders, without the GUI.
+
+Every watched folder is polled for STDF files (plain or .gz/.bz2/.xz). A file
+is queued once its size and mtime have not changed for `settle` seconds, so a
+file still being copied in is left alone, and queued again whenever it
+changes later on; the ingest ledger turns an unchanged file into a no-op.
+
+Jobs run WaferMap.main in a pool of worker processes (Loader and WaferMap keep
+per-process state, so jobs cannot share one). Files are parsed concurrently,
+but SQLite takes one writer at a time: every database has a write lock that a
+job holds while its loader writes, so loads into the same database queue up
+behind each other while loads into other databases go ahead. Model.main can
+be run on every loaded wafer after its ingest.
+
+Job states and throughput are printed every report_interval seconds and
+written to a JSON status file when one is given. Throughput counts the time
+the daemon had work queued or running, not the time it sat idle.
+
+Usage:
+    python IngestDaemon.py drop_folder database.db [--workers 4] [--predict] [--status-file status.json]
+
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+import functools
+import collections
+import queue
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, CancelledError
+
+import Schema
+import WaferMap
+import ShardRouter
+from Parser import STDF_SUFFIXES
+
+# queued -> running -> done | unchanged | failed, or cancelled when the daemon stops first
+JOB_STATES = ("queued", "running", "done", "unchanged", "failed", "cancelled")
+
+# Write lock of every database and the queue of job starts, set in each worker process by _init_worker
+_write_locks = {}
+_events = None
+
+
+def _init_worker(write_locks, events):
+    global _write_locks, _events
+    _write_locks, _events = write_locks, events
+
+
+def _run_job(file_name, db_name, ingest_options, predict, model_options):
+    """
+    Load one file in a worker process.
+
+    Returns:
+    result [dict]: {"ids", "complete", "unchanged", "started", "finished", "outliers"}
+    """
+    started = time.time()
+    _events.put((file_name, started))
+    lock = _write_locks.get(db_name)
+    try:
+        IDs = WaferMap.main(file_name, db_name, write_lock=lock, **ingest_options)
+        result = {"ids": [wafer[0] for wafer in IDs], "unchanged": WaferMap.UNCHANGED,
+                  "complete": bool(IDs) and (WaferMap.UNCHANGED or WaferMap.COMPLETE), "started": started, "outliers": {}}
+
+        # Predict the wafers that were just loaded, Model.main writes temporary_data
+        if predict and result["complete"] and not result["unchanged"]:
+            import Model
+            with lock:
+                for mid in result["ids"]:
+                    result["outliers"][mid] = int(Model.main(db_name, mid, **model_options)[0])
+    finally:
+        # Workers outlive their jobs, keep no connection or shard attached between them
+        ShardRouter.close_router(db_name)
+
+    result["finished"] = time.time()
+    return result
+
+
+class IngestJob:
+    def __init__(self, file_name, db_name, size):
+        self.file_name = file_name
+        self.db_name = db_name
+        self.size = size
+        self.state = "queued"
+        self.queued = time.time()
+        self.started = None
+        self.finished = None
+        self.ids = []
+        self.outliers = {}
+        self.error = None
+
+    def seconds(self):
+        if self.started is None:
+            return None
+        return (self.finished or time.time()) - self.started
+
+    def as_dict(self):
+        return {"file": self.file_name, "database": self.db_name, "size": self.size, "state": self.state,
+                "queued": self.queued, "seconds": self.seconds(), "ids": self.ids, "outliers": self.outliers,
+                "error": self.error}
+
+
+class IngestDaemon:
+    def __init__(self, folders, workers=None, poll_interval=5.0, settle=2.0, ingest_options=None, predict=False,
+                 model_options=None, status_file=None, report_interval=60.0, history=1000):
+        """
+        Args:
+        folders [dict]: watched folder -> database its files are loaded into
+        workers [int]: concurrent jobs, defaults to one per core
+        poll_interval [float]: seconds between folder scans
+        settle [float]: seconds a file's size and mtime must stay the same before it is queued
+        ingest_options [dict]: keyword arguments forwarded to WaferMap.main, e.g.
+                               {"loader_options": {"bulk": True}, "parser_options": {"die_store": True}}
+        predict [bool]: run Model.main on every wafer loaded
+        model_options [dict]: keyword arguments forwarded to Model.main, e.g. {"nu": 0.06}
+        status_file [string]: JSON file rewritten with status() at every report
+        report_interval [float]: seconds between status reports
+        history [int]: finished jobs kept in status()
+        """
+        self._folders = {os.path.abspath(folder): os.path.abspath(db) for folder, db in folders.items()}
+        self._workers = workers or os.cpu_count() or 1
+        self._poll_interval = poll_interval
+        self._settle = settle
+        self._ingest_options = dict(ingest_options or {})
+        self._predict = predict
+        self._model_options = dict(model_options or {})
+        self._status_file = status_file
+        self._report_interval = report_interval
+
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._executor = None
+        self._write_locks = {db: multiprocessing.Lock() for db in set(self._folders.values())}
+        self._events = multiprocessing.Queue()
+
+        self._seen = {}         # path -> ((size, mtime), first time seen with it) while settling
+        self._submitted = {}    # path -> (size, mtime) of the last version queued
+        self._active = {}       # path -> IngestJob queued or running
+        self._finished = collections.deque(maxlen=history)
+        self._totals = collections.Counter()
+
+        # Throughput is measured over the time with at least one job active
+        self._started = time.time()
+        self._busy = 0.0
+        self._busy_since = None
+
+    def _scan(self, folder):
+        try:
+            entries = list(os.scandir(folder))
+        except OSError as e:
+            print(f"Cannot scan {folder}: {e}")
+            return []
+        return [entry for entry in entries if entry.name.lower().endswith(STDF_SUFFIXES) and entry.is_file()]
+
+    def poll(self):
+        """
+        Scan the watched folders once and queue the files that settled.
+
+        Returns:
+        queued [int]: jobs queued by this scan
+        """
+        now, queued, present = time.time(), 0, set()
+        for folder, db_name in self._folders.items():
+            for entry in self._scan(folder):
+                path = os.path.abspath(entry.path)
+                present.add(path)
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                version = (stat.st_size, stat.st_mtime_ns)
+
+                # Already queued in this version, or still being loaded
+                if self._submitted.get(path) == version or path in self._active:
+                    continue
+
+                # Wait until the file stops changing
+                seen = self._seen.get(path)
+                if seen is None or seen[0] != version:
+                    self._seen[path] = (version, now)
+                    if self._settle > 0:
+                        continue
+                elif now - seen[1] < self._settle:
+                    continue
+
+                del self._seen[path]
+                self._submitted[path] = version
+                self.submit(path, db_name, stat.st_size)
+                queued += 1
+
+        # Forget files removed from the folders, a file dropped again is loaded again
+        for path in set(self._seen) - present:
+            del self._seen[path]
+        for path in set(self._submitted) - present:
+            del self._submitted[path]
+        return queued
+
+    def submit(self, file_name, db_name, size=None):
+        """ Queue a file for loading into db_name, which must be one of the watched databases. """
+        db_name = os.path.abspath(db_name)
+        if db_name not in self._write_locks:
+            raise ValueError(f"{db_name} is not the database of a watched folder")
+        if size is None:
+            size = os.path.getsize(file_name)
+        job = IngestJob(file_name, db_name, size)
+
+        with self._lock:
+            self._active[file_name] = job
+            if self._busy_since is None:
+                self._busy_since = job.queued
+            self._totals["queued"] += 1
+
+        future = self._executor.submit(_run_job, file_name, db_name, self._ingest_options, self._predict, self._model_options)
+        future.add_done_callback(functools.partial(self._job_finished, job))
+        return job
+
+    def _drain_events(self):
+        """ Mark the jobs the workers started since the last call as running. """
+        while True:
+            try:
+                file_name, started = self._events.get_nowait()
+            except queue.Empty:
+                return
+            job = self._active.get(file_name)
+            if job is not None and job.state == "queued":
+                job.state, job.started = "running", started
+
+    def _job_finished(self, job, future):
+        try:
+            result = future.result()
+            job.started, job.finished = result["started"], result["finished"]
+            job.ids, job.outliers = result["ids"], result["outliers"]
+            if result["unchanged"]:
+                job.state = "unchanged"
+            elif result["complete"]:
+                job.state = "done"
+            else:
+                job.state, job.error = "failed", "incomplete load, see the worker output"
+        except CancelledError:
+            job.state = "cancelled"
+        except Exception as e:
+            job.state, job.error = "failed", f"{type(e).__name__}: {e}"
+        job.finished = job.finished or time.time()
+
+        with self._lock:
+            self._active.pop(job.file_name, None)
+            self._finished.append(job)
+            self._totals[job.state] += 1
+            if job.state == "done":
+                self._totals["bytes"] += job.size
+            if not self._active and self._busy_since is not None:
+                self._busy += job.finished - self._busy_since
+                self._busy_since = None
+        if job.state == "failed":
+            print(f"Ingest of {job.file_name} failed: {job.error}")
+
+    def status(self):
+        """
+        Returns:
+        status [dict]: job counts per state, throughput and the active and recent jobs
+        """
+        with self._lock:
+            self._drain_events()
+            now = time.time()
+            busy = self._busy + (now - self._busy_since if self._busy_since is not None else 0.0)
+            active = list(self._active.values())
+            finished = list(self._finished)
+            totals = dict(self._totals)
+        states = collections.Counter(job.state for job in active)
+        for state in JOB_STATES[2:]:
+            states[state] = totals.get(state, 0)
+
+        done = [job for job in finished if job.state == "done" and job.seconds()]
+        return {
+            "uptime": now - self._started,
+            "busy": busy,
+            "workers": self._workers,
+            "states": {state: states.get(state, 0) for state in JOB_STATES},
+            "files_per_min": totals.get("done", 0) / busy * 60 if busy else 0.0,
+            "mb_per_s": totals.get("bytes", 0) / 1e6 / busy if busy else 0.0,
+            # Speed of a single worker, the aggregate above also reflects the concurrency
+            "job_mb_per_s": sum(job.size for job in done) / 1e6 / sum(job.seconds() for job in done) if done else 0.0,
+            "active": [job.as_dict() for job in active],
+            "recent": [job.as_dict() for job in finished],
+        }
+
+    def report(self):
+        status = self.status()
+        states = " ".join(f"{state}={count}" for state, count in status["states"].items())
+        print(f"ingest: {states} | {status['files_per_min']:.1f} files/min, {status['mb_per_s']:.2f} MB/s "
+              f"({status['job_mb_per_s']:.2f} MB/s per job) over {status['busy']:.0f}s busy")
+
+        # Written next to its final path then swapped in, readers never see half a file
+        if self._status_file:
+            temp = self._status_file + ".tmp"
+            with open(temp, "w") as f:
+                json.dump(status, f, indent=1)
+            os.replace(temp, self._status_file)
+        return status
+
+    def idle(self):
+        with self._lock:
+            return not self._active and not self._seen
+
+    def run(self, until_idle=False):
+        """
+        Poll the watched folders until stop() is called or Ctrl+C. Running jobs are
+        finished on the way out, queued ones are cancelled and picked up on the next start.
+
+        Args:
+        until_idle [bool]: return once every file present has been loaded
+        """
+        self._stop.clear()
+        # Upgrade every database once here rather than in concurrent jobs
+        for db_name in self._write_locks:
+            Schema.migrate(db_name)
+        self._executor = ProcessPoolExecutor(max_workers=self._workers, initializer=_init_worker,
+                                             initargs=(self._write_locks, self._events))
+        last_report = time.time()
+        try:
+            while not self._stop.is_set():
+                self.poll()
+                if until_idle and self.idle():
+                    break
+                if time.time() - last_report >= self._report_interval:
+                    self.report()
+                    last_report = time.time()
+                self._stop.wait(min(self._poll_interval, self._settle) if self._seen else self._poll_interval)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+        return self.report()
+
+    def stop(self):
+        self._stop.set()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load the STDF files dropped into a folder")
+    parser.add_argument("folder")
+    parser.add_argument("database")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--poll", type=float, default=5.0, help="seconds between folder scans")
+    parser.add_argument("--settle", type=float, default=2.0, help="seconds a file must stay unchanged before it is loaded")
+    parser.add_argument("--bulk", action="store_true", help="batched inserts with ingest PRAGMAs")
+    parser.add_argument("--test-storage", choices=("npy", "npz"), default=None)
+    parser.add_argument("--predict", action="store_true", help="run the die level prediction on every wafer loaded")
+    parser.add_argument("--status-file", default=None)
+    parser.add_argument("--report", type=float, default=60.0, help="seconds between status reports")
+    parser.add_argument("--once", action="store_true", help="load the files present and exit")
+    args = parser.parse_args()
+
+    loader_options = {"bulk": args.bulk, "test_storage": args.test_storage}
+    daemon = IngestDaemon({args.folder: args.database}, workers=args.workers, poll_interval=args.poll, settle=args.settle,
+                          ingest_options={"parser_options": {"die_store": True}, "loader_options": loader_options},
+                          predict=args.predict, status_file=args.status_file, report_interval=args.report)
+    status = daemon.run(until_idle=args.once)
+    sys.exit(1 if status["states"]["failed"] else 0)
@@ -0,0 +1,206 @@
+"""
+
+IngestLedger remembers which STDF files were loaded into a database.
+
+Every complete load records the file's fingerprint (size, mtime and a hash
+of its first and last MiB, see RecordIndex.fingerprint), the MasterIDs it
+produced and the load settings that change what is stored. Opening the same
+file again returns the stored IDs instead of parsing it when all of these
+still match; any difference falls back to a full reload.
+
+Loads in progress also keep their last durable checkpoint: the parser state
+at a byte offset (see ParseFile.checkpoint), committed by the loader in the
+same transaction as the rows before it. A load that died midway resumes from
+there as long as the start of the file is unchanged.
+
+"""
+import os
+import json
+import sqlite3
+import hashlib
+import datetime
+
+import Schema
+import ShardRouter
+
+# Bytes at the start of a file that identify it for resuming
+_HEAD_SAMPLE = 1 << 20
+
+
+def content_key(test_filter=None, test_storage=None, merge=False):
+    """
+    Settings of a load that change what ends up in the database.
+
+    Args:
+    test_filter [set]: tests loaded, None for all tests and an empty set for none
+    test_storage [string]: Loader test_storage
+    merge [bool]: Loader retest merge
+    """
+    tests = "all" if test_filter is None else sorted(test_filter)
+    return json.dumps({"tests": tests, "test_storage": test_storage, "merge": merge}, sort_keys=True)
+
+
+def _covers(stored, requested):
+    """ A load of every test covers a reload of a subset of them with the same storage. """
+    if stored == requested:
+        return True
+    stored, requested = json.loads(stored), json.loads(requested)
+    return (stored["tests"] == "all" and stored["test_storage"] == requested["test_storage"]
+            and stored.get("merge", False) == requested.get("merge", False))
+
+
+def _connect(db_name):
+    conn = sqlite3.connect(db_name)
+    Schema.migrate(conn)
+    return conn
+
+
+def lookup(db_name, file_name, fingerprint, content):
+    """
+    Returns the wafers of an unchanged file that is already loaded.
+
+    Args:
+    db_name [string]
+    file_name [string]: STDF file path
+    fingerprint [dict]: RecordIndex.fingerprint of the file
+    content [string]: content_key of the requested load
+
+    Returns:
+    IDs [list]: (MasterID, LotID, WaferID) of every wafer of the file, None when it must be loaded
+    """
+    conn = _connect(db_name)
+    try:
+        row = conn.execute("SELECT Size, MTime, Hash, MasterIDs, Content FROM ingest_ledger WHERE Path = ?",
+                           (os.path.abspath(file_name),)).fetchone()
+        if not row or row[:3] != (fingerprint["size"], fingerprint["mtime"], fingerprint["hash"]):
+            return None
+        if not _covers(row[4], content):
+            return None
+
+        # The wafers must still be in the database, or in their shard
+        IDs = []
+        for mid in json.loads(row[3]):
+            wafer = conn.execute("SELECT * FROM wafer_info WHERE MasterID = ?", (mid,)).fetchone()
+            if not wafer:
+                return None
+            try:
+                if not ShardRouter.get_router(db_name).query(mid, "SELECT 1 FROM {shard}.die_info WHERE MasterID = ? LIMIT 1", (mid,)):
+                    return None
+            except FileNotFoundError:
+                return None
+            IDs.append(wafer)
+        return IDs or None
+    finally:
+        conn.close()
+
+
+def record(db_name, file_name, fingerprint, IDs, content):
+    """
+    Record a complete load of a file.
+
+    Entries of other files that shared one of its wafers are dropped, their data
+    was overwritten by this load. A retest merge keeps them: it only overwrote some dies.
+
+    Args:
+    IDs [list]: (MasterID, LotID, WaferID) of every wafer loaded
+    """
+    path = os.path.abspath(file_name)
+    mids = [wafer[0] for wafer in IDs]
+    conn = _connect(db_name)
+    try:
+        with conn:
+            # A subset reload of an unchanged file keeps the full load it refreshed
+            row = conn.execute("SELECT Size, MTime, Hash, Content FROM ingest_ledger WHERE Path = ?", (path,)).fetchone()
+            if row and row[:3] == (fingerprint["size"], fingerprint["mtime"], fingerprint["hash"]) and _covers(row[3], content):
+                content = row[3]
+
+            if not json.loads(content).get("merge"):
+                _drop_wafers(conn, mids)
+
+            conn.execute("INSERT OR REPLACE INTO ingest_ledger (Path, Size, MTime, Hash, MasterIDs, Content, LoadedAt) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                         (path, fingerprint["size"], fingerprint["mtime"], fingerprint["hash"], json.dumps(mids), content,
+                          datetime.datetime.now().isoformat(timespec="seconds")))
+    finally:
+        conn.close()
+
+
+def _drop_wafers(conn, mids):
+    """ Drop the entries of files holding one of the wafers. """
+    for path, file_mids in conn.execute("SELECT Path, MasterIDs FROM ingest_ledger").fetchall():
+        if set(json.loads(file_mids)) & set(mids):
+            conn.execute("DELETE FROM ingest_ledger WHERE Path = ?", (path,))
+
+
+def forget(db_name, file_name, IDs=()):
+    """
+    Drop a file's entry so the next open reloads it, e.g. after an incomplete load.
+    Entries of other files sharing one of the IDs are dropped too, their wafers were overwritten.
+    """
+    conn = _connect(db_name)
+    try:
+        with conn:
+            conn.execute("DELETE FROM ingest_ledger WHERE Path = ?", (os.path.abspath(file_name),))
+            _drop_wafers(conn, [wafer[0] for wafer in IDs])
+    finally:
+        conn.close()
+
+
+def _head_hash(file_name, length):
+    with open(file_name, "rb") as f:
+        return hashlib.blake2b(f.read(length), digest_size=16).hexdigest()
+
+
+def source(file_name):
+    """
+    Identity of a file being loaded with checkpoints, handed to the Loader.
+
+    Returns:
+    source [dict]: {"path", "head_length", "head_hash"}
+    """
+    length = min(os.path.getsize(file_name), _HEAD_SAMPLE)
+    return {"path": os.path.abspath(file_name), "head_length": length, "head_hash": _head_hash(file_name, length)}
+
+
+def save_checkpoint(cursor, source, state, loader_state):
+    """
+    Record the parser state of a checkpoint, in the loader's transaction.
+
+    Args:
+    cursor [sqlite3.Cursor]
+    source [dict]: see source()
+    state [dict]: ParseFile checkpoint state
+    loader_state [dict]: Loader state, e.g. the MasterIDs loaded so far
+    """
+    cursor.execute("INSERT OR REPLACE INTO ingest_checkpoints (Path, HeadLength, HeadHash, State, LoaderState, UpdatedAt) VALUES (?, ?, ?, ?, ?, ?)",
+                   (source["path"], source["head_length"], source["head_hash"], json.dumps(state), json.dumps(loader_state),
+                    datetime.datetime.now().isoformat(timespec="seconds")))
+
+
+def clear_checkpoint(cursor, source):
+    """ Drop the checkpoint of a load that completed, in the loader's transaction. """
+    cursor.execute("DELETE FROM ingest_checkpoints WHERE Path = ?", (source["path"],))
+
+
+def load_checkpoint(db_name, file_name):
+    """
+    Returns the last checkpoint of an interrupted load of the file, when the file
+    still holds the bytes parsed before it.
+
+    Returns:
+    checkpoint [tuple]: (ParseFile checkpoint state, Loader state), None when the file
+                        must be loaded from the start
+    """
+    conn = _connect(db_name)
+    try:
+        row = conn.execute("SELECT HeadLength, HeadHash, State, LoaderState FROM ingest_checkpoints WHERE Path = ?",
+                           (os.path.abspath(file_name),)).fetchone()
+    finally:
+        conn.close()
+    if not row:
+        return None
+    state = json.loads(row[2])
+    if not os.path.exists(file_name) or os.path.getsize(file_name) < max(state["offset"], row[0]):
+        return None
+    if _head_hash(file_name, row[0]) != row[1]:
+        return None
+    return state, json.loads(row[3])
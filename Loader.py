@@ -1,26 +1,121 @@
+import os
 import sqlite3
 from sqlite3 import Error
+from itertools import repeat
+import numpy as np
+from BatchDecoder import to_test_array
+import TestStore
+from TestStore import TestBlockWriter
+import Schema
+import IngestLedger
+import ShardRouter
 
 class Loader:
     """Singleton class for interacting with a SQLite database."""
 
     # Class instance
     _instance = None
+
+    # Prepared statements, one per table, reused for every row
+    SQL_INSERT = {
+        "wafer_config": "INSERT INTO wafer_config (MasterID, WaferSize, DieHeight, DieWidth, WaferFlat, CenterX, CenterY, PositiveX, PositiveY) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        "die_info": "INSERT INTO die_info (MasterID, DieID, SiteNum, HardwareBin, SoftwareBin, DieX, DieY, PartFlg, Passing) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        "test_results": "INSERT INTO test_results (MasterID, DieID, TestNumber, LowerLimit, UpperLimit, Result, TestFlag) VALUES (?, ?, ?, ?, ?, ?, ?)",
+    }
+
+    # Merge mode: a retested die replaces the stored die at the same coordinates
+    SQL_MERGE = {
+        "die_info": "INSERT OR REPLACE INTO die_info (MasterID, DieID, SiteNum, HardwareBin, SoftwareBin, DieX, DieY, PartFlg, Passing, Generation) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        "test_results_delete": "DELETE FROM test_results WHERE MasterID = ? AND DieID = ?",
+    }
+
+    # PRAGMAs applied in bulk mode. WAL with synchronous=NORMAL cannot corrupt the
+    # database on a crash, it may only lose the last committed wafers.
+    # page_size only takes effect on a new database, so it comes before journal_mode.
+    INGEST_PRAGMAS = (
+        ("page_size", 8192),
+        ("journal_mode", "WAL"),
+        ("synchronous", "NORMAL"),
+        ("cache_size", -65536),     # 64 MiB
+        ("temp_store", "MEMORY"),
+    )
+
+    # Rows accumulated per table before an executemany in bulk mode
+    BATCH_SIZE = 50000
     
     # Constructor called for creatin new instances of the class
-    def __new__(cls, parse_thread, record_queue, db_name):
-        """Overrides the __new__ method to ensure singleton behavior."""
+    def __new__(cls, record_queue, db_name, test_filter=None, bulk=False, pragmas=None, batch_size=None,
+                test_storage=None, test_dir=None, merge=False, on_commit=None, source=None, resume=None):
+        """
+        Overrides the __new__ method to ensure singleton behavior.
+
+        Args:
+            record_queue: Channel.BatchChannel, or SharedMemoryChannel when the parser
+                runs in its own process, carrying the parser's records.
+            test_filter: Test numbers selected by the parser. None loads every test,
+                an empty set loads no test results and keeps the stored ones.
+            bulk: Accumulate rows per table and write them with executemany, one
+                explicit transaction per wafer.
+            pragmas: (name, value) pairs applied on connection, defaults to
+                INGEST_PRAGMAS in bulk mode and to none otherwise.
+            batch_size: Rows per executemany in bulk mode, defaults to BATCH_SIZE.
+            test_storage: None stores one test_results row per test result, "npy" or
+                "npz" stores each wafer's test results as a TestStore columnar block.
+            test_dir: Directory of the test blocks, defaults to TestStore.store_dir(db_name).
+            merge: Merge a retest file into a stored wafer instead of replacing it: dies
+                overwrite the stored die at the same (DieX, DieY) and keep its DieID, new
+                coordinates get new DieIDs, and the other dies are left untouched.
+                Every die written gets the wafer's next retest Generation.
+            on_commit: Called with the MasterID after each commit of a wafer or of the
+                dies parsed so far (parser checkpoints in follow mode), e.g. to refresh a plot.
+            source: IngestLedger.source of the file. Parser checkpoints carrying a resume
+                state are then recorded with the rows they commit, and cleared once the
+                whole file is loaded.
+            resume: Loader state of the checkpoint the parser resumes from.
+
+        When db_name is a sharded catalog (see ShardRouter) every wafer is written to
+        its shard database; checkpoints are then not recorded.
+        """
         if not cls._instance: # Make sure only one instance exists. 
             cls._instance = super().__new__(cls)
-            cls._instance._parse_thread = parse_thread
             cls._instance._record_queue = record_queue
             cls._instance._db_name = db_name  
+            cls._instance._test_filter = None if test_filter is None else tuple(test_filter)
+            cls._instance._bulk = bulk
+            cls._instance._pragmas = pragmas if pragmas is not None else (cls.INGEST_PRAGMAS if bulk else ())
+            cls._instance._batch_size = batch_size or cls.BATCH_SIZE
+            cls._instance._merge = merge
+            cls._instance._merged = set() # DieIDs written to the current wafer in merge mode
+            cls._instance._sql = cls._statements(merge, cls._instance._test_filter)
+            cls._instance._batches = {table: [] for table in cls._instance._sql}
             cls._instance._conn = None
+            cls._instance._wafer_id = None
+            cls._instance._wafer_ids = list(resume["ids"]) if resume else [] # MasterID of every wafer loaded, in file order
+            cls._instance._source = source
+            cls._instance._resume = resume
+            cls._instance._on_commit = on_commit
+            cls._instance.complete = False # Set once the whole stream is loaded without error
+            cls._instance.error = None # Parse or load error that ended the stream early
+            cls._instance._test_storage = test_storage
+            cls._instance._blocks = TestBlockWriter(db_name, test_storage, test_dir) if test_storage else None
+            cls._instance._router = None
+            cls._instance._shards = {} # Shard path -> (connection, cursor, TestBlockWriter) opened by this load
             cls._instance._connect_to_db() # Connect to the database
         
         # Return instance    
         return cls._instance 
 
+    @classmethod
+    def _statements(cls, merge, test_filter):
+        """Statements by batch name, in the order pending batches are written."""
+        if not merge:
+            return dict(cls.SQL_INSERT)
+        delete = cls.SQL_MERGE["test_results_delete"]
+        if test_filter:
+            delete += f" AND TestNumber IN ({', '.join('?' * len(test_filter))})"
+        # Stored results of a retested die are deleted before its new results are inserted
+        return {"test_results_delete": delete, **cls.SQL_INSERT, "die_info": cls.SQL_MERGE["die_info"]}
+
     @classmethod
     def reset_instance(cls):
         """ Reset class instance to None. """
@@ -31,6 +126,17 @@ class Loader:
         if not self._conn:  # Check only once
             self._conn = sqlite3.connect(self._db_name)
             self._cursor = self._conn.cursor()
+            for name, value in self._pragmas:
+                self._cursor.execute(f"PRAGMA {name} = {value}")
+            # Create or upgrade tables and indexes
+            Schema.migrate(self._conn)
+            self._catalog = (self._conn, self._cursor, self._blocks)
+
+            # Wafers of a sharded catalog are written to their shard, see _use_shard
+            if ShardRouter.sharding(self._cursor):
+                self._router = ShardRouter.ShardRouter(self._db_name)
+                # A checkpoint cannot commit atomically with rows of another database
+                self._source = None
 
     def retrieve_data(self, table_name, query=None, params=None):
         """
@@ -53,73 +159,298 @@ class Loader:
             self._cursor.execute(query)
         return self._cursor.fetchall()
 
+    def _delete_test_results(self):
+        """Deletes the stored test results of the current wafer that are about to be reloaded."""
+        if self._test_filter is None:
+            self.retrieve_data("test_info", "DELETE FROM test_results WHERE MasterID = ?", params=(self._wafer_id,))
+        elif self._test_filter:
+            column_placeholders = ', '.join('?' * len(self._test_filter))
+            self.retrieve_data("test_info", f"DELETE FROM test_results WHERE MasterID = ? AND TestNumber IN ({column_placeholders})", params=(self._wafer_id, *self._test_filter))
+        # A previous load stored as a block must not be read next to the new rows
+        if not self._blocks:
+            TestStore.drop_tests(self._cursor, self._wafer_id, self._test_filter)
+
+    def _close(self):
+        """Closes the catalog and shard connections and detaches the router's shards."""
+        for conn, cursor, _ in (self._catalog, *self._shards.values()):
+            cursor.close()
+            conn.close()
+        self._shards.clear()
+        if self._router:
+            self._router.close()
+
+    def _loaded_ids(self):
+        """Returns (MasterID, LotID, WaferID) of every wafer loaded so far."""
+        cursor = self._catalog[1]
+        return [cursor.execute("SELECT * FROM wafer_info WHERE MasterID = ?", (wafer_id,)).fetchall()[0]
+                for wafer_id in self._wafer_ids]
+
+    def _write(self, table_name, rows):
+        """
+        Writes rows into a table with its prepared statement.
+
+        In bulk mode rows are accumulated and written once a batch is full.
+        """
+        if self._bulk:
+            batch = self._batches[table_name]
+            batch.extend(rows)
+            if len(batch) >= self._batch_size:
+                # Merge deletes must run before the inserts that follow them
+                self._flush(None if self._merge else table_name)
+        else:
+            self._cursor.executemany(self._sql[table_name], rows)
+
+    def _flush(self, table_name=None):
+        """Writes pending bulk rows of one table, or of every table."""
+        for table in ([table_name] if table_name else self._sql):
+            if self._batches[table]:
+                self._cursor.executemany(self._sql[table], self._batches[table])
+                self._batches[table].clear()
+
+    def _start_wafer(self, lot_id, wafer_id):
+        """Registers a wafer (WIR) and clears the data of a previous load of it."""
+        # Close the previous wafer if its WRR was missing
+        self._end_wafer()
+
+        if self._router:
+            self._wafer_id = self._use_shard(lot_id, wafer_id)
+        else:
+            if not self.retrieve_data("wafer_info", query=f"SELECT * FROM wafer_info WHERE LotID = ? and WaferID = ?", params=(lot_id, wafer_id)):
+                self._cursor.execute("INSERT INTO wafer_info (LotID, WaferID) VALUES (?, ?)", (lot_id, wafer_id))
+            self._conn.commit()
+
+            # Fetch MasterID from database
+            self._wafer_id = self.retrieve_data("wafer_info", query=f"SELECT MasterID FROM wafer_info WHERE LotID = ? and WaferID = ?", params=(lot_id, wafer_id))[0][0]
+        if self._wafer_id not in self._wafer_ids:
+            self._wafer_ids.append(self._wafer_id)
+
+        # One explicit transaction per wafer
+        if self._bulk:
+            self._cursor.execute("BEGIN")
+
+        if self._blocks:
+            self._blocks.start(self._wafer_id)
+
+        if self._merge:
+            self._start_merge()
+            return
+
+        # In case of reloading a pre-existing file we must delete it's data from db to avoid some constraints 
+        self.retrieve_data("wafer_config", "DELETE FROM wafer_config WHERE MasterID = ?", params=(self._wafer_id,))
+        self.retrieve_data("die_info", "DELETE FROM die_info WHERE MasterID = ?", params=(self._wafer_id,))
+        self._delete_test_results()
+
+    def _use_shard(self, lot_id, wafer_id):
+        """Registers a wafer in the catalog and switches the connection to its database."""
+        mid, path = self._router.assign(lot_id, wafer_id)
+        if path == os.path.abspath(self._db_name):
+            self._conn, self._cursor, self._blocks = self._catalog
+        else:
+            if path not in self._shards:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                conn = sqlite3.connect(path)
+                cursor = conn.cursor()
+                for name, value in self._pragmas:
+                    cursor.execute(f"PRAGMA {name} = {value}")
+                Schema.migrate(conn)
+                blocks = TestBlockWriter(path, self._test_storage) if self._test_storage else None
+                self._shards[path] = (conn, cursor, blocks)
+            self._conn, self._cursor, self._blocks = self._shards[path]
+
+            # A shard holds the wafer_info rows of its wafers, under the catalog's MasterID
+            self._cursor.execute("INSERT OR IGNORE INTO wafer_info (MasterID, LotID, WaferID) VALUES (?, ?, ?)", (mid, lot_id, wafer_id))
+            self._conn.commit()
+        return mid
+
+    def _start_merge(self):
+        """Loads the stored dies of the current wafer by coordinates for a retest merge."""
+        stored = self.retrieve_data("die_info", "SELECT DieX, DieY, DieID, Generation FROM die_info WHERE MasterID = ?", params=(self._wafer_id,))
+        self._die_map = {(x, y): die_id for x, y, die_id, _ in stored}
+        self._next_die_id = max((row[2] for row in stored), default=0) + 1
+        self._generation = max(row[3] for row in stored) + 1 if stored else 0
+        self._merged = set()
+
+    def _resume_wafer(self, lot_id, wafer_id):
+        """Continues a wafer loaded up to a checkpoint, its stored rows are kept."""
+        self._end_wafer()
+        self._wafer_id = self.retrieve_data("wafer_info", query=f"SELECT MasterID FROM wafer_info WHERE LotID = ? and WaferID = ?", params=(lot_id, wafer_id))[0][0]
+        if self._wafer_id not in self._wafer_ids:
+            self._wafer_ids.append(self._wafer_id)
+        if self._bulk:
+            self._cursor.execute("BEGIN")
+        if self._blocks:
+            self._blocks.start(self._wafer_id, appending=True)
+        if self._merge:
+            self._start_merge()
+            self._generation = self._resume.get("generation", self._generation)
+
+    def _checkpoint(self, state):
+        """Commits the rows received so far, with the parser state to resume after them."""
+        self._flush()
+        if self._blocks:
+            self._blocks.write(self._cursor, self._test_filter, merged_dies=self._merged if self._merge else None, final=False)
+        if state and self._source:
+            loader_state = {"ids": self._wafer_ids}
+            if self._merge:
+                loader_state["generation"] = self._generation
+            IngestLedger.save_checkpoint(self._cursor, self._source, state, loader_state)
+        self._commit()
+
+    def _merge_die_id(self, x, y):
+        """
+        Returns the DieID of a retested die: the stored die at (x, y) keeps its DieID, a
+        new coordinate gets the next free one. Stored results of the die are deleted.
+        """
+        die_id = self._die_map.get((x, y))
+        if die_id is None:
+            die_id = self._next_die_id
+            self._next_die_id += 1
+            self._die_map[(x, y)] = die_id
+        else:
+            if die_id in self._merged:
+                # Retested twice in this file, its pending rows are written before they are deleted
+                self._flush()
+                if self._blocks:
+                    self._blocks.drop_dies([die_id])
+            if not self._blocks and self._test_filter != ():
+                self._write("test_results_delete", [(self._wafer_id, die_id, *(self._test_filter or ()))])
+        self._merged.add(die_id)
+        return die_id
+
+    def _end_wafer(self):
+        """Writes pending rows and commits the current wafer as one unit."""
+        self._flush()
+        if self._blocks:
+            self._blocks.write(self._cursor, self._test_filter, merged_dies=self._merged if self._merge else None)
+        self._commit()
+
+    def _commit(self):
+        """Commits and notifies on_commit."""
+        self._conn.commit()
+        if self._on_commit and self._wafer_id is not None:
+            self._on_commit(self._wafer_id)
+
+    def _write_die(self, die):
+        """Writes a DieInfo and its test results."""
+        die_num = die.get_number()
+        die_info = die.get_info()
+        if self._merge:
+            die_num = self._merge_die_id(die_info[2], die_info[3])
+            self._write("die_info", [(self._wafer_id, die_num, die.get_site(), *die_info, self._generation)])
+        else:
+            self._write("die_info", [(self._wafer_id, die_num, die.get_site(), *die_info)])
+
+        test_results = die.get_test_results()
+        if self._blocks:
+            tests = to_test_array(test_results, die.get_site())
+            self._blocks.add(np.full(len(tests), die_num, dtype=np.uint32), tests)
+            return
+
+        # Batch decoded results arrive as NumPy columns (missing limits as NaN, stored as NULL)
+        if not isinstance(test_results, list):
+            test_results = test_results.tolist()
+        if test_results:
+            self._write("test_results", [(self._wafer_id, die_num, *test_result[:5]) for test_result in test_results])
+
+    def _write_die_store(self, store):
+        """Writes the dies of a DieInfo.DieStore and their test results from its columns."""
+        mid = repeat(self._wafer_id)
+        dies = store.dies
+        tests = store.tests
+        test_counts = store.test_counts()
+        die_ids = dies['DieID']
+        if self._merge:
+            die_ids = np.array([self._merge_die_id(x, y) for x, y in zip(dies['DieX'].tolist(), dies['DieY'].tolist())], dtype=np.uint32)
+            # A die retested within the store: only its last test is kept
+            last = len(die_ids) - 1 - np.unique(die_ids[::-1], return_index=True)[1]
+            if len(last) < len(die_ids):
+                keep = np.zeros(len(die_ids), dtype=bool)
+                keep[last] = True
+                dies, die_ids, tests, test_counts = dies[keep], die_ids[keep], tests[keep.repeat(test_counts)], test_counts[keep]
+        columns = [mid, die_ids.tolist(), dies['SiteNum'].tolist(),
+                   dies['HardwareBin'].tolist(), dies['SoftwareBin'].tolist(),
+                   dies['DieX'].tolist(), dies['DieY'].tolist(),
+                   dies['PartFlg'].tolist(), dies['Passing'].tolist()]
+        if self._merge:
+            columns.append(repeat(self._generation))
+        self._write("die_info", zip(*columns))
+        if self._blocks:
+            self._blocks.add(die_ids.repeat(test_counts), tests)
+        elif len(tests):
+            die_ids = die_ids.repeat(test_counts)
+            self._write("test_results", zip(mid, die_ids.tolist(), tests['TestNumber'].tolist(),
+                                            tests['LowerLimit'].tolist(), tests['UpperLimit'].tolist(),
+                                            tests['Result'].tolist(), tests['TestFlag'].tolist()))
+
     def insert_data(self):
         """
         Inserts a data tuple to the database.
+
+        Each WIR..WRR block is committed as its own unit, so a wafer is queryable
+        while the following wafers of the same file are still being parsed.
         
         Returns:
-        IDs [tuple]: (MasterID, LotID, WaferID)
+        IDs [list]: (MasterID, LotID, WaferID) of every wafer in the file
         """
 
-        while self._parse_thread.is_alive():
-            while not self._record_queue.empty():
-                # Decompose records
-                table_name, *record = self._record_queue.get()
-                # Store identical SQL statements for batch insertion
-                sql_statements = []
-
-                if table_name == "wafer_info":
-                    if not self.retrieve_data("wafer_info", query=f"SELECT * FROM wafer_info WHERE LotID = ? and WaferID = ?", params=(record[0], record[1])):
-                        sql_params = record
-                        column_placeholders = ', '.join('?' * len(sql_params))
-                        sql_statements.append((sql_params, f"""INSERT INTO wafer_info (LotID, WaferID) VALUES ({column_placeholders})"""))
-
-                elif table_name == "wafer_config":
-                    sql_params = (self._wafer_id, record[0], record[1], record[2], record[3], record[4], record[5], record[6], record[7])
-                    column_placeholders = ', '.join('?' * len(sql_params))
-                    sql_statements.append((sql_params, f"""INSERT INTO wafer_config (MasterID, WaferSize, DieHeight, DieWidth, WaferFlat, CenterX, CenterY, PositiveX, PositiveY) VALUES ({column_placeholders})"""))
-                
-                elif table_name == "die_info":
-                    die_num = record[0].get_number()
-                    die_site = record[0].get_site()
-                    die_info = record[0].get_info()
-                    sql_params = (self._wafer_id,die_num,die_site, die_info[0], die_info[1], die_info[2], die_info[3], die_info[4], die_info[5])
-                    column_placeholders = ', '.join('?' * len(sql_params))
-                    sql_statements.append((sql_params, f"""INSERT INTO die_info (MasterID, DieID, SiteNum, HardwareBin, SoftwareBin, DieX, DieY, PartFlg, Passing) VALUES ({column_placeholders})"""))
-                    for test_result in record[0].get_test_results():
-                        sql_params = (self._wafer_id,die_num, test_result[0], test_result[1], test_result[2], test_result[3], test_result[4])
-                        column_placeholders = ', '.join('?' * len(sql_params))
-                        sql_statements.append((sql_params, f"""INSERT INTO test_results (MasterID, DieID, TestNumber, LowerLimit, UpperLimit, Result, TestFlag) VALUES ({column_placeholders})"""))
-
+        self._parse_error = None
+        try:
+            # Blocking iteration until the parser closes the channel
+            for table_name, *record in self._record_queue:
                 try:
-                    for sql_statement in sql_statements:
-                        self._cursor.execute(sql_statement[1], sql_statement[0])
-
                     if table_name == "wafer_info":
-                        self._conn.commit()
-                        # Fetch MasterID from database
-                        self._wafer_id = self.retrieve_data("wafer_info", query=f"SELECT MasterID FROM wafer_info WHERE LotID = ? and WaferID = ?", params=(record[0] , record[1]))[0][0]
-
-                        # In case of reloading a pre-existing file we must delete it's data from db to avoid some constraints 
-                        self.retrieve_data("wafer_config", "DELETE FROM wafer_config WHERE MasterID = ?", params=(self._wafer_id,))
-                        self.retrieve_data("die_info", "DELETE FROM die_info WHERE MasterID = ?", params=(self._wafer_id,))
-                        self.retrieve_data("test_info", "DELETE FROM test_results WHERE MasterID = ?", params=(self._wafer_id,))
-                        
+                        self._start_wafer(record[0], record[1])
+
+                    elif table_name == "wafer_config":
+                        if self._merge:
+                            # A retest file replaces the stored configuration only when it has its own WCR
+                            self.retrieve_data("wafer_config", "DELETE FROM wafer_config WHERE MasterID = ?", params=(self._wafer_id,))
+                        self._write("wafer_config", [(self._wafer_id, *record)])
+
+                    elif table_name == "die_info":
+                        self._write_die(record[0])
+
+                    elif table_name == "die_store":
+                        self._write_die_store(record[0])
+
+                    elif table_name == "wafer_end":
+                        # WRR closes the wafer: commit it as one unit
+                        self._end_wafer()
+
+                    elif table_name == "checkpoint":
+                        # Make the dies parsed so far visible and durable
+                        self._checkpoint(record[1])
+
+                    elif table_name == "resume":
+                        self._resume_wafer(record[0], record[1])
+
+                    elif table_name == "parse_error":
+                        # Keep what was parsed, the load is incomplete
+                        self._parse_error = self.error = record[0]
+                    
                 except (Exception) as error:
                     self._conn.rollback()
+                    for batch in self._batches.values():
+                        batch.clear()
+                    if self._blocks:
+                        self._blocks.discard()
+                    # Unblock the parser
+                    self._record_queue.cancel()
                     print("Error while inserting data:", error)
-                    return
+                    self.error = f"Error while inserting data: {error}"
+                    # Wafers committed before the error are kept
+                    return self._loaded_ids()
 
-        self._conn.commit()
-        
-        # Fetch WaferID, LoID, and MasterID
-        IDs = self.retrieve_data("wafer_info", "SELECT * FROM wafer_info WHERE MasterID = ?", params=(self._wafer_id,))[0]
-
-        # Close db connection
-        self._cursor.close()
-        self._conn.close()
-        
-        return IDs
+            self._end_wafer()
+            self.complete = self._parse_error is None
 
+            # The whole file is loaded, nothing to resume
+            if self.complete and self._source:
+                IngestLedger.clear_checkpoint(self._cursor, self._source)
+                self._conn.commit()
 
-    
\ No newline at end of file
+            # Fetch WaferID, LoID, and MasterID
+            return self._loaded_ids()
+        finally:
+            # Close db connections, also when a load error ended the stream
+            self._close()
@@ -2,12 +2,220 @@ import sqlite3
 import pandas as pd
 from sklearn.preprocessing import StandardScaler
 from sklearn.svm import OneClassSVM
+from sklearn.linear_model import SGDOneClassSVM
+from sklearn.kernel_approximation import Nystroem
+from sklearn.ensemble import IsolationForest
+from sklearn.pipeline import make_pipeline
+from scipy.signal import fftconvolve # scipy is installed with scikit-learn
 from math import sqrt, pow
 import numpy as np
 import io 
 import matplotlib.pyplot as plt # For data visualization
 import matplotlib
 matplotlib.use('Agg') # Use Agg backend to prevent creation of plots as GUIs
+import Schema
+import ShardRouter
+
+# Neighbour offsets of calculate_local_yield_8, in the order its weights are summed
+NEIGHBORHOOD_8 = [(-1, 1), (0, 1), (1, 1), (-1, 0), (1, 0), (-1, -1), (0, -1), (1, -1)]
+
+# Largest grid, in cells per die, rasterized before falling back to a sorted lookup
+MAX_GRID_DENSITY = 64
+
+# Neighbours from which calculate_neighborhood_features convolves the grid with FFTs
+FFT_MIN_NEIGHBORS = 48
+
+# Solver tolerance of the OCSVM fit on distinct feature vectors: whole groups of identical
+# dies sit on the margin, at the default 1e-3 their side is decided by when the solver stops
+DEDUPLICATED_TOL = 1e-9
+
+# Kernels of the exact One-Class SVM, and the approximate detectors selectable as kernel
+OCSVM_KERNELS = ('rbf', 'linear', 'poly', 'sigmoid')
+APPROXIMATE_DETECTORS = ('nystroem', 'iforest')
+KERNELS = OCSVM_KERNELS + APPROXIMATE_DETECTORS
+
+# Landmark dies of the Nystroem approximation of the rbf kernel
+NYSTROEM_COMPONENTS = 100
+
+
+def square_kernel(radius):
+    """
+    Bool kernel of the square neighbourhood of a die: 3x3 for radius 1, 5x5 for radius 2, 7x7 for radius 3.
+    Kernels are indexed [dx + radius, dy + radius], the die itself is not a neighbour.
+    """
+    kernel = np.ones((2 * radius + 1, 2 * radius + 1), dtype=bool)
+    kernel[radius, radius] = False
+    return kernel
+
+
+def neighborhood_offsets(kernel):
+    """
+    Returns the (dx, dy) offsets of the non-zero cells of a kernel, row by row from the
+    top left like NEIGHBORHOOD_8, which they equal for square_kernel(1).
+    """
+    radius = kernel.shape[0] // 2
+    return [(dx, dy) for dy in range(radius, -radius - 1, -1) for dx in range(-radius, radius + 1)
+            if (dx or dy) and kernel[dx + radius, dy + radius]]
+
+
+def distance_weights(offsets, die_dim):
+    """
+    Weights of the neighbours at the given offsets, derived as in calculate_effect_probability:
+    the inverse distances from the die, DieWidth per DieX step and DieHeight per DieY step,
+    are summed over each class of symmetric neighbours (same |dx| and |dy|, e.g. the four
+    corners) and normalized by their total; every neighbour of a class gets its class sum.
+
+    Args:
+    offsets [list]: (dx, dy) neighbour offsets
+    die_dim [tuple]: (DieWidth, DieHeight)
+
+    Returns:
+    weights [numpy.ndarray]
+    """
+    x, y = die_dim
+    if x <= 0 or y <= 0:
+        raise ValueError("Die dimensions must be positive non-zero values.")
+    offsets = np.abs(np.asarray(offsets))
+    inverse_distance = 1 / np.sqrt((offsets[:, 0] * x) ** 2 + (offsets[:, 1] * y) ** 2)
+    _, symmetry_class = np.unique(offsets, axis=0, return_inverse=True)
+    class_sum = np.bincount(symmetry_class, weights=inverse_distance)
+    return class_sum[symmetry_class] / inverse_distance.sum()
+
+
+def _rasterize(x, y, margin):
+    """
+    Number the (DieX, DieY) cells of a grid holding the dies with a margin around them.
+
+    Returns:
+    cells [numpy.ndarray]: cell of every die
+    shape [tuple]: (width, height) of the grid
+    dense [bool]: the grid is small enough to allocate
+    unique_cells, first [numpy.ndarray]: occupied cells and the first die in each
+    """
+    x0, y0 = x.min() - margin, y.min() - margin
+    width, height = int(x.max() - x0 + margin + 1), int(y.max() - y0 + margin + 1)
+    cells = (x - x0) * height + (y - y0)
+    unique_cells, first = np.unique(cells, return_index=True)
+    return cells, (width, height), width * height <= MAX_GRID_DENSITY * len(x) + (1 << 16), unique_cells, first
+
+
+def neighbor_lookup(x, y, passing, offsets):
+    """
+    Find the neighbours of every die at the given offsets.
+
+    The dies are rasterized once into a grid of (DieX, DieY) cells with a margin for
+    the largest offset, so each offset is a single shifted read of the grid. Sparse
+    coordinates whose grid would be too large are looked up in the sorted cells instead.
+    Like calculate_local_yield_8, a cell holding several dies takes the first one.
+
+    Args:
+    x, y [numpy.ndarray]: DieX and DieY of every die
+    passing [numpy.ndarray]: bool, die passed
+    offsets [list]: (dx, dy) neighbour offsets
+
+    Returns:
+    found [numpy.ndarray]: bool (len(offsets), dies), a die exists at the offset
+    good [numpy.ndarray]: bool (len(offsets), dies), the die at the offset passed
+    """
+    margin = max(max(abs(dx), abs(dy)) for dx, dy in offsets)
+    cells, (width, height), dense, unique_cells, first = _rasterize(x, y, margin)
+
+    found = np.empty((len(offsets), len(x)), dtype=bool)
+    good = np.empty((len(offsets), len(x)), dtype=bool)
+    if dense:
+        occupied = np.zeros(width * height, dtype=bool)
+        passed = np.zeros(width * height, dtype=bool)
+        occupied[unique_cells] = True
+        passed[unique_cells] = passing[first]
+        for i, (dx, dy) in enumerate(offsets):
+            neighbors = cells + (dx * height + dy)
+            found[i] = occupied[neighbors]
+            good[i] = passed[neighbors]
+    else:
+        passed = passing[first]
+        for i, (dx, dy) in enumerate(offsets):
+            neighbors = cells + (dx * height + dy)
+            index = np.minimum(np.searchsorted(unique_cells, neighbors), len(unique_cells) - 1)
+            found[i] = unique_cells[index] == neighbors
+            good[i] = found[i] & passed[index]
+    return found, good
+
+
+def neighbor_convolve(x, y, passing, kernel):
+    """
+    Counterpart of neighbor_lookup for large kernels: the grids of occupied and passing
+    cells are convolved with the kernel using FFTs, so the cost depends on the size of
+    the grid and not on the number of neighbours. Sums are exact up to float round-off,
+    counts are rounded back to integers.
+
+    Args:
+    x, y [numpy.ndarray]: DieX and DieY of every die
+    passing [numpy.ndarray]: bool, die passed
+    kernel [numpy.ndarray]: (2r+1, 2r+1) neighbour weights indexed [dx + r, dy + r], 0 outside the neighbourhood
+
+    Returns:
+    found [numpy.ndarray]: neighbours of every die
+    good [numpy.ndarray]: passing neighbours of every die
+    local_yield [numpy.ndarray]: sum of the weights of the passing neighbours
+    None when the dies are too sparse for a grid
+    """
+    cells, shape, dense, unique_cells, first = _rasterize(x, y, kernel.shape[0] // 2)
+    if not dense:
+        return None
+    occupied = np.zeros(shape[0] * shape[1])
+    passed = np.zeros(shape[0] * shape[1])
+    occupied[unique_cells] = 1.0
+    passed[unique_cells] = passing[first]
+    occupied, passed = occupied.reshape(shape), passed.reshape(shape)
+
+    # A convolution flips the kernel, flipping it first sums each die's neighbours
+    kernel = kernel[::-1, ::-1]
+    mask = (kernel != 0).astype(float)
+    found = np.rint(fftconvolve(occupied, mask, mode='same').ravel()[cells]).astype(np.int64)
+    good = np.rint(fftconvolve(passed, mask, mode='same').ravel()[cells]).astype(np.int64)
+    local_yield = fftconvolve(passed, kernel, mode='same').ravel()[cells]
+    # No passing neighbour is exactly 0, not round-off
+    return found, good, np.where(good > 0, local_yield, 0.0)
+
+
+def check_detector(kernel='rbf', nu=0.06):
+    """
+    Raise a ValueError naming the problem when the detector selected by kernel cannot be fit with nu.
+    """
+    if kernel not in KERNELS:
+        raise ValueError(f"Unknown kernel {kernel!r}, expected one of {KERNELS}")
+    if not 0 < nu <= 1:
+        raise ValueError(f"nu must be in (0, 1], got {nu}")
+    if kernel == 'iforest' and nu > 0.5:
+        raise ValueError(f"nu must be at most 0.5 with 'iforest', an IsolationForest flags at most half of the dies (got {nu})")
+
+
+def make_detector(kernel='rbf', gamma=1.0, nu=0.06, samples=None):
+    """
+    Create the anomaly detector selected by kernel. OCSVM_KERNELS give the exact One-Class SVM,
+    whose fit grows quadratically or worse with the training dies. The approximate detectors
+    grow linearly, for very large or pooled training sets:
+    'nystroem' maps the features on NYSTROEM_COMPONENTS landmarks of the rbf kernel and fits a
+    linear One-Class SVM by SGD, 'iforest' is an IsolationForest flagging a fraction nu (at most 0.5)
+    of the dies. Invalid combinations raise ValueError, see check_detector.
+
+    Args:
+    kernel [string]: one of KERNELS
+    gamma [float]: rbf kernel coefficient, unused by 'iforest' and 'linear'
+    nu [float]: fraction of training dies flagged as outliers
+    samples [int]: training dies, caps the Nystroem landmarks
+
+    Returns:
+    detector: scikit-learn estimator with fit and predict, predicting -1 for outliers
+    """
+    check_detector(kernel, nu)
+    if kernel == 'nystroem':
+        components = NYSTROEM_COMPONENTS if samples is None else max(1, min(NYSTROEM_COMPONENTS, samples))
+        return make_pipeline(Nystroem(kernel='rbf', gamma=gamma, n_components=components, random_state=0),
+                             SGDOneClassSVM(nu=nu, random_state=0))
+    if kernel == 'iforest':
+        return IsolationForest(contamination=nu, random_state=0)
+    return OneClassSVM(kernel=kernel, gamma=gamma, nu=nu)
 
 class die_level_prediction:
     def __init__(self, db_name, mid, kernel='rbf', gamma='scale', nu=0.06):
@@ -19,6 +227,7 @@ class die_level_prediction:
         self.die_data_df = None
         self.scaled_data_df = None
         self.model = None
+        self.neighborhood_size = len(NEIGHBORHOOD_8)
         self.figures_list = []
         self.count_df = pd.DataFrame({
                 'MasterID': [0],
@@ -32,17 +241,18 @@ class die_level_prediction:
 
     def connect_to_db(self):
         """
-        Connect to the database
+        Connect to the database holding the wafer, its shard when the database is sharded
         """
-        self._conn = sqlite3.connect(self.db_name)
-        self._cursor = self.conn.cursor()
+        self.conn = sqlite3.connect(ShardRouter.get_router(self.db_name).path(self.mid))
+        self.cursor = self.conn.cursor()
+        Schema.migrate(self.conn)
 
     def load_data_from_db(self):
             """
             Load data from the database using the provided query.
             """
             # Read die data from db as a dataframe 
-            self.die_data_df = pd.read_sql('SELECT * FROM die_info WHERE MasterID = ?', self.conn, params=(self.mid,))
+            self.die_data_df = pd.read_sql('SELECT MasterID, DieID, DieX, DieY, SiteNum, HardwareBin, SoftwareBin, PartFlg, Passing FROM die_info WHERE MasterID = ?', self.conn, params=(self.mid,))
             
             # Fetch wafer center coordinates
             result = self.cursor.execute('SELECT CenterX, CenterY FROM wafer_config WHERE MasterID = ?',  (self.mid,))
@@ -51,11 +261,44 @@ class die_level_prediction:
             # Fetch die dimensions from db
             result = self.cursor.execute('SELECT DieWidth, DieHeight FROM wafer_config WHERE MasterID = ?',  (self.mid,))
             self.die_dim = result.fetchall()[0]
-        
+
+            self.store_counts()
+
+    def load_data_from_store(self, store, wafer_config):
+            """
+            Load data directly from a DieInfo.DieStore filled by the parser, without a database round trip.
+
+            Args:
+            store [DieStore]: dies of the wafer
+            wafer_config [tuple]: WCR values as put in the record queue
+                                  (WaferSize, DieHeight, DieWidth, WaferFlat, CenterX, CenterY, PositiveX, PositiveY)
+            """
+            dies = store.dies
+            self.die_data_df = pd.DataFrame({
+                'MasterID': self.mid,
+                'DieID': dies['DieID'],
+                'DieX': dies['DieX'],
+                'DieY': dies['DieY'],
+                'SiteNum': dies['SiteNum'],
+                'HardwareBin': dies['HardwareBin'],
+                'SoftwareBin': dies['SoftwareBin'],
+                'PartFlg': dies['PartFlg'],
+                'Passing': dies['Passing'],
+            }).astype('int64')
+            self.centers = (wafer_config[4], wafer_config[5])
+            self.die_dim = (wafer_config[2], wafer_config[1])
+
+            self.store_counts()
+
+    def store_counts(self):
+            """
+            Store die counts before prediction.
+            """
             # Storing count values
-            self.count_df['MasterID','die_count'] = self.mid,self.die_data_df['Passing'].count()
-            self.count_df['bad_die_count_before']  = self.die_data_df[self.die_data_df['Passing'] == 0].count()
-            self.count_df['good_die_count_before'] = self.die_data_df[self.die_data_df['Passing'] == 1].count()
+            self.count_df['MasterID'] = self.mid
+            self.count_df['die_count'] = self.die_data_df['Passing'].count()
+            self.count_df['bad_die_count_before']  = (self.die_data_df['Passing'] == 0).sum()
+            self.count_df['good_die_count_before'] = (self.die_data_df['Passing'] == 1).sum()
 
     def calculate_effect_probability(self):
         """
@@ -147,16 +390,152 @@ class die_level_prediction:
                 self.die_data_df.at[index, 'edge'] = (neighbors < 8)
                 self.die_data_df.at[index, 'bad_neighbor'] = bad_neighbors
 
-    def train_ocsvm(self):
+    def neighborhood_kernel(self, neighborhood=1):
         """
-        Train One-Class SVM model.
+        Offsets and weights of the neighbours of a die.
+
+        Args:
+        neighborhood [int or numpy.ndarray]: radius of a square neighbourhood, 1 for the 8 neighbours of
+                                             calculate_local_yield_8, 2 for 5x5 and 3 for 7x7, or a custom
+                                             (2r+1, 2r+1) kernel indexed [dx + r, dy + r]: bool to select
+                                             neighbours weighted by distance, numbers to give their weights
+
+        Returns:
+        offsets [list]: (dx, dy) of the neighbours
+        weights [numpy.ndarray]: weight of each neighbour
+        """
+        if isinstance(neighborhood, (int, np.integer)):
+            if neighborhood < 1:
+                raise ValueError("Neighbourhood radius must be at least 1.")
+            if neighborhood == 1:
+                # The reference weights, for values identical to calculate_local_yield_8
+                return NEIGHBORHOOD_8, np.array(self.calculate_effect_probability())
+            kernel = square_kernel(neighborhood)
+        else:
+            kernel = np.asarray(neighborhood)
+            if kernel.ndim != 2 or kernel.shape[0] != kernel.shape[1] or kernel.shape[0] % 2 == 0:
+                raise ValueError("Neighbourhood kernels must be square with an odd size.")
+
+        offsets = neighborhood_offsets(kernel)
+        if not offsets:
+            raise ValueError("Neighbourhood kernel has no neighbour.")
+        if kernel.dtype == bool:
+            return offsets, distance_weights(offsets, self.die_dim)
+        radius = kernel.shape[0] // 2
+        return offsets, np.array([kernel[dx + radius, dy + radius] for dx, dy in offsets], dtype=float)
+
+    def calculate_neighborhood_features(self, neighborhood=1, method='auto'):
+        """
+        Calculate the local yield, good and bad neighbours and edge flag of every die over a
+        neighbourhood of any size, in one pass over all dies. Radius 1 gives the columns and
+        values of calculate_local_yield_8; larger ones flag a die as edge when any of its
+        neighbours is missing.
+
+        Args:
+        neighborhood [int or numpy.ndarray]: radius or kernel, see neighborhood_kernel
+        method [string]: 'direct' reads each neighbour with neighbor_lookup, 'fft' convolves the grid
+                         with neighbor_convolve, 'auto' convolves from FFT_MIN_NEIGHBORS neighbours
+        """
+        if method not in ('auto', 'direct', 'fft'):
+            raise ValueError(f"Unknown method {method!r}, expected 'auto', 'direct' or 'fft'.")
+        x = self.die_data_df['DieX'].to_numpy(dtype=np.int64)
+        y = self.die_data_df['DieY'].to_numpy(dtype=np.int64)
+        offsets, weights = self.neighborhood_kernel(neighborhood)
+        self.neighborhood_size = len(offsets)
+        if len(x) == 0:
+            return self.calculate_local_yield_8()
+        passing = self.die_data_df['Passing'].to_numpy() == 1
+
+        convolved = None
+        if method == 'fft' or (method == 'auto' and len(offsets) >= FFT_MIN_NEIGHBORS):
+            radius = max(max(abs(dx), abs(dy)) for dx, dy in offsets)
+            kernel = np.zeros((2 * radius + 1, 2 * radius + 1))
+            for (dx, dy), weight in zip(offsets, weights):
+                kernel[dx + radius, dy + radius] = weight
+            convolved = neighbor_convolve(x, y, passing, kernel)
+
+        if convolved is not None:
+            found, good, local_yield = convolved
+        else:
+            found, good = neighbor_lookup(x, y, passing, offsets)
+
+            # Weights are added neighbour by neighbour, in the reference order, for identical sums
+            local_yield = np.zeros(len(x))
+            for i, weight in enumerate(weights):
+                local_yield = local_yield + np.where(good[i], weight, 0.0)
+            found, good = found.sum(axis=0), good.sum(axis=0)
+
+        self.die_data_df['Visited'] = True
+        self.die_data_df['distance_from_center'] = np.sqrt((x - self.centers[0]) ** 2 + (y - self.centers[1]) ** 2)
+        self.die_data_df['edge'] = found < len(offsets)
+        self.die_data_df['local_yield'] = local_yield
+        self.die_data_df['good_neighbor'] = good
+        self.die_data_df['bad_neighbor'] = found - good
+
+    def calculate_local_yield_grid(self):
+        """
+        Vectorized calculate_local_yield_8, same columns and values: the neighbours of
+        every die are found at once with neighbor_lookup instead of scanning the
+        dataframe for each neighbour of each die.
+        """
+        self.calculate_neighborhood_features(1, method='direct')
+
+    def verify_local_yield(self):
+        """
+        Compare calculate_local_yield_grid with the reference calculate_local_yield_8 on
+        copies of the loaded dies.
+
+        Returns:
+        mismatches [list]: columns whose values or dtypes differ, empty when identical
+        """
+        dies = self.die_data_df
+        try:
+            self.die_data_df = dies.copy()
+            self.calculate_local_yield_8()
+            reference = self.die_data_df
+            self.die_data_df = dies.copy()
+            self.calculate_local_yield_grid()
+            result = self.die_data_df
+        finally:
+            self.die_data_df = dies
+        return [column for column in reference.columns if column not in result or not reference[column].equals(result[column])]
+
+    def train_ocsvm(self, deduplicate=True):
+        """
+        Train One-Class SVM model, or the approximate detector selected by kernel (see make_detector).
+
+        The features take few distinct values, a count of bad neighbours and a sum of a few
+        fixed weights, so by default the One-Class SVM is fit once per distinct feature vector
+        with its number of dies as sample weight: the same optimization problem as fitting
+        every die, at a cost that no longer grows with the die count. The approximate detectors
+        fit every die, their SGD steps and outlier threshold count dies, not weights.
+
+        Args:
+        deduplicate [bool]: fit the distinct feature vectors with sample weights instead of every die
         """
         # Extract the features to train the model     
-        self.features = self.die_data_df.loc[(self.die_data_df['edge'] == False) & (self.die_data_df.bad_neighbor.between(2,8)),['bad_neighbor','local_yield']]
-        
+        self.features = self.die_data_df.loc[(self.die_data_df['edge'] == False) & (self.die_data_df.bad_neighbor.between(2, self.neighborhood_size)),['bad_neighbor','local_yield']]
+        values = self.features.to_numpy(dtype=float)
+
+        # gamma='scale' depends on the variance of all the dies, not of the distinct vectors
+        gamma = self.gamma
+        if gamma == 'scale' and len(values):
+            variance = values.var()
+            gamma = 1.0 / (values.shape[1] * variance) if variance != 0 else 1.0
+        elif gamma == 'auto':
+            gamma = 1.0 / values.shape[1]
+
+        # Distinct feature vectors, predictions are mapped back to their dies
+        self.unique_features, self.feature_inverse, counts = np.unique(values, axis=0, return_inverse=True, return_counts=True)
+        self.feature_inverse = self.feature_inverse.ravel()
+
         # Initialize and fit the One-Class SVM model
-        self.model = OneClassSVM(kernel = self.kernel, gamma = self.gamma, nu = self.nu )
-        self.model.fit(self.features)
+        self.model = make_detector(self.kernel, gamma, self.nu, len(values))
+        if deduplicate and self.kernel in OCSVM_KERNELS:
+            self.model.set_params(tol=DEDUPLICATED_TOL)
+            self.model.fit(self.unique_features, sample_weight=counts)
+        else:
+            self.model.fit(values)
 
     def predict(self):
         """
@@ -169,8 +548,8 @@ class die_level_prediction:
         if self.model is None:
             raise ValueError("Model must be trained before making predictions.")
 
-        # Predict using the trained model
-        predictions = self.model.predict(self.features)
+        # Predict the distinct feature vectors, then map them back to their dies
+        predictions = self.model.predict(self.unique_features)[self.feature_inverse]
         
         # Find outliers
         outliers_index = np.where(predictions == -1)[0]
@@ -233,28 +612,40 @@ class die_level_prediction:
         plt.close()
         self.figures_list.append(buf)
 
-    def load_vis_data(self, table_name):
+    def load_vis_data(self, table_name, source=None):
             """
             This function loads data after prediction to the database.
             
             Ards: table_name
+            source [string]: ModelCache key of the run the rows come from, None when uncached
             """
             # Drop some columns before inserting into the database
-            self.die_data_df.drop(['edge', 'bad_neighbor'], axis=1, inplace=True)
+            self.die_data_df.drop(['edge', 'bad_neighbor'], axis=1, inplace=True, errors='ignore')
 
-            # Insert DataFrame into SQL table
-            self.die_data_df.to_sql(table_name, self.conn, if_exists='replace', index=False)
+            # Replace this wafer's rows only, the table and its indexes are kept for the other wafers
+            self.cursor.execute(f'DELETE FROM {table_name} WHERE MasterID = ?', (self.mid,))
+            self.die_data_df.to_sql(table_name, self.conn, if_exists='append', index=False)
+            self.cursor.execute('INSERT OR REPLACE INTO vis_data_source (TableName, MasterID, Source) VALUES (?, ?, ?)', (table_name, self.mid, source))
+            self.conn.commit()
         
 
-def main(db_name, mid, kernel='rbf', gamma='scale', nu=0.06):
-    
+def main(db_name, mid, kernel='rbf', gamma='scale', nu=0.06, store=None, wafer_config=None, neighborhood=1):
+    """
+    Args:
+    store [DieStore]: optional dies of the wafer straight from the parser, used instead of reading die_info
+    wafer_config [tuple]: WCR values of the wafer, required with store
+    neighborhood [int or numpy.ndarray]: radius or kernel of the neighbourhood, see die_level_prediction.neighborhood_kernel
+    """
     anomaly_detector = die_level_prediction(db_name, mid, kernel= kernel, gamma= gamma, nu= nu)
 
-    # Load data from the database
-    anomaly_detector.load_data_from_db()
+    # Load data from the parser's die store or from the database
+    if store is not None:
+        anomaly_detector.load_data_from_store(store, wafer_config)
+    else:
+        anomaly_detector.load_data_from_db()
     
     # Calculate local yield for each die
-    anomaly_detector.calculate_local_yield_8()
+    anomaly_detector.calculate_neighborhood_features(neighborhood)
 
     # Train the OCSVM model
     anomaly_detector.train_ocsvm()
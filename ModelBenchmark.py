@@ -0,0 +1,142 @@
+"""
+
+ModelBenchmark compares the anomaly detectors of Model (see make_detector)
+on wafers of growing size: fit and predict time of each detector and the
+share of training dies it classifies like the exact One-Class SVM.
+
+Wafers are synthetic round wafers with clustered and random failures,
+written to a temporary database, or existing wafers of a database.
+
+Usage:
+    python ModelBenchmark.py --sizes 1000 10000 100000
+    python ModelBenchmark.py --database database.db --mids 4 5 --kernels rbf nystroem iforest
+
+"""
+import os
+import sys
+import time
+import shutil
+import sqlite3
+import argparse
+import tempfile
+
+import numpy as np
+
+import Model
+import Schema
+
+# Detector compared against, and its fit on every die instead of the distinct feature vectors
+REFERENCE = 'rbf'
+PER_DIE = 'rbf per die'
+
+
+def synthetic_wafer(conn, dies, rng, lot_id='BENCH'):
+    """
+    Write a round wafer of about the given number of dies, with a few failing clusters
+    and scattered failures.
+
+    Returns:
+    mid [int]: MasterID of the wafer
+    """
+    radius = int(np.sqrt(dies / np.pi)) + 1
+    x, y = np.meshgrid(np.arange(-radius, radius + 1), np.arange(-radius, radius + 1))
+    on_wafer = x ** 2 + y ** 2 <= radius ** 2
+    x, y = x[on_wafer], y[on_wafer]
+
+    # Clusters fail densely at their centre, thinning out to their radius
+    failing = rng.random(len(x)) < 0.05
+    for cx, cy in rng.integers(-radius, radius + 1, (max(1, len(x) // 2000), 2)):
+        failing |= (x - cx) ** 2 + (y - cy) ** 2 <= rng.integers(2, 6) ** 2 * rng.random(len(x))
+
+    mid = conn.execute("INSERT INTO wafer_info (LotID, WaferID) VALUES (?, ?)", (lot_id, str(dies))).lastrowid
+    conn.execute("INSERT INTO wafer_config (MasterID, WaferSize, DieHeight, DieWidth, WaferFlat, CenterX, CenterY, PositiveX, PositiveY) VALUES (?, 300, 4, 5, 'D', 0, 0, 'R', 'U')", (mid,))
+    conn.executemany("INSERT INTO die_info (MasterID, DieID, DieX, DieY, SiteNum, HardwareBin, SoftwareBin, PartFlg, Passing) VALUES (?, ?, ?, ?, 1, ?, ?, 0, ?)",
+                     ((mid, i, int(x[i]), int(y[i]), 2 if failing[i] else 1, 2 if failing[i] else 1, 0 if failing[i] else 1) for i in range(len(x))))
+    conn.commit()
+    return mid
+
+
+def benchmark(db_name, mid, kernels, gamma='scale', nu=0.06, neighborhood=1, full_fit_max=20000):
+    """
+    Fit and predict every detector on a wafer.
+
+    Args:
+    kernels [list]: Model.KERNELS to compare, PER_DIE for the exact One-Class SVM fit on every die
+    full_fit_max [int]: dies above which PER_DIE is skipped, its fit time grows quadratically or worse
+
+    Returns:
+    results [list]: dict per detector: kernel, dies, training dies, fit and predict seconds,
+                    outliers and agreement with REFERENCE
+    """
+    detector = Model.die_level_prediction(db_name, mid, gamma=gamma, nu=nu)
+    detector.load_data_from_db()
+    detector.calculate_neighborhood_features(neighborhood)
+    dies = detector.die_data_df
+
+    results = []
+    reference = None
+    for kernel in [REFERENCE] + [kernel for kernel in kernels if kernel != REFERENCE]:
+        if kernel == PER_DIE and len(dies) > full_fit_max:
+            continue
+        detector.kernel = REFERENCE if kernel == PER_DIE else kernel
+        detector.die_data_df = dies.copy()
+        start = time.perf_counter()
+        detector.train_ocsvm(deduplicate=kernel != PER_DIE)
+        fit = time.perf_counter() - start
+        start = time.perf_counter()
+        predictions, outliers = detector.predict()
+        predict = time.perf_counter() - start
+
+        if reference is None:
+            reference = predictions
+        if kernel in kernels:
+            results.append({'kernel': kernel, 'dies': len(dies), 'training': len(detector.features), 'fit': fit,
+                            'predict': predict, 'outliers': len(outliers), 'agreement': float(np.mean(predictions == reference))})
+    detector.conn.close()
+    return results
+
+
+def _report(results):
+    print(f"{'kernel':<12} {'dies':>8} {'training':>9} {'fit s':>9} {'predict s':>10} {'outliers':>9} {'agreement':>10}")
+    for result in results:
+        print(f"{result['kernel']:<12} {result['dies']:>8} {result['training']:>9} {result['fit']:>9.3f} {result['predict']:>10.3f} "
+              f"{result['outliers']:>9} {result['agreement']:>10.2%}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the anomaly detectors of Model across wafer sizes")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000], help="dies of the synthetic wafers")
+    parser.add_argument("--database", default=None, help="benchmark existing wafers of this database instead")
+    parser.add_argument("--mids", type=int, nargs="+", default=[], help="MasterIDs of the wafers, with --database")
+    parser.add_argument("--kernels", nargs="+", default=[REFERENCE, PER_DIE] + list(Model.APPROXIMATE_DETECTORS),
+                        choices=list(Model.KERNELS) + [PER_DIE])
+    parser.add_argument("--gamma", default='scale', help="'scale', 'auto' or a number")
+    parser.add_argument("--nu", type=float, default=0.06)
+    parser.add_argument("--neighborhood", type=int, default=1, help="neighbourhood radius of the features")
+    parser.add_argument("--full-fit-max", type=int, default=20000, help="largest wafer fit die by die")
+    args = parser.parse_args()
+    gamma = args.gamma if args.gamma in ('scale', 'auto') else float(args.gamma)
+
+    directory = None
+    if args.database:
+        db_name, mids = args.database, args.mids
+        if not mids:
+            print("--mids is required with --database")
+            sys.exit(1)
+    else:
+        directory = tempfile.mkdtemp(prefix="model_benchmark_")
+        db_name = os.path.join(directory, "benchmark.db")
+        conn = sqlite3.connect(db_name)
+        Schema.migrate(conn)
+        rng = np.random.default_rng(0)
+        mids = [synthetic_wafer(conn, size, rng) for size in args.sizes]
+        conn.close()
+
+    try:
+        for mid in mids:
+            _report(benchmark(db_name, mid, args.kernels, gamma=gamma, nu=args.nu, neighborhood=args.neighborhood,
+                              full_fit_max=args.full_fit_max))
+            print()
+    finally:
+        if directory:
+            shutil.rmtree(directory, ignore_errors=True)
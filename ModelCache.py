@@ -0,0 +1,228 @@
+"""
+
+ModelCache keeps the results of die level predictions so asking again for a
+wafer and parameter set already predicted returns at once: only the wafer's
+rows are read to check their version, its features are not computed again,
+the detector is not refit and the figures are not redrawn.
+
+A prediction is keyed by the wafer's MasterID, the version of its data (a
+hash of the die_info and wafer_config rows the model reads, so reloading or
+merging a retest invalidates it), the neighbourhood of the features and the
+kernel, gamma and nu of the detector. Entries hold the fitted detector, its
+predictions, the counts and figures Model.main returns and the rows written
+to temporary_data for the wafer map.
+
+Entries live in an in-memory LRU bounded by their pickled size and, with
+disk_store, in <database>.models/ next to the database, bounded the same way
+with the least recently used files removed first, so they survive restarts.
+
+Usage:
+    cache = ModelCache(disk_store=True)
+    outliers, count_df, figures = cache.main("database.db", 4, kernel='rbf', gamma='scale', nu=0.06)
+
+"""
+import io
+import os
+import json
+import pickle
+import hashlib
+import threading
+import contextlib
+import collections
+
+import numpy as np
+import sklearn
+
+import Model
+
+# Bumped when the entries or the prediction pipeline change, orphaning older disk entries
+CACHE_FORMAT = 1
+
+MAX_MEMORY_BYTES = 256 << 20
+MAX_DISK_BYTES = 1 << 30
+
+
+def data_version(cursor, mid):
+    """
+    Returns a hash of the die_info and wafer_config rows the model reads for a wafer.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(repr(cursor.execute('SELECT CenterX, CenterY, DieWidth, DieHeight FROM wafer_config WHERE MasterID = ?', (mid,)).fetchall()).encode())
+    rows = cursor.execute('SELECT DieID, DieX, DieY, SiteNum, HardwareBin, SoftwareBin, PartFlg, Passing FROM die_info WHERE MasterID = ? ORDER BY DieID', (mid,)).fetchall()
+    digest.update(pickle.dumps(rows, protocol=4))
+    return digest.hexdigest()
+
+
+def cache_key(mid, version, neighborhood=1, kernel='rbf', gamma='scale', nu=0.06):
+    """
+    Returns the key of a prediction, a hex digest of everything its result depends on.
+    """
+    if isinstance(neighborhood, (int, np.integer)):
+        features = int(neighborhood)
+    else:
+        kernel_array = np.ascontiguousarray(neighborhood)
+        features = [kernel_array.dtype.str, kernel_array.shape, hashlib.blake2b(kernel_array.tobytes(), digest_size=16).hexdigest()]
+    parts = [CACHE_FORMAT, sklearn.__version__, mid, version, features, kernel, gamma, nu]
+    return hashlib.blake2b(json.dumps(parts).encode(), digest_size=16).hexdigest()
+
+
+class CachedPrediction:
+    """
+    Result of a die level prediction.
+
+    Attributes:
+    model: fitted detector
+    predictions [numpy.ndarray]: 1 or -1 for every training die
+    outliers [DataFrame]: features of the training dies predicted as outliers
+    num_outliers [int]
+    count_df [DataFrame]: die counts before and after prediction
+    figure_bytes [list]: PNG figures of Model.visualize
+    vis_data [DataFrame]: rows written to temporary_data
+    """
+    def __init__(self, model, predictions, outliers, count_df, figure_bytes, vis_data):
+        self.model = model
+        self.predictions = predictions
+        self.outliers = outliers
+        self.num_outliers = len(outliers)
+        self.count_df = count_df
+        self.figure_bytes = figure_bytes
+        self.vis_data = vis_data
+
+    @property
+    def figures_list(self):
+        """ Fresh in-memory buffers of the figures, as Model.main returns them. """
+        return [io.BytesIO(figure) for figure in self.figure_bytes]
+
+
+class ModelCache:
+    def __init__(self, max_bytes=MAX_MEMORY_BYTES, disk_store=False, max_disk_bytes=MAX_DISK_BYTES):
+        """
+        Args:
+        max_bytes [int]: pickled size of the entries kept in memory
+        disk_store [bool]: also keep entries in <database>.models/
+        max_disk_bytes [int]: size of the files kept in each <database>.models/
+        """
+        self._max_bytes = max_bytes
+        self._disk_store = disk_store
+        self._max_disk_bytes = max_disk_bytes
+        self._entries = collections.OrderedDict()  # (database, key) -> (entry, size), least recently used first
+        self._size = 0
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _directory(db_name):
+        return os.path.splitext(os.path.abspath(db_name))[0] + ".models"
+
+    def _get(self, db_name, key):
+        db_name = os.path.abspath(db_name)
+        with self._lock:
+            cached = self._entries.get((db_name, key))
+            if cached:
+                self._entries.move_to_end((db_name, key))
+                return cached[0]
+        if not self._disk_store:
+            return None
+        path = os.path.join(self._directory(db_name), key + ".pkl")
+        try:
+            with open(path, "rb") as f:
+                blob = f.read()
+            entry = pickle.loads(blob)
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+            return None
+        os.utime(path)
+        self._remember(db_name, key, entry, len(blob))
+        return entry
+
+    def _remember(self, db_name, key, entry, size):
+        """ Put an entry in the memory LRU, evicting the least recently used ones beyond max_bytes. """
+        if size > self._max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop((db_name, key), None)
+            if previous:
+                self._size -= previous[1]
+            self._entries[(db_name, key)] = (entry, size)
+            self._size += size
+            while self._size > self._max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._size -= evicted
+
+    def _put(self, db_name, key, entry):
+        blob = pickle.dumps(entry, protocol=pickle.HIGHEST_PROTOCOL)
+        self._remember(os.path.abspath(db_name), key, entry, len(blob))
+        if not self._disk_store or len(blob) > self._max_disk_bytes:
+            return
+        directory = self._directory(db_name)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, key + ".pkl")
+        with open(path + ".tmp", "wb") as f:
+            f.write(blob)
+        os.replace(path + ".tmp", path)
+
+        # Remove the least recently used files beyond max_disk_bytes
+        files = []
+        for name in os.listdir(directory):
+            if name.endswith(".pkl"):
+                stat = os.stat(os.path.join(directory, name))
+                files.append((stat.st_mtime_ns, stat.st_size, name))
+        total = sum(size for _, size, _ in files)
+        for _, size, name in sorted(files):
+            if total <= self._max_disk_bytes:
+                break
+            with contextlib.suppress(OSError):
+                os.remove(os.path.join(directory, name))
+            total -= size
+
+    def predict(self, db_name, mid, kernel='rbf', gamma='scale', nu=0.06, neighborhood=1):
+        """
+        Predict a wafer like Model.main, or return the cached prediction. Either way
+        temporary_data holds the wafer's rows of this prediction afterwards.
+
+        Returns:
+        prediction [CachedPrediction]
+        """
+        detector = Model.die_level_prediction(db_name, mid, kernel=kernel, gamma=gamma, nu=nu)
+        try:
+            key = cache_key(mid, data_version(detector.cursor, mid), neighborhood, kernel, gamma, nu)
+            entry = self._get(db_name, key)
+            if entry is None:
+                self.misses += 1
+                detector.load_data_from_db()
+                detector.calculate_neighborhood_features(neighborhood)
+                detector.train_ocsvm()
+                predictions, outliers = detector.predict()
+                detector.visualize()
+                detector.load_vis_data('temporary_data', source=key)
+                entry = CachedPrediction(detector.model, predictions, outliers, detector.count_df,
+                                         [figure.getvalue() for figure in detector.figures_list], detector.die_data_df)
+                self._put(db_name, key, entry)
+            else:
+                self.hits += 1
+                # Rewrite the wafer's map rows only when another prediction replaced them
+                source = detector.cursor.execute("SELECT Source FROM vis_data_source WHERE TableName = 'temporary_data' AND MasterID = ?", (mid,)).fetchone()
+                if not source or source[0] != key:
+                    detector.die_data_df = entry.vis_data.copy()
+                    detector.load_vis_data('temporary_data', source=key)
+            return entry
+        finally:
+            detector.conn.close()
+
+    def main(self, db_name, mid, kernel='rbf', gamma='scale', nu=0.06, neighborhood=1):
+        """
+        Drop-in for Model.main.
+
+        Returns:
+        num_outliers [int]
+        count_df [DataFrame]
+        figures_list [list]: io.BytesIO PNG figures
+        """
+        entry = self.predict(db_name, mid, kernel=kernel, gamma=gamma, nu=nu, neighborhood=neighborhood)
+        return entry.num_outliers, entry.count_df.copy(), entry.figures_list
+
+    def clear(self):
+        """ Empty the memory LRU, disk entries are kept. """
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
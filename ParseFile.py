@@ -1,24 +1,74 @@
+import os
 import time
+import mmap
+import queue
 import struct
 import logging
 import datetime
 
-from DieInfo import DieInfo
+from DieInfo import DieInfo, DieStore
 
 
 class ParseFile():
     # Class variable _instance will keep track of the single object instance
     _instance = None
 
-    def __init__(self, file_name, record_queue):
+    # Records of interest keyed by (REC_TYP, REC_SUB): (record name, extraction method)
+    # Any record not listed here is skipped without being decoded
+    RECORD_TABLE = {
+        (0, 10): ("FAR", None),             # Beggining of STDF file, contains no significant information
+        (1, 10): ("MIR", "extract_data"),   # Lot ID
+        (2, 10): ("WIR", "extract_data"),   # Wafer ID
+        (2, 30): ("WCR", "extract_data"),   # Wafer configuration
+        (2, 20): ("WRR", "extract_wrr"),    # End of wafer
+        (5, 10): ("PIR", "extract_pir"),    # Site number of each die
+        (15, 10): ("PTR", "extract_ptr"),   # Parametric test results
+        (5, 20): ("PRR", "extract_prr"),    # Die results, appears after PTR records
+        (1, 20): ("MRR", "extract_mrr"),    # End of file
+    }
+
+    # Supported record scanners
+    SCANNERS = ("stream", "mmap")
+
+    # Decompressed bytes read at once from compressed files
+    CHUNK_SIZE = 1 << 23
+
+    def __init__(self, file_name, record_queue, scanner="stream", ptr_batch=False, codec=None, skip_ptr=False, test_filter=None, die_store=False,
+                 follow=False, poll_interval=1.0, follow_timeout=60.0, checkpoint_bytes=None, resume=None):
         super().__init__()
+        if scanner not in self.SCANNERS:
+            raise ValueError(f"Unknown scanner '{scanner}', expected one of {self.SCANNERS}")
         self.record_queue = record_queue
         self._file_name = file_name
+        self._scanner = scanner
+        self._codec = codec # (codec name, opener) of compressed files, see Parser.detect_codec
         self.record_sub_type = self.record_type = 0
         self.record = bytearray()  # Faster processing
         self.logger = logging.getLogger(__name__)
         self.sites = {}
+        self._wafer_config = None # Set by WCR, which is optional
         self.dies_counter = 0 # Acts as PartID or DieID
+        self._store = DieStore() if die_store else None # Fill a wafer-scoped DieStore instead of queuing DieInfo objects
+        self._ptr_batch = ptr_batch or die_store # Gather PTR bodies per die and decode them as NumPy columns
+        self._skip_ptr = skip_ptr # Seek past PTR bodies without decoding them (bin maps only)
+        self._test_filter = frozenset(test_filter) if test_filter is not None else None # Allow-list of test numbers
+        self._follow = follow # Keep reading a file that is still being written, see _read_follow
+        self._poll_interval = poll_interval
+        self._follow_timeout = follow_timeout
+        self.finished = False # Set by MRR
+        self._checkpoint_bytes = checkpoint_bytes # Emit a resumable checkpoint about every this many bytes
+        self._resume = resume # Checkpoint state to resume from, see checkpoint()
+        self._context = {} # Latest MIR, WCR and WIR bodies, replayed on resume
+
+        # Bind the dispatch table once: (REC_TYP, REC_SUB) -> (record name, bound method or None)
+        self._handlers = {key: (name, getattr(self, method) if method else None)
+                          for key, (name, method) in self.RECORD_TABLE.items()}
+        if self._ptr_batch:
+            self._handlers[(15, 10)] = ("PTR", self.collect_ptr)
+        self._extract_ptr = self._handlers[(15, 10)][1]
+        if skip_ptr:
+            # Unknown records are skipped by the scanners using the record length only
+            del self._handlers[(15, 10)]
         logging.basicConfig(level=logging.DEBUG, filename='logs\waferMap.log')
     
     # Extract part information record
@@ -50,18 +100,27 @@ class ParseFile():
 
         # Store results within DieInfo objects from inside the dictionary
         self.sites[site_num].set_info((HARD_Bin, SOFT_Bin, X_COORD, Y_COORD, PART_FLG, PassFail))
+
+        # Decode PTR bodies gathered for this die in one pass
+        if self._ptr_batch:
+            self.sites[site_num].decode_ptr_records()
         
-        # Put data into record_queue
-        self.record_queue.put(("die_info", self.sites[site_num]))
-        
-        # Free memory
-        del self.sites[site_num]
+        # Put data into record_queue, or append it to the die store
+        die = self.sites.pop(site_num)
+        if self._store is not None:
+            self._store.add_die(die.get_number(), site_num, die.get_info(), die.get_test_results())
+        else:
+            self.record_queue.put(("die_info", die))
 
     # Extract parametric test results
     def extract_ptr(self):
         # Extract test_num   U*4
         test_num = int.from_bytes(self.record[0:4], byteorder='little', signed=False)
 
+        # Drop tests outside the allow-list before decoding the rest of the record
+        if self._test_filter is not None and test_num not in self._test_filter:
+            return
+
         # Extract site_num   U*1
         site_num = self.record[5]
 
@@ -91,17 +150,32 @@ class ParseFile():
         # Store test results related to currect site number
         self.sites[site_num].add_test_result((test_num, LO_LIMIT, HI_LIMIT, result ,PARAM_FLG))
 
+    # Gather parametric test records for batch decoding at PRR
+    def collect_ptr(self):
+        # Drop tests outside the allow-list, test_num   U*4
+        if self._test_filter is not None and int.from_bytes(self.record[0:4], byteorder='little') not in self._test_filter:
+            return
+
+        # Extract site_num   U*1
+        self.sites[self.record[5]].add_ptr_record(self.record)
+
     # Extract master information record, wafer information record, and wafer configuration record
     def extract_data(self):
+        # Keep the body for checkpoints
+        self._context[self.record_name] = bytes(self.record)
+
         if self.record_name == "MIR":
             # Extract LotID  C*n starting from index 15 where ID size is stored
-            self.LotID = self.record[16 : 16 + self.record[15]]  #extract LotID as a bytearray
+            self.LotID = bytes(self.record[16 : 16 + self.record[15]])  #extract LotID as bytes (record may be a memoryview)
             self.LotID = self.LotID.decode('utf-8') #Stringify LotID
 
         elif self.record_name == "WIR":
             # Extract WaferID  C*n
-            self.WaferID = self.record[7 : 7 + self.record[6]] 
+            self.WaferID = bytes(self.record[7 : 7 + self.record[6]])
             self.WaferID = self.WaferID.decode('utf-8')
+
+            # Dies of a previous wafer without WRR
+            self.flush_store()
             
             # Put record in queue
             self.record_queue.put(("wafer_info", self.LotID, self.WaferID))
@@ -128,13 +202,254 @@ class ParseFile():
 
             self._wafer_config = (self.wafer_size, self.DIE_HT, self.DIE_WID , self.WF_FLAT, self.Center_X, self.Center_Y, self.POS_X, self.POS_Y)
             return
-    # Parse STDF File
+
+    # Extract master results record: end of file
+    def extract_mrr(self):
+        self.finished = True
+
+    # Hand the filled die store to the loader and start a new one
+    def flush_store(self):
+        if self._store:
+            self.record_queue.put(("die_store", self._store))
+            self._store = DieStore()
+
+    # Extract wafer results record: closes the current wafer
+    def extract_wrr(self):
+        # Release parts left open within the wafer
+        self.sites.clear()
+        self.flush_store()
+
+        # Let the loader commit the wafer as one unit
+        self.record_queue.put(("wafer_end", self.WaferID))
+
+    # Parse STDF File using the selected scanner
     def read(self):
         start = time.time()
         
         # Log parsing attempts
         self.logger.info(f'New Log       Date: {datetime.datetime.now()}')
-        
+        self.logger.info(f'Scanner: {self._scanner}')
+
+        if self._follow:
+            self._read_follow()
+        elif self._codec:
+            self._read_compressed()
+        elif self._scanner == "mmap":
+            self._read_mmap()
+        else:
+            self._read_stream()
+        self.flush_store()
+
+        end = time.time()
+        self.logger.info(f'Execution time: {end - start} seconds')
+        self.logger.info(f'-------------------------------------------------------------====-------------------------------------------------------------')
+
+    # Memory-map the file and walk record headers without copying record bodies
+    def _read_mmap(self):
+        # Empty files cannot be mapped
+        if os.path.getsize(self._file_name) == 0:
+            return
+
+        with open(self._file_name, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            view = memoryview(mm)
+            try:
+                start = self.restore(self._resume) if self._resume else 0
+                if self._checkpoint_bytes:
+                    self._scan_checkpointed(view, start, len(view))
+                else:
+                    self.scan(view, start, len(view))
+            finally:
+                # Drop every exported slice before the map is closed
+                self.record = bytearray()
+                view.release()
+
+    # Stream-decompress the file and scan records out of large chunks, carrying
+    # a trailing partial record over to the next chunk
+    def _read_compressed(self):
+        codec_name, opener = self._codec
+        start = time.time()
+        decompressed = 0
+        pending = bytearray()
+
+        with opener(self._file_name, "rb") as stream:
+            while chunk := stream.read(self.CHUNK_SIZE):
+                decompressed += len(chunk)
+                pending += chunk
+                view = memoryview(pending)
+                try:
+                    consumed = self.scan(view, 0, len(view))
+                finally:
+                    self.record = bytearray()
+                    view.release()
+                del pending[:consumed]
+
+        # Report throughput per codec
+        elapsed = max(time.time() - start, 1e-9)
+        compressed = os.path.getsize(self._file_name)
+        self.logger.info(f'{codec_name}: {compressed / elapsed / 1e6:.1f} MB/s compressed, '
+                         f'{decompressed / elapsed / 1e6:.1f} MB/s decompressed '
+                         f'(ratio {decompressed / max(compressed, 1):.2f})')
+        if pending:
+            self.logger.warning(f'{len(pending)} trailing bytes do not form a complete record')
+
+    # Follow a file that is still being written by the tester: scan what is there, then
+    # poll for growth and resume from the last complete record. A trailing partial record
+    # is kept until the rest of it is written. Stops at MRR, or when the file has not
+    # grown for follow_timeout seconds.
+    def _read_follow(self):
+        pending = bytearray()
+        position = 0
+        idle_since = time.time()
+
+        # The tester may not have created the file yet
+        while not os.path.exists(self._file_name):
+            if time.time() - idle_since >= self._follow_timeout:
+                raise FileNotFoundError(f"{self._file_name} was not created within {self._follow_timeout} seconds")
+            time.sleep(self._poll_interval)
+
+        with open(self._file_name, "rb") as f:
+            if self._resume:
+                position = self.restore(self._resume)
+                f.seek(position)
+            last_checkpoint = position
+
+            while not self.finished:
+                chunk = f.read(self.CHUNK_SIZE)
+                if chunk:
+                    position += len(chunk)
+                    pending += chunk
+                    view = memoryview(pending)
+                    try:
+                        if self._checkpoint_bytes:
+                            consumed, last_checkpoint = self._scan_checkpointed(view, 0, len(view), position - len(pending), last_checkpoint)
+                        else:
+                            consumed = self.scan(view, 0, len(view))
+                    finally:
+                        self.record = bytearray()
+                        view.release()
+                    del pending[:consumed]
+                    idle_since = time.time()
+
+                    # Caught up with the writer: hand the dies parsed so far to the loader
+                    if len(chunk) < self.CHUNK_SIZE:
+                        last_checkpoint = position - len(pending)
+                        self.checkpoint(last_checkpoint)
+
+                elif os.fstat(f.fileno()).st_size < position:
+                    self.logger.warning(f'{self._file_name} was truncated while being followed')
+                    break
+
+                elif time.time() - idle_since >= self._follow_timeout:
+                    self.logger.warning(f'No MRR: {self._file_name} did not grow for {self._follow_timeout} seconds')
+                    break
+
+                else:
+                    time.sleep(self._poll_interval)
+
+        if pending:
+            self.logger.warning(f'{len(pending)} trailing bytes do not form a complete record')
+
+    # Let the loader commit the dies parsed so far. With the byte offset of a record
+    # boundary where no part is open, the checkpoint also carries the state needed to
+    # resume parsing there after a crash.
+    def checkpoint(self, offset=None):
+        self.flush_store()
+        state = None
+        if offset is not None and not self.sites:
+            state = {"offset": offset, "dies_counter": self.dies_counter,
+                     "context": {name: body.hex() for name, body in self._context.items()}}
+        self.record_queue.put(("checkpoint", self.dies_counter, state))
+
+    # Restore the state of a checkpoint: replay its context records without queuing
+    # them, then tell the loader which wafer continues. Returns the offset to resume at.
+    def restore(self, state):
+        record_queue, self.record_queue = self.record_queue, queue.SimpleQueue()
+        try:
+            for name in ("MIR", "WCR", "WIR"):
+                if name in state["context"]:
+                    self.record_name = name
+                    self.record = bytes.fromhex(state["context"][name])
+                    self.extract_data()
+        finally:
+            self.record_queue = record_queue
+        self.dies_counter = state["dies_counter"]
+        if "WIR" in self._context:
+            self.record_queue.put(("resume", self.LotID, self.WaferID))
+        self.logger.info(f'Resuming at byte {state["offset"]}, {self.dies_counter} dies parsed before')
+        return state["offset"]
+
+    # Scan view[start:end] in checkpoint_bytes segments, with a checkpoint after each
+    # segment once the parts open at its end are closed. base is the file offset of view[0]
+    # and last the file offset of the previous checkpoint when the view holds only part of
+    # the file (see _read_follow). Returns the offset of the first record that was not
+    # consumed and the file offset of the last checkpoint.
+    def _scan_checkpointed(self, view, start, end, base=0, last=None):
+        offset = start
+        last = start if last is None else last - base
+        while offset < end:
+            due = last + self._checkpoint_bytes
+            if due > end:
+                # The next checkpoint lies beyond the bytes at hand
+                return self.scan(view, offset, end), last + base
+            next_offset = self.scan(view, offset, due)
+
+            # Finish open parts record by record, a record larger than a segment is scanned alone
+            while (self.sites or next_offset == offset) and next_offset + 4 <= end:
+                record_end = next_offset + 4 + (view[next_offset] | (view[next_offset + 1] << 8))
+                if record_end > end:
+                    break
+                next_offset = self.scan(view, next_offset, record_end)
+
+            if next_offset == offset:
+                break # Truncated trailing record
+            offset = next_offset
+            if self.sites or offset == end:
+                break # The rest of the open parts is not written yet, or nothing follows
+            if not self.finished:
+                self.checkpoint(base + offset)
+            last = offset
+        return offset, last + base
+
+    # Walk records in view[start:end] and dispatch them through the record table.
+    # Returns the offset of the first record that was not consumed.
+    def scan(self, view, start, end):
+        handlers = self._handlers
+        offset = start
+
+        # Stop at a truncated trailing header or body
+        while offset + 4 <= end:
+            # Decompose header into size, type, and sub type
+            body = offset + 4
+            next_offset = body + (view[offset] | (view[offset + 1] << 8))
+            if next_offset > end:
+                break
+            handler = handlers.get((view[offset + 2], view[offset + 3]))
+            offset = next_offset
+
+            # Unknown records are skipped using the record length only
+            if handler is None:
+                continue
+
+            self.record_name, extract = handler
+            if extract is not None:
+                # Zero-copy slice of the record body
+                self.record = view[body:next_offset]
+                extract()
+
+        return offset
+
+    # Re-run context records (MIR, WCR, WIR) found at the given offsets without
+    # putting anything into record_queue, so a scan can start mid-file
+    def replay(self, view, offsets):
+        record_queue, self.record_queue = self.record_queue, queue.SimpleQueue()
+        try:
+            for offset in offsets:
+                self.scan(view, offset, offset + 4 + (view[offset] | (view[offset + 1] << 8)))
+        finally:
+            self.record_queue = record_queue
+
+    # Read records one by one with buffered file reads
+    def _read_stream(self):
         # Open file
         with open(self._file_name, "rb") as f:
             
@@ -145,6 +460,11 @@ class ParseFile():
                 self.record_type = header[2]
                 self.record_sub_type = header[3]
 
+                # Seek past PTR bodies when test results are not needed
+                if self._skip_ptr and self.record_type == 15 and self.record_sub_type == 10:
+                    f.seek(self.record_size, 1)
+                    continue
+
                 # Read record
                 self.record = f.read(self.record_size)
                 
@@ -161,7 +481,7 @@ class ParseFile():
                 elif self.record_type == 15 and self.record_sub_type == 10:
                     # PTR record holds test related information
                     self.record_name = "PTR"
-                    self.extract_ptr()
+                    self._extract_ptr()
 
                 elif self.record_type == 5 and self.record_sub_type == 20:
                     # PRR record contains die related information, and it appears after PTR records
@@ -183,16 +503,15 @@ class ParseFile():
                     self.record_name = "WCR"
                     self.extract_data()        
 
+                elif self.record_type == 2 and self.record_sub_type == 20:
+                    # WRR record indicates the end of a wafer
+                    self.record_name = "WRR"
+                    self.extract_wrr()
+
                 elif self.record_type == 1 and self.record_sub_type == 20:
                     # MRR record indicates the end of file
                     self.record_name = "MRR"
-                    
-
-                    
-
-        end = time.time()
-        self.logger.info(f'Execution time: {end - start} seconds')
-        self.logger.info(f'-------------------------------------------------------------====-------------------------------------------------------------')
+                    self.extract_mrr()
 
 
 
@@ -4,10 +4,69 @@ Parser class is a factory of parsers. It returns an oject based on the extension
 Task:
   -> Implement a proper design pattern
 """
-from parse_file import ParseFile
+import bz2
+import gzip
+import lzma
+
+from ParseFile import ParseFile
+from ShardedParseFile import ShardedParseFile
+
+# Compressed STDF archives detected by magic bytes: magic -> (codec name, opener)
+COMPRESSION_CODECS = {
+    b'\x1f\x8b': ("gzip", gzip.open),
+    b'BZh': ("bz2", bz2.open),
+    b'\xfd7zXZ\x00': ("xz", lzma.open),
+}
+
+# File names picked up when scanning folders for STDF files
+STDF_SUFFIXES = (".stdf", ".stdf.gz", ".stdf.bz2", ".stdf.xz")
+
+def detect_codec(file_name):
+    """ Return (codec name, opener) when the file starts with a known compression magic, else None. """
+    with open(file_name, "rb") as f:
+        head = f.read(6)
+    for magic, codec in COMPRESSION_CODECS.items():
+        if head.startswith(magic):
+            return codec
+    return None
 
 class Parse():
     @classmethod
-    def create_parser(cls, file_name, RecordQueue):
-        return ParseFile(file_name, RecordQueue)
+    def create_parser(cls, file_name, RecordQueue, scanner="stream", ptr_batch=False, workers=1, skip_ptr=False, test_filter=None, die_store=False,
+                      follow=False, poll_interval=1.0, follow_timeout=60.0, checkpoint_bytes=None, resume=None):
+        """
+        Args:
+        file_name [string]: file path
+        RecordQueue [Queue object]
+        scanner [string]: "stream" reads records with file reads, "mmap" walks a memory-mapped file
+        ptr_batch [bool]: decode PTR records per die into NumPy columns instead of tuples
+        workers [int]: parse shards of the file in this many processes (None for one per core)
+        skip_ptr [bool]: skip every PTR record, only bin and pass/fail data is extracted
+        test_filter [iterable]: only keep PTR records with these test numbers
+        die_store [bool]: fill one compact DieStore per wafer instead of queuing a DieInfo per die
+        follow [bool]: keep reading a file that is still being written until MRR, committing
+                       the dies parsed so far every time the parser catches up with the tester
+        poll_interval [float]: seconds between checks for growth in follow mode
+        follow_timeout [float]: stop following when the file has not grown for this many seconds
+        checkpoint_bytes [int]: let the loader commit about every this many bytes, at record
+                                boundaries where no part is open, and record where to resume
+        resume [dict]: checkpoint state to resume parsing from, see ParseFile.checkpoint
 
+        Compressed files (.gz/.bz2/.xz) are detected by magic bytes and stream-decompressed
+        straight into the record scanner; they are always parsed by a single ParseFile and
+        are not checkpointed.
+        """
+        options = dict(ptr_batch=ptr_batch, skip_ptr=skip_ptr, test_filter=test_filter, die_store=die_store)
+        if follow:
+            # A growing file is read by a single parser, it may not exist yet
+            return ParseFile(file_name, RecordQueue, follow=True, poll_interval=poll_interval, follow_timeout=follow_timeout,
+                             checkpoint_bytes=checkpoint_bytes, resume=resume, **options)
+        codec = detect_codec(file_name)
+        if codec:
+            return ParseFile(file_name, RecordQueue, codec=codec, **options)
+        if checkpoint_bytes or resume:
+            # Checkpoints are byte offsets of a single memory-mapped scan
+            return ParseFile(file_name, RecordQueue, scanner="mmap", checkpoint_bytes=checkpoint_bytes, resume=resume, **options)
+        if workers is None or workers > 1:
+            return ShardedParseFile(file_name, RecordQueue, workers=workers, **options)
+        return ParseFile(file_name, RecordQueue, scanner=scanner, **options)
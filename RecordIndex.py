@@ -0,0 +1,234 @@
+"""
+
+RecordIndex keeps byte offsets of the records of an STDF file in a sidecar
+file next to it (<file>.idx.npz), so later operations can seek instead of
+re-parsing from byte 0.
+
+The index holds:
+  - the offsets of every MIR, WIR, WCR and WRR record
+  - the PIR..PRR span of every part with its die number, site, X/Y
+    coordinates and the WIR it belongs to
+
+The sidecar is validated against the STDF file size, modification time and
+a sampled content hash, and rebuilt when any of them differ.
+
+"""
+import os
+import mmap
+import json
+import queue
+import struct
+import hashlib
+
+import numpy as np
+
+from ParseFile import ParseFile
+
+# Sidecar layout version, bump when the arrays below change
+INDEX_VERSION = 1
+
+# Bytes hashed at the beginning and at the end of the file
+_HASH_SAMPLE = 1 << 20
+
+# Context records kept in the index
+_CONTEXT_RECORDS = {(1, 10): "MIR", (2, 10): "WIR", (2, 30): "WCR", (2, 20): "WRR"}
+
+RECORD_DTYPE = np.dtype([('offset', '<u8'), ('type', 'u1'), ('sub_type', 'u1')])
+
+PART_DTYPE = np.dtype([
+    ('start', '<u8'),   # Offset of the PIR record
+    ('end', '<u8'),     # Offset right after the PRR record
+    ('number', '<u4'),  # DieID, as numbered by ParseFile
+    ('site', 'u1'),
+    ('wafer', '<i4'),   # Position of the enclosing WIR among WIR records, -1 before the first WIR
+    ('x', '<i2'),
+    ('y', '<i2'),
+])
+
+
+def fingerprint(file_name):
+    """
+    Fast identity of a file: size, mtime and a hash of its first and last MiB.
+
+    Returns:
+    fingerprint [dict]: {"size", "mtime", "hash"}
+    """
+    stat = os.stat(file_name)
+    digest = hashlib.blake2b(str(stat.st_size).encode(), digest_size=16)
+    with open(file_name, "rb") as f:
+        digest.update(f.read(_HASH_SAMPLE))
+        if stat.st_size > _HASH_SAMPLE:
+            f.seek(max(stat.st_size - _HASH_SAMPLE, _HASH_SAMPLE))
+            digest.update(f.read(_HASH_SAMPLE))
+    return {"size": stat.st_size, "mtime": stat.st_mtime_ns, "hash": digest.hexdigest()}
+
+
+def sidecar_name(file_name):
+    return f"{file_name}.idx.npz"
+
+
+class RecordIndex:
+    def __init__(self, file_name, records, parts, file_fingerprint):
+        self.file_name = file_name
+        self.records = records          # RECORD_DTYPE array in file order
+        self.parts = parts              # PART_DTYPE array in PIR order
+        self.fingerprint = file_fingerprint
+
+    @classmethod
+    def build(cls, file_name):
+        """ Walk the record headers of an STDF file and index them. """
+        records, parts = [], []
+        open_parts = {}     # site -> index in parts of the part opened by its PIR
+        wafer = -1
+        size = os.path.getsize(file_name)
+
+        if size:
+            with open(file_name, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                offset = 0
+                while offset + 4 <= size:
+                    key = (mm[offset + 2], mm[offset + 3])
+                    start, body = offset, offset + 4
+                    offset = body + (mm[offset] | (mm[offset + 1] << 8))
+                    if offset > size:
+                        break
+
+                    if key == (5, 10):
+                        # PIR: open a part on its site
+                        site = mm[body + 1]
+                        open_parts[site] = len(parts)
+                        parts.append([start, 0, len(parts) + 1, site, wafer, 0, 0])
+                    elif key == (5, 20):
+                        # PRR: close the part and store its coordinates
+                        part = open_parts.pop(mm[body + 1], None)
+                        if part is not None:
+                            parts[part][1] = offset
+                            parts[part][5:7] = struct.unpack_from('<hh', mm, body + 9)
+                    elif key in _CONTEXT_RECORDS:
+                        if key == (2, 10):
+                            wafer += 1
+                        records.append((start, *key))
+
+        return cls(file_name,
+                   np.array(records, dtype=RECORD_DTYPE),
+                   np.array([tuple(part) for part in parts], dtype=PART_DTYPE),
+                   fingerprint(file_name))
+
+    def save(self):
+        """ Write the index next to the STDF file. """
+        meta = json.dumps({"version": INDEX_VERSION, **self.fingerprint})
+        with open(sidecar_name(self.file_name), "wb") as f:
+            np.savez_compressed(f, records=self.records, parts=self.parts, meta=np.array(meta))
+
+    @classmethod
+    def load(cls, file_name, rebuild=True):
+        """
+        Load the sidecar of an STDF file if it is still valid.
+
+        Args:
+        file_name [string]: STDF file path
+        rebuild [bool]: build and save a new index when the sidecar is missing or stale
+
+        Returns:
+        index [RecordIndex] or None
+        """
+        current = fingerprint(file_name)
+        try:
+            with np.load(sidecar_name(file_name)) as sidecar:
+                meta = json.loads(str(sidecar["meta"]))
+                if meta.pop("version") == INDEX_VERSION and meta == current:
+                    return cls(file_name, sidecar["records"], sidecar["parts"], current)
+        except (OSError, KeyError, ValueError):
+            pass
+
+        if not rebuild:
+            return None
+        index = cls.build(file_name)
+        index.save()
+        return index
+
+    def offsets(self, record_name):
+        """ Offsets of every MIR, WIR, WCR or WRR record. """
+        record_type, sub_type = next(key for key, name in _CONTEXT_RECORDS.items() if name == record_name)
+        mask = (self.records['type'] == record_type) & (self.records['sub_type'] == sub_type)
+        return self.records['offset'][mask]
+
+    def find_die(self, x, y, wafer=None):
+        """ Die numbers located at (x, y), optionally within one wafer (WIR position). """
+        mask = (self.parts['x'] == x) & (self.parts['y'] == y)
+        if wafer is not None:
+            mask &= self.parts['wafer'] == wafer
+        return self.parts['number'][mask]
+
+    def _context_before(self, offset):
+        """ Offsets of the latest MIR, WCR and WIR preceding offset. """
+        latest = {}
+        for record in self.records[self.records['offset'] < offset]:
+            latest[(record['type'], record['sub_type'])] = int(record['offset'])
+        return sorted(value for key, value in latest.items() if key != (2, 20))
+
+    def read_wafer_config(self, wafer=0):
+        """
+        Decode only the context records of a wafer.
+
+        Args:
+        wafer [int]: position of the WIR among the file's WIR records
+
+        Returns:
+        (LotID, WaferID, wafer_config) with wafer_config None when the file has no WCR
+        """
+        wir = self.offsets("WIR")[wafer]
+        parser = ParseFile(self.file_name, queue.SimpleQueue(), scanner="mmap")
+        with open(self.file_name, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            view = memoryview(mm)
+            try:
+                parser.replay(view, self._context_before(wir) + [int(wir)])
+            finally:
+                parser.record = bytearray()
+                view.release()
+        return parser.LotID, parser.WaferID, parser._wafer_config
+
+    def read_dies(self, numbers, record_queue, **parser_options):
+        """
+        Re-extract the given dies by seeking to their PIR..PRR spans.
+
+        Records of other sites interleaved within a span are skipped. Each die
+        is put into record_queue as ("die_info", DieInfo), or all of them as one
+        ("die_store", DieStore) with die_store=True, like ParseFile.read.
+
+        Args:
+        numbers [iterable]: die numbers (DieID)
+        record_queue [Queue object]
+        parser_options: ParseFile options such as ptr_batch, skip_ptr or test_filter
+        """
+        parser = ParseFile(self.file_name, record_queue, scanner="mmap", **parser_options)
+        site_byte = {(5, 10): 1, (15, 10): 5, (5, 20): 1}   # Position of SITE_NUM in PIR, PTR and PRR
+
+        with open(self.file_name, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            view = memoryview(mm)
+            try:
+                for part in self.parts[np.isin(self.parts['number'], np.fromiter(numbers, dtype='<u4'))]:
+                    parser.dies_counter = int(part['number']) - 1
+                    offset, end = int(part['start']), int(part['end'])
+                    while offset < end:
+                        key = (view[offset + 2], view[offset + 3])
+                        body = offset + 4
+                        offset = body + (view[offset] | (view[offset + 1] << 8))
+                        if key not in site_byte or view[body + site_byte[key]] != part['site']:
+                            continue
+                        # PTR has no handler with skip_ptr, and test_filter is applied by its handler as in scan
+                        handler = parser._handlers.get(key)
+                        if handler is None:
+                            continue
+                        parser.record_name, extract = handler
+                        parser.record = view[body:offset]
+                        extract()
+                parser.flush_store()
+            finally:
+                parser.record = bytearray()
+                view.release()
+
+
+if __name__ == "__main__":
+    import sys
+    index = RecordIndex.load(sys.argv[1])
+    print(f"{len(index.parts)} parts, {len(index.offsets('WIR'))} wafers indexed in {sidecar_name(sys.argv[1])}")
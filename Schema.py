@@ -0,0 +1,205 @@
+"""
+
+Schema creates and upgrades the wafer map database.
+
+Migrations are applied in order and the database's PRAGMA user_version
+records the last one applied, so opening an up to date database costs a
+single PRAGMA read. Existing databases (e.g. "database - Copy.db") are
+upgraded in place: the base tables are only created when missing.
+
+Usage:
+    python Schema.py database.db
+
+"""
+import sys
+import sqlite3
+
+from TestStore import CATALOG_TABLE
+
+# (version, statements), applied in order
+MIGRATIONS = (
+    # 1: base tables
+    (1, (
+        """CREATE TABLE IF NOT EXISTS [wafer_info](
+  [MasterID] INTEGER PRIMARY KEY AUTOINCREMENT,
+  [LotID] TEXT,
+  [WaferID] TEXT)""",
+        """CREATE TABLE IF NOT EXISTS [wafer_config](
+  [ID] INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+  [MasterID] INTEGER REFERENCES [wafer_info]([MasterID]),
+  [WaferSize] REAL,
+  [DieHeight] REAL,
+  [DieWidth] REAL,
+  [WaferFlat] CHAR,
+  [CenterX] INTEGER,
+  [CenterY] INTEGER,
+  [PositiveX] CHAR,
+  [PositiveY] CHAR)""",
+        """CREATE TABLE IF NOT EXISTS [test_results](
+  [ResultID] INTEGER PRIMARY KEY AUTOINCREMENT,
+  [MasterID] INTEGER REFERENCES [wafer_info]([MasterID]),
+  [DieID] INTEGER,
+  [TestNumber] INTEGER,
+  [LowerLimit] REAL,
+  [UpperLimit] REAL,
+  [Result] REAL,
+  [TestFlag] INTEGER)""",
+        """CREATE TABLE IF NOT EXISTS [die_info](
+  [MasterID] INTEGER REFERENCES [wafer_info]([MasterID]),
+  [DieID] INTEGER,
+  [DieX] INTEGER,
+  [DieY] INTEGER,
+  [SiteNum] INTEGER,
+  [HardwareBin] INTEGER,
+  [SoftwareBin] INTEGER,
+  [PartFlg] INTEGER,
+  [Passing] INTEGER,
+  PRIMARY KEY([MasterID], [DieID]))""",
+        """CREATE TABLE IF NOT EXISTS "temporary_data" (
+"MasterID" INTEGER,
+  "DieID" INTEGER,
+  "DieX" INTEGER,
+  "DieY" INTEGER,
+  "SiteNum" INTEGER,
+  "HardwareBin" INTEGER,
+  "SoftwareBin" INTEGER,
+  "PartFlg" INTEGER,
+  "Passing" INTEGER,
+  "Visited" INTEGER,
+  "local_yield" REAL,
+  "distance_from_center" REAL,
+  "good_neighbor" INTEGER,
+  "edge" INTEGER
+)""",
+    )),
+
+    # 2: indexes for the hot lookups
+    (2, (
+        # Loader: MasterID of a (LotID, WaferID) on every WIR
+        "CREATE UNIQUE INDEX IF NOT EXISTS wafer_info_lot_wafer ON wafer_info(LotID, WaferID)",
+        # Loader deletes on reload, Model and UI fetch the wafer geometry
+        "CREATE INDEX IF NOT EXISTS wafer_config_master ON wafer_config(MasterID)",
+        # Loader deletes on reload, per die and per test lookups
+        "CREATE INDEX IF NOT EXISTS test_results_master_die_test ON test_results(MasterID, DieID, TestNumber)",
+        # UI wafer plot: covers SELECT DieX, DieY, HardwareBin, Passing FROM die_info WHERE MasterID = ?
+        "CREATE INDEX IF NOT EXISTS die_info_map ON die_info(MasterID, DieX, DieY, HardwareBin, Passing)",
+        # UI die search and Model reload of a wafer's predictions
+        "CREATE INDEX IF NOT EXISTS temporary_data_master_die ON temporary_data(MasterID, DieID)",
+        "CREATE INDEX IF NOT EXISTS temporary_data_map ON temporary_data(MasterID, DieX, DieY, HardwareBin, Passing)",
+    )),
+
+    # 3: catalog of TestStore columnar test result blocks
+    (3, (
+        CATALOG_TABLE,
+    )),
+
+    # 4: IngestLedger, files loaded and the wafers they produced
+    (4, (
+        """CREATE TABLE IF NOT EXISTS ingest_ledger(
+  Path TEXT PRIMARY KEY,
+  Size INTEGER,
+  MTime INTEGER,
+  Hash TEXT,
+  MasterIDs TEXT,
+  Content TEXT,
+  LoadedAt TEXT)""",
+    )),
+
+    # 5: retest generation of each die, see Loader merge mode
+    (5, (
+        "ALTER TABLE die_info ADD COLUMN Generation INTEGER NOT NULL DEFAULT 0",
+    )),
+
+    # 6: last durable checkpoint of loads in progress, see IngestLedger
+    (6, (
+        """CREATE TABLE IF NOT EXISTS ingest_checkpoints(
+  Path TEXT PRIMARY KEY,
+  HeadLength INTEGER,
+  HeadHash TEXT,
+  State TEXT,
+  LoaderState TEXT,
+  UpdatedAt TEXT)""",
+    )),
+
+    # 7: shard catalog, see ShardRouter
+    (7, (
+        "CREATE TABLE IF NOT EXISTS shard_settings(Name TEXT PRIMARY KEY, Value TEXT)",
+        "CREATE TABLE IF NOT EXISTS shards(Name TEXT PRIMARY KEY, Path TEXT)",
+        """CREATE TABLE IF NOT EXISTS shard_map(
+  MasterID INTEGER PRIMARY KEY REFERENCES wafer_info(MasterID),
+  Shard TEXT REFERENCES shards(Name))""",
+        "CREATE INDEX IF NOT EXISTS shard_map_shard ON shard_map(Shard)",
+    )),
+
+    # 8: cached model run whose results a wafer's visualization rows hold, see ModelCache
+    (8, (
+        """CREATE TABLE IF NOT EXISTS vis_data_source(
+  TableName TEXT,
+  MasterID INTEGER,
+  Source TEXT,
+  PRIMARY KEY(TableName, MasterID))""",
+    )),
+)
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def get_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(conn):
+    """
+    Bring a database up to SCHEMA_VERSION. Every migration runs in its own transaction
+    together with its user_version update; ANALYZE refreshes the planner statistics after
+    an upgrade.
+
+    Args:
+    conn [sqlite3.Connection or string]: open connection or database path
+
+    Returns:
+    version [int]: schema version of the database
+    """
+    if isinstance(conn, str):
+        with sqlite3.connect(conn) as db:
+            version = migrate(db)
+        db.close()
+        return version
+
+    version = get_version(conn)
+    if version >= SCHEMA_VERSION:
+        return version
+
+    for migration, statements in MIGRATIONS:
+        if migration <= version:
+            continue
+        try:
+            # Take the write lock first, another connection may have migrated meanwhile
+            conn.execute("BEGIN IMMEDIATE")
+            current = get_version(conn)
+            if current >= migration:
+                conn.rollback()
+                version = current
+                continue
+            for statement in statements:
+                conn.execute(statement)
+            conn.execute(f"PRAGMA user_version = {migration}")
+            conn.commit()
+        except sqlite3.Error as error:
+            conn.rollback()
+            raise sqlite3.DatabaseError(f"Schema migration {migration} failed: {error}") from error
+        version = migration
+
+    conn.execute("ANALYZE")
+    conn.commit()
+    return version
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print("Usage: python Schema.py <database>")
+        sys.exit(1)
+    with sqlite3.connect(sys.argv[1]) as db:
+        before = get_version(db)
+        after = migrate(db)
+    print(f"{sys.argv[1]}: schema version {before} -> {after}")
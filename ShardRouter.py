@@ -0,0 +1,244 @@
+"""
+
+ShardRouter spreads the wafers of a database over shard databases, one per
+lot or one per month of loading, so the file written to stays small and old
+shards can be archived or moved to slower storage.
+
+The database the application opens (e.g. database.db) becomes the catalog.
+It keeps wafer_info, so MasterIDs stay unique across shards, the ingest
+ledger, and shard_map, the shard of every wafer. A shard is a complete
+database with the same schema holding the wafer_info rows, dies, test
+results, test blocks and predictions of its wafers, so it can be opened on
+its own as well. Wafers loaded before sharding was enabled stay in the
+catalog database.
+
+Queries for a wafer are routed by attaching its shard to the router's
+connection on demand; at most max_attached shards stay attached, the least
+recently used one is detached first. Shards are created in <database>.shards/
+and are found through the shards table, a moved shard is re-pointed with
+relocate.
+
+Usage:
+    python ShardRouter.py database.db enable lot|month
+    python ShardRouter.py database.db list
+    python ShardRouter.py database.db relocate <shard> <new path>
+
+"""
+import os
+import re
+import sys
+import sqlite3
+import datetime
+import threading
+import contextlib
+import collections
+
+import Schema
+
+SHARD_KEYS = ("lot", "month")
+
+# SQLite attaches at most 10 databases by default
+MAX_ATTACHED = 8
+
+
+def sharding(cursor):
+    """ Returns how the database behind cursor is sharded, "lot" or "month", or None. """
+    row = cursor.execute("SELECT Value FROM shard_settings WHERE Name = 'by'").fetchone()
+    return row[0] if row else None
+
+
+class ShardRouter:
+    def __init__(self, db_name, max_attached=MAX_ATTACHED):
+        """
+        Args:
+        db_name [string]: catalog database
+        max_attached [int]: shards kept attached at once
+        """
+        self._db_name = os.path.abspath(db_name)
+        self._db_dir = os.path.dirname(self._db_name)
+        self._max_attached = max_attached
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(self._db_name, check_same_thread=False)
+        Schema.migrate(self._conn)
+        self._attached = collections.OrderedDict()  # shard name -> schema name, least recently used first
+        self._next_alias = 0
+
+    @property
+    def by(self):
+        with self._lock:
+            return sharding(self._conn)
+
+    def enable(self, by):
+        """ Shard the wafers loaded from now on by "lot" or by "month". """
+        if by not in SHARD_KEYS:
+            raise ValueError(f"Unknown shard key {by!r}, expected one of {SHARD_KEYS}")
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO shard_settings (Name, Value) VALUES ('by', ?)", (by,))
+
+    def _shard_name(self, lot_id):
+        if self.by == "month":
+            return datetime.date.today().strftime("%Y-%m")
+        return re.sub(r"[^\w.-]+", "_", str(lot_id)) or "_"
+
+    def _shard_path(self, name):
+        row = self._conn.execute("SELECT Path FROM shards WHERE Name = ?", (name,)).fetchone()
+        return os.path.join(self._db_dir, row[0])
+
+    def shard(self, mid):
+        """ Returns the shard name of a wafer, None when it is stored in the catalog database. """
+        with self._lock:
+            row = self._conn.execute("SELECT Shard FROM shard_map WHERE MasterID = ?", (mid,)).fetchone()
+        return row[0] if row else None
+
+    def path(self, mid):
+        """ Returns the database file holding the data of a wafer. """
+        name = self.shard(mid)
+        if name is None:
+            return self._db_name
+        with self._lock:
+            return self._shard_path(name)
+
+    def assign(self, lot_id, wafer_id):
+        """
+        Returns the MasterID of a wafer and the database its data goes to. A new wafer is
+        registered in the catalog and, when sharding is enabled, mapped to its shard.
+
+        Returns:
+        mid [int]: MasterID
+        path [string]: database file of the wafer's data
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT MasterID FROM wafer_info WHERE LotID = ? AND WaferID = ?", (lot_id, wafer_id)).fetchone()
+            if not row:
+                try:
+                    with self._conn:
+                        mid = self._conn.execute("INSERT INTO wafer_info (LotID, WaferID) VALUES (?, ?)", (lot_id, wafer_id)).lastrowid
+                        if self.by:
+                            name = self._shard_name(lot_id)
+                            stem = os.path.splitext(os.path.basename(self._db_name))[0]
+                            self._conn.execute("INSERT OR IGNORE INTO shards (Name, Path) VALUES (?, ?)",
+                                               (name, os.path.join(stem + ".shards", name + ".db")))
+                            self._conn.execute("INSERT INTO shard_map (MasterID, Shard) VALUES (?, ?)", (mid, name))
+                except sqlite3.IntegrityError:
+                    # Registered by another loader meanwhile
+                    row = self._conn.execute("SELECT MasterID FROM wafer_info WHERE LotID = ? AND WaferID = ?", (lot_id, wafer_id)).fetchone()
+            if row:
+                mid = row[0]
+            return mid, self.path(mid)
+
+    def _attach(self, name):
+        """ Returns the schema name of an attached shard, attaching it first if needed. """
+        if name in self._attached:
+            self._attached.move_to_end(name)
+            return self._attached[name]
+        path = self._shard_path(name)
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"Shard {name} not found at {path}, see ShardRouter.relocate")
+        while len(self._attached) >= self._max_attached:
+            _, alias = self._attached.popitem(last=False)
+            self._conn.execute(f"DETACH DATABASE {alias}")
+        alias = f"shard_{self._next_alias}"
+        self._next_alias += 1
+        self._conn.execute("ATTACH DATABASE ? AS " + alias, (path,))
+        self._attached[name] = alias
+        return alias
+
+    @contextlib.contextmanager
+    def connection(self, mid):
+        """
+        Context manager giving the router's connection and the schema name of a wafer's
+        tables, "main" for wafers stored in the catalog database. Commits on exit.
+
+        Usage:
+            with router.connection(mid) as (conn, shard):
+                conn.execute(f"SELECT DieX, DieY FROM {shard}.die_info WHERE MasterID = ?", (mid,))
+        """
+        with self._lock:
+            name = self.shard(mid)
+            alias = "main" if name is None else self._attach(name)
+            try:
+                yield self._conn, alias
+                self._conn.commit()
+            except Exception:
+                self._conn.rollback()
+                raise
+
+    def query(self, mid, sql, params=()):
+        """
+        Runs a query on a wafer's tables, {shard} in sql is replaced by their schema name.
+
+        Returns:
+        rows [list]
+        """
+        with self.connection(mid) as (conn, shard):
+            return conn.execute(sql.format(shard=shard), params).fetchall()
+
+    def shards(self):
+        """
+        Returns:
+        shards [list]: (name, path, wafers, size in bytes or None when the file is missing)
+        """
+        with self._lock:
+            rows = self._conn.execute("SELECT Name, Path, (SELECT COUNT(*) FROM shard_map WHERE Shard = Name) FROM shards ORDER BY Name").fetchall()
+        shards = []
+        for name, path, wafers in rows:
+            path = os.path.join(self._db_dir, path)
+            shards.append((name, path, wafers, os.path.getsize(path) if os.path.exists(path) else None))
+        return shards
+
+    def relocate(self, name, path):
+        """ Point a shard at its new file, e.g. after moving it to archive storage. """
+        with self._lock:
+            alias = self._attached.pop(name, None)
+            if alias:
+                self._conn.execute(f"DETACH DATABASE {alias}")
+            with self._conn:
+                if not self._conn.execute("UPDATE shards SET Path = ? WHERE Name = ?", (os.path.abspath(path), name)).rowcount:
+                    raise KeyError(f"No shard named {name}")
+
+    def close(self):
+        with self._lock:
+            self._attached.clear()
+            self._conn.close()
+
+
+# Routers of the databases opened by this process, see get_router
+_routers = {}
+_routers_lock = threading.Lock()
+
+
+def get_router(db_name):
+    """ Returns the shared ShardRouter of a database, created on first use. """
+    key = os.path.abspath(db_name)
+    with _routers_lock:
+        if key not in _routers:
+            _routers[key] = ShardRouter(key)
+        return _routers[key]
+
+
+def close_router(db_name=None):
+    """
+    Close the shared ShardRouter of a database, or of every database, e.g. when a
+    worker is done with it. The next get_router opens a new one.
+    """
+    with _routers_lock:
+        keys = [os.path.abspath(db_name)] if db_name else list(_routers)
+        routers = [_routers.pop(key) for key in keys if key in _routers]
+    for router in routers:
+        router.close()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3 or sys.argv[2] not in ("enable", "list", "relocate"):
+        print("Usage: python ShardRouter.py <database> enable lot|month | list | relocate <shard> <new path>")
+        sys.exit(1)
+    router = ShardRouter(sys.argv[1])
+    if sys.argv[2] == "enable":
+        router.enable(sys.argv[3])
+        print(f"{sys.argv[1]}: new wafers are sharded by {sys.argv[3]}")
+    elif sys.argv[2] == "relocate":
+        router.relocate(sys.argv[3], sys.argv[4])
+    else:
+        for name, path, wafers, size in router.shards():
+            print(f"{name}: {wafers} wafers, {path} ({'missing' if size is None else f'{size / 1e6:.1f} MB'})")
+    router.close()
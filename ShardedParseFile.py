@@ -0,0 +1,137 @@
+"""
+
+ShardedParseFile parses a single STDF file with a pool of processes.
+
+The file is pre-scanned once to find record boundaries where no part is
+open (every PIR has been closed by its PRR). It is split into shards at
+those boundaries; each shard carries the latest MIR, WCR and WIR records
+preceding it plus the number of dies before it, so a worker can replay
+that context and continue the die numbering exactly where the previous
+shard stopped. Workers return the dies of their shard as DieStore
+columns, and shard results are merged back into the record queue in file
+order with only a few shards per worker parsed ahead of the consumer, so
+the parent never holds more than that window of the file.
+
+"""
+import os
+import mmap
+import time
+import queue
+import logging
+import datetime
+import itertools
+import collections
+from concurrent.futures import ProcessPoolExecutor
+
+from ParseFile import ParseFile
+
+# Context records carried to every shard
+_CONTEXT_RECORDS = {(1, 10): "MIR", (2, 30): "WCR", (2, 10): "WIR"}
+
+# Shards per worker, more shards balance uneven wafers better
+_SHARDS_PER_WORKER = 4
+
+# Largest shard, bounds the results held for the shards in flight
+_MAX_SHARD_BYTES = 16 << 20
+
+# Shards parsed ahead per worker while the oldest one is queued
+_SHARDS_IN_FLIGHT_PER_WORKER = 2
+
+
+def _parse_shard(shard):
+    """
+    Parse one shard in a worker process.
+
+    Args:
+    shard [tuple]: (file_name, start, end, context offsets, dies before shard, parser options)
+
+    Returns:
+    records [list]: queue records produced by the shard in file order, dies as DieStore columns
+    """
+    file_name, start, end, context, dies_counter, parser_options = shard
+    records = queue.SimpleQueue()
+    parser = ParseFile(file_name, records, scanner="mmap", **dict(parser_options, die_store=True))
+
+    with open(file_name, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        view = memoryview(mm)
+        try:
+            parser.replay(view, context)
+            parser.dies_counter = dies_counter
+            parser.scan(view, start, end)
+            parser.flush_store()
+        finally:
+            parser.record = bytearray()
+            view.release()
+
+    return [records.get() for _ in range(records.qsize())]
+
+
+class ShardedParseFile():
+    def __init__(self, file_name, record_queue, workers=None, **parser_options):
+        self.record_queue = record_queue
+        self._file_name = file_name
+        self._workers = workers or os.cpu_count()
+        self._parser_options = parser_options
+        self.dies_counter = 0
+        self.logger = logging.getLogger(__name__)
+
+    # Walk record headers and split the file at closed part boundaries
+    def plan_shards(self):
+        size = os.path.getsize(self._file_name)
+        if size == 0:
+            return []
+        target = max(min(size // (self._workers * _SHARDS_PER_WORKER), _MAX_SHARD_BYTES), 1)
+
+        shards = []
+        context = {}            # Latest context record offset by record name
+        shard_start, shard_context, shard_dies = 0, [], 0
+        open_parts = dies = 0
+
+        with open(self._file_name, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            offset = 0
+            while offset + 4 <= size:
+                key = (mm[offset + 2], mm[offset + 3])
+                record_start = offset
+                offset += 4 + (mm[offset] | (mm[offset + 1] << 8))
+
+                if key == (5, 10):
+                    open_parts += 1
+                    dies += 1
+                elif key == (5, 20):
+                    open_parts -= 1
+                    # Cut after a PRR once the shard is large enough and no part is open
+                    if open_parts <= 0 and offset - shard_start >= target and offset < size:
+                        shards.append((shard_start, offset, shard_context, shard_dies))
+                        shard_start, shard_context, shard_dies = offset, sorted(context.values()), dies
+                elif key in _CONTEXT_RECORDS:
+                    context[_CONTEXT_RECORDS[key]] = record_start
+
+        shards.append((shard_start, size, shard_context, shard_dies))
+        self.dies_counter = dies
+        return shards
+
+    # Parse shards in a process pool and merge results in file order
+    def read(self):
+        start = time.time()
+        self.logger.info(f'New Log       Date: {datetime.datetime.now()}')
+
+        shards = self.plan_shards()
+        self.logger.info(f'Sharded scan: {len(shards)} shards on {self._workers} workers, pre-scan took {time.time() - start} seconds')
+
+        jobs = ((self._file_name, *shard, self._parser_options) for shard in shards)
+        with ProcessPoolExecutor(max_workers=self._workers) as executor:
+            pending = collections.deque(executor.submit(_parse_shard, job)
+                                        for job in itertools.islice(jobs, self._workers * _SHARDS_IN_FLIGHT_PER_WORKER))
+            try:
+                while pending:
+                    for record in pending.popleft().result():
+                        self.record_queue.put(record)
+                    # The oldest shard is queued, parse the next one
+                    job = next(jobs, None)
+                    if job is not None:
+                        pending.append(executor.submit(_parse_shard, job))
+            finally:
+                for future in pending:
+                    future.cancel()
+
+        self.logger.info(f'Execution time: {time.time() - start} seconds')
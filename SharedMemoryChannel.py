@@ -0,0 +1,218 @@
+"""
+
+SharedMemoryChannel hands decoded dies from a parser process to the loader
+without pickling DieInfo objects.
+
+The consumer allocates a ring of fixed-size shared memory slots. The parser
+process packs the dies it produces into the free slot as DieStore columns
+(DIE_DTYPE rows, test offsets and TEST_RESULT_DTYPE rows) and only sends the
+slot number through a queue. The loader copies the columns out, returns the
+slot to the free list and receives a ("die_store", DieStore) record. Other
+records (wafer_info, wafer_config, wafer_end) are small and are sent as they
+are, after the pending block so the order is preserved.
+
+When every slot is in use the parser blocks until the loader frees one.
+A parser process that dies without closing the channel (killed, crashed in
+native code) ends the stream as a parse error once it is watched.
+
+"""
+import time
+import queue
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from BatchDecoder import TEST_RESULT_DTYPE
+from DieInfo import DIE_DTYPE, DieStore
+
+# Slot layout: [die count u8][test count u8][dies][offsets][tests]
+_HEADER = np.dtype([('dies', '<u8'), ('tests', '<u8')])
+_OFFSET = np.dtype('<u8')
+
+# Seconds the consumer waits for a message before checking the producer is alive
+POLL_INTERVAL = 0.5
+
+
+def _block_size(dies, tests):
+    return _HEADER.itemsize + dies * DIE_DTYPE.itemsize + (dies + 1) * _OFFSET.itemsize + tests * TEST_RESULT_DTYPE.itemsize
+
+
+class SharedMemoryChannel:
+    def __init__(self, slots=8, slot_size=1 << 23):
+        """
+        Args:
+        slots [int]: shared memory blocks in the ring
+        slot_size [int]: bytes per block
+        """
+        self._slot_size = slot_size
+        self._blocks = [shared_memory.SharedMemory(create=True, size=slot_size) for _ in range(slots)]
+        self._free = multiprocessing.Queue()
+        self._ready = multiprocessing.Queue()
+        self._cancelled = multiprocessing.Event()
+        self._producer = None
+        for slot in range(slots):
+            self._free.put(slot)
+
+        # Producer state: dies received one by one
+        self._pending = DieStore()
+
+        # Consumer metrics
+        self._block_count = 0
+        self._die_count = 0
+        self._test_count = 0
+        self._get_wait = 0.0
+
+    def __getstate__(self):
+        # Producer buffers are not shared with the other process
+        state = self.__dict__.copy()
+        state["_pending"] = DieStore()
+        state["_producer"] = None
+        return state
+
+    def watch(self, producer):
+        """
+        Args:
+        producer [multiprocessing.Process]: parser process, the stream ends as a parse error
+                                            when it exits without closing the channel
+        """
+        self._producer = producer
+
+    # Producer side (parser process)
+    def put(self, record):
+        if self._cancelled.is_set():
+            return
+        if record[0] == "die_store":
+            self.flush()
+            self._send_store(record[1])
+        elif record[0] == "die_info":
+            die = record[1]
+            self._pending.add_die(die.get_number(), die.get_site(), die.get_info(), die.get_test_results())
+            if _block_size(len(self._pending), len(self._pending.tests)) >= self._slot_size:
+                self.flush()
+        else:
+            self.flush()
+            self._ready.put(("record", record))
+
+    def flush(self):
+        """ Send the dies received one by one. """
+        if self._pending:
+            store, self._pending = self._pending, DieStore()
+            self._send_store(store)
+
+    def _send_store(self, store):
+        """ Split a store into slot sized blocks and announce each of them. """
+        offsets = store.offsets
+        start = 0
+        while start < len(store):
+            # Largest run of dies starting at start that fits in a slot
+            counts = np.arange(1, len(store) - start + 1)
+            sizes = _block_size(counts, offsets[start + 1:].astype(np.int64) - int(offsets[start]))
+            end = start + int(np.searchsorted(sizes, self._slot_size, side='right'))
+            if end == start:
+                # A die larger than a slot goes through the queue as is
+                end = start + 1
+                self._ready.put(("record", ("die_store", DieStore.from_arrays(
+                    store.dies[start:end].copy(), offsets[start:end + 1] - offsets[start],
+                    store.tests[int(offsets[start]):int(offsets[end])].copy()))))
+            else:
+                self._write_block(store, start, end)
+            start = end
+
+    def _write_block(self, store, start, end):
+        slot = self._take_slot()
+        if slot is None:
+            return
+        buffer = self._blocks[slot].buf
+        first, last = int(store.offsets[start]), int(store.offsets[end])
+        die_count, test_count = end - start, last - first
+
+        position = _HEADER.itemsize
+        np.ndarray(1, _HEADER, buffer)[0] = (die_count, test_count)
+        np.ndarray(die_count, DIE_DTYPE, buffer, position)[:] = store.dies[start:end]
+        position += die_count * DIE_DTYPE.itemsize
+        np.ndarray(die_count + 1, _OFFSET, buffer, position)[:] = store.offsets[start:end + 1] - first
+        position += (die_count + 1) * _OFFSET.itemsize
+        np.ndarray(test_count, TEST_RESULT_DTYPE, buffer, position)[:] = store.tests[first:last]
+        self._ready.put(("block", slot))
+
+    def _take_slot(self):
+        while not self._cancelled.is_set():
+            try:
+                return self._free.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return None
+
+    def close(self):
+        """ Send the pending block and the end-of-stream marker. """
+        self.flush()
+        self._ready.put(("end",))
+
+    def _get(self):
+        """ Next message, ("died", exit code) when the producer exited without closing the channel. """
+        exited = False
+        while True:
+            try:
+                return self._ready.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                if self._producer is None or self._producer.is_alive():
+                    continue
+                # Its last messages may still be in flight, wait once more after it exited
+                if exited:
+                    return ("died", self._producer.exitcode)
+                exited = True
+
+    # Consumer side (loader)
+    def __iter__(self):
+        while True:
+            start = time.perf_counter()
+            message = self._get()
+            self._get_wait += time.perf_counter() - start
+
+            if message[0] == "died":
+                print(f"Parser process exited with code {message[1]} before the end of the stream")
+                yield ("parse_error", f"parser process exited with code {message[1]}")
+                return
+            if message[0] == "end":
+                return
+            if message[0] == "record":
+                yield message[1]
+                continue
+
+            # Copy the columns out and hand the slot back to the parser
+            slot = message[1]
+            buffer = self._blocks[slot].buf
+            die_count, test_count = np.ndarray(1, _HEADER, buffer)[0].tolist()
+            position = _HEADER.itemsize
+            dies = np.ndarray(die_count, DIE_DTYPE, buffer, position).copy()
+            position += dies.nbytes
+            offsets = np.ndarray(die_count + 1, _OFFSET, buffer, position).copy()
+            position += offsets.nbytes
+            tests = np.ndarray(test_count, TEST_RESULT_DTYPE, buffer, position).copy()
+            self._free.put(slot)
+
+            self._block_count += 1
+            self._die_count += die_count
+            self._test_count += test_count
+            yield ("die_store", DieStore.from_arrays(dies, offsets, tests))
+
+    def cancel(self):
+        """ Stop the stream from the consumer side: pending and future puts are dropped. """
+        self._cancelled.set()
+
+    def release(self):
+        """ Free the shared memory ring, once both sides are done. """
+        for block in self._blocks:
+            block.close()
+            block.unlink()
+        self._blocks = []
+
+    def metrics(self):
+        return {
+            "blocks": self._block_count,
+            "dies": self._die_count,
+            "tests": self._test_count,
+            "mean_dies_per_block": self._die_count / self._block_count if self._block_count else 0,
+            "consumer_wait_seconds": self._get_wait,
+        }
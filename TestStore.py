@@ -0,0 +1,316 @@
+"""
+
+TestStore keeps the test results of a wafer as one columnar block instead
+of one test_results row per PTR.
+
+A block holds the columns DieID, TestNumber, LowerLimit, UpperLimit, Result
+and TestFlag with rows sorted by (TestNumber, DieID), so the results of one
+test are a contiguous slice of every column. TestIndex and TestStarts give
+the test numbers of the block and where each one starts. Blocks are written
+next to the database, in <database>.tests/, and registered in the
+test_blocks catalog table:
+
+    "npy"  one directory per wafer with a .npy file per column, read
+           memory-mapped
+    "npz"  one compressed .npz archive per wafer, smaller on disk but
+           decompressed into memory when read
+
+"""
+import os
+import shutil
+import sqlite3
+import numpy as np
+
+# On-disk column layout, missing limits are NaN
+COLUMNS = {
+    "DieID": np.uint32,
+    "TestNumber": np.uint32,
+    "LowerLimit": np.float32,
+    "UpperLimit": np.float32,
+    "Result": np.float32,
+    "TestFlag": np.uint8,
+}
+
+FORMATS = ("npy", "npz")
+
+CATALOG_TABLE = """CREATE TABLE IF NOT EXISTS test_blocks(
+  MasterID INTEGER PRIMARY KEY REFERENCES wafer_info(MasterID),
+  Path TEXT,
+  Format TEXT,
+  Dies INTEGER,
+  Tests INTEGER)"""
+
+
+def store_dir(db_name):
+    """ Default block directory of a database: database.db -> database.tests """
+    return os.path.splitext(db_name)[0] + ".tests"
+
+
+def _block_path(directory, mid, storage):
+    return os.path.join(directory, str(mid) + (".npz" if storage == "npz" else ""))
+
+
+def _load(path, storage, mmap_mode="r"):
+    """ Returns a dict of column arrays, memory-mapped for "npy" blocks. """
+    if storage == "npz":
+        with np.load(path) as block:
+            return {name: block[name] for name in block.files}
+    return {name: np.load(os.path.join(path, name + ".npy"), mmap_mode=mmap_mode)
+            for name in (*COLUMNS, "TestIndex", "TestStarts")}
+
+
+def _save(path, storage, columns):
+    """ Write a block next to its final path then swap it in, a reader never sees half a block. """
+    if storage == "npz":
+        temp = path + ".tmp.npz"
+        np.savez_compressed(temp, **columns)
+        os.replace(temp, path)
+        return
+
+    temp, old = path + ".tmp", path + ".old"
+    shutil.rmtree(temp, ignore_errors=True)
+    os.makedirs(temp)
+    for name, column in columns.items():
+        np.save(os.path.join(temp, name + ".npy"), column)
+    if os.path.exists(path):
+        os.replace(path, old)
+    os.replace(temp, path)
+    shutil.rmtree(old, ignore_errors=True)
+
+
+def _remove(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def _index(columns):
+    """ Sort a block by test so a test's results are one contiguous slice, and index the tests. """
+    order = np.lexsort((columns["DieID"], columns["TestNumber"]))
+    columns = {name: column[order] for name, column in columns.items()}
+    columns["TestIndex"], columns["TestStarts"] = np.unique(columns["TestNumber"], return_index=True)
+    columns["TestStarts"] = np.append(columns["TestStarts"], len(order)).astype(np.uint64)
+    return columns
+
+
+def drop_tests(cursor, mid, test_filter=None):
+    """
+    Drop the block results of a wafer reloaded as test_results rows, so the block does
+    not return a previous load's results next to the new rows.
+
+    Args:
+    cursor [sqlite3.Cursor]: cursor of the loader's transaction
+    mid [int]: MasterID
+    test_filter [iterable]: tests reloaded, None for all of them; an empty one keeps the block as is
+    """
+    if test_filter is not None and not len(test_filter):
+        return
+    row = cursor.execute("SELECT Path, Format FROM test_blocks WHERE MasterID = ?", (mid,)).fetchone()
+    if not row:
+        return
+    db_name = cursor.execute("PRAGMA database_list").fetchone()[2]
+    path = os.path.join(os.path.dirname(os.path.abspath(db_name)), row[0])
+
+    # A subset reload keeps the stored results of the other tests
+    if test_filter is not None and os.path.exists(path):
+        stored = _load(path, row[1], mmap_mode=None)
+        keep = ~np.isin(stored["TestNumber"], list(test_filter))
+        if keep.any():
+            columns = _index({name: stored[name][keep] for name in COLUMNS})
+            _save(path, row[1], columns)
+            cursor.execute("UPDATE test_blocks SET Dies = ?, Tests = ? WHERE MasterID = ?",
+                           (len(np.unique(columns["DieID"])), len(columns["TestIndex"]), mid))
+            return
+
+    cursor.execute("DELETE FROM test_blocks WHERE MasterID = ?", (mid,))
+    _remove(path)
+
+
+def import_block(cursor, db_name, mid, source, storage, dies, tests, directory=None):
+    """
+    Move a block written for another database, e.g. a BatchIngest staging database,
+    into the store of db_name under a new MasterID and register it in the catalog.
+
+    Args:
+    cursor [sqlite3.Cursor]: cursor of db_name's transaction
+    mid [int]: MasterID of the wafer in db_name
+    source [string]: path of the block to move
+    storage [string]: "npy" or "npz"
+    dies, tests [int]: catalog counts of the block
+    directory [string]: block directory, defaults to store_dir(db_name)
+    """
+    db_dir = os.path.dirname(os.path.abspath(db_name))
+    directory = directory or store_dir(db_name)
+    path = _block_path(directory, mid, storage)
+    row = cursor.execute("SELECT Path, Format FROM test_blocks WHERE MasterID = ?", (mid,)).fetchone()
+
+    os.makedirs(directory, exist_ok=True)
+    old = path + ".old"
+    if os.path.exists(path):
+        os.replace(path, old)
+    shutil.move(source, path)
+    _remove(old)
+    if row and row[1] != storage:
+        _remove(os.path.join(db_dir, row[0]))
+
+    cursor.execute("INSERT OR REPLACE INTO test_blocks (MasterID, Path, Format, Dies, Tests) VALUES (?, ?, ?, ?, ?)",
+                   (mid, os.path.relpath(path, db_dir), storage, dies, tests))
+
+
+class TestBlockWriter:
+    def __init__(self, db_name, storage="npy", directory=None):
+        """
+        Args:
+        db_name [string]: database holding the test_blocks catalog
+        storage [string]: "npy" or "npz"
+        directory [string]: block directory, defaults to store_dir(db_name)
+        """
+        if storage not in FORMATS:
+            raise ValueError(f"Unknown test storage {storage!r}, expected one of {FORMATS}")
+        self._db_dir = os.path.dirname(os.path.abspath(db_name))
+        self._directory = directory or store_dir(db_name)
+        self._storage = storage
+        self._mid = None
+        self._chunks = []
+        self._appending = False # The stored block already holds earlier results of this load
+
+    def start(self, mid, appending=False):
+        """
+        Start collecting the test results of a wafer.
+
+        Args:
+        appending [bool]: the stored block holds earlier results of the same load, e.g. when it resumes
+        """
+        self._mid = mid
+        self._chunks = []
+        self._appending = appending
+
+    def add(self, die_ids, tests):
+        """
+        Args:
+        die_ids [numpy.ndarray]: DieID of every test result
+        tests [numpy.ndarray]: BatchDecoder.TEST_RESULT_DTYPE test results
+        """
+        if self._mid is not None and len(tests):
+            self._chunks.append((die_ids, tests))
+
+    def drop_dies(self, die_ids):
+        """ Drop the collected results of dies that are written again. """
+        chunks = []
+        for ids, tests in self._chunks:
+            keep = ~np.isin(ids, die_ids)
+            chunks.append((ids[keep], tests[keep]))
+        self._chunks = chunks
+
+    def discard(self):
+        """ Drop the results collected for the current wafer. """
+        self._mid = None
+        self._chunks = []
+        self._appending = False
+
+    def write(self, cursor, test_filter=None, merged_dies=None, final=True):
+        """
+        Write the current wafer's block and its catalog row. A checkpoint writes what was
+        collected so far (final=False); the results collected next are appended to the block.
+
+        Args:
+        cursor [sqlite3.Cursor]: cursor of the loader's transaction
+        test_filter [tuple]: tests selected by the parser, stored results of the
+                             other tests are kept; an empty tuple keeps the block as is
+        merged_dies [set]: DieIDs written by a retest merge, stored results of the
+                           other dies are kept
+        final [bool]: last write of the wafer
+        """
+        mid, chunks, appending = self._mid, self._chunks, self._appending
+        if final:
+            self.discard()
+        else:
+            self._chunks, self._appending = [], True
+        if mid is None or test_filter == () or (appending and not chunks):
+            return
+
+        columns = {name: np.concatenate([tests[name] if name != "DieID" else die_ids for die_ids, tests in chunks]).astype(dtype)
+                   if chunks else np.empty(0, dtype) for name, dtype in COLUMNS.items()}
+
+        # Keep the stored results of the tests and dies that were not reloaded
+        path = _block_path(self._directory, mid, self._storage)
+        row = cursor.execute("SELECT Path, Format FROM test_blocks WHERE MasterID = ?", (mid,)).fetchone()
+        if (test_filter is not None or merged_dies is not None or appending) and row:
+            stored = _load(os.path.join(self._db_dir, row[0]), row[1], mmap_mode=None)
+            replaced = np.ones(len(stored["DieID"]), dtype=bool)
+            if test_filter is not None:
+                replaced &= np.isin(stored["TestNumber"], test_filter)
+            if appending:
+                # Earlier results of this load are kept, dies written again are replaced
+                replaced &= np.isin(stored["DieID"], columns["DieID"])
+            elif merged_dies is not None:
+                replaced &= np.isin(stored["DieID"], np.fromiter(merged_dies, dtype=np.int64, count=len(merged_dies)))
+            keep = ~replaced
+            columns = {name: np.concatenate([stored[name][keep], column]) for name, column in columns.items()}
+
+        columns = _index(columns)
+
+        os.makedirs(self._directory, exist_ok=True)
+        _save(path, self._storage, columns)
+        # Remove the block of a previous load stored in the other format
+        if row and row[1] != self._storage:
+            _remove(os.path.join(self._db_dir, row[0]))
+
+        cursor.execute("INSERT OR REPLACE INTO test_blocks (MasterID, Path, Format, Dies, Tests) VALUES (?, ?, ?, ?, ?)",
+                       (mid, os.path.relpath(path, self._db_dir), self._storage,
+                        len(np.unique(columns["DieID"])), len(columns["TestIndex"])))
+
+
+def read_block(db_name, mid):
+    """
+    Args:
+    db_name [string]
+    mid [int]: MasterID
+
+    Returns:
+    block [dict]: column name -> array, memory-mapped for "npy" blocks
+    """
+    # Blocks of a sharded wafer are stored with its shard
+    import ShardRouter
+    db_name = ShardRouter.get_router(db_name).path(mid)
+    with sqlite3.connect(db_name) as conn:
+        row = conn.execute("SELECT Path, Format FROM test_blocks WHERE MasterID = ?", (mid,)).fetchone()
+    if not row:
+        raise KeyError(f"No test block stored for MasterID {mid}")
+    return _load(os.path.join(os.path.dirname(os.path.abspath(db_name)), row[0]), row[1])
+
+
+def read_test(db_name, mid, test_number, column="Result"):
+    """
+    Returns one test of a wafer without reading the other tests.
+
+    Returns:
+    die_ids [numpy.ndarray]: DieID of the dies that ran the test
+    values [numpy.ndarray]: the requested column for those dies
+    """
+    block = read_block(db_name, mid)
+    index = np.searchsorted(block["TestIndex"], test_number)
+    if index == len(block["TestIndex"]) or block["TestIndex"][index] != test_number:
+        return np.empty(0, COLUMNS["DieID"]), np.empty(0, COLUMNS[column])
+    start, end = int(block["TestStarts"][index]), int(block["TestStarts"][index + 1])
+    return block["DieID"][start:end], block[column][start:end]
+
+
+def test_matrix(db_name, mid, column="Result"):
+    """
+    Returns a die x test matrix of one column, NaN where a die has no result for a test.
+
+    Returns:
+    die_ids [numpy.ndarray]: row labels
+    test_numbers [numpy.ndarray]: column labels
+    matrix [numpy.ndarray]: float32 array of shape (len(die_ids), len(test_numbers))
+    """
+    block = read_block(db_name, mid)
+    die_ids = np.unique(block["DieID"])
+    test_numbers = np.asarray(block["TestIndex"])
+    matrix = np.full((len(die_ids), len(test_numbers)), np.nan, dtype=np.float32)
+    rows = np.searchsorted(die_ids, block["DieID"])
+    columns = np.repeat(np.arange(len(test_numbers)), np.diff(block["TestStarts"].astype(np.int64)))
+    matrix[rows, columns] = block[column]
+    return die_ids, test_numbers, matrix
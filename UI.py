@@ -9,6 +9,8 @@ from wafer_map.wm_constants import DataType
 from PIL import Image
 import WaferMap
 import Model 
+import ModelCache
+import ShardRouter
 import time
 
 class WaferPlotPanel(wx.Panel):
@@ -61,13 +63,11 @@ class WaferPlotPanel(wx.Panel):
         except:
             print("First plotting attempt")
             
-        # Create a new connection to avoid thread-safty issues
-        conn = sqlite3.connect(db_name)
-        cursor = conn.cursor()
+        # Queries are routed to the wafer's shard, the router serializes threads
+        router = ShardRouter.get_router(db_name)
     
         #retrive wafer information
-        cursor.execute(f'SELECT * FROM wafer_config WHERE MasterID = ?', (mid,))
-        wafer_tuple = cursor.fetchall()[0]
+        wafer_tuple = router.query(mid, 'SELECT * FROM {shard}.wafer_config WHERE MasterID = ?', (mid,))[0]
         
 
         #create a WaferInfo instance
@@ -79,8 +79,7 @@ class WaferPlotPanel(wx.Panel):
             40,  # Flat Exclusion
         )
        #retrive data before prediction
-        cursor.execute(f'SELECT DieX, DieY, HardwareBin, passing FROM die_info WHERE MasterID = ?', (mid,))
-        num_xyd = cursor.fetchall()
+        num_xyd = router.query(mid, 'SELECT DieX, DieY, HardwareBin, passing FROM {shard}.die_info WHERE MasterID = ?', (mid,))
   
         xyd = [(_x, _y, (str(_bin)+(" / PASS" if _passing == 1 else " / FAIL"))) for _x, _y, _bin, _passing in num_xyd]
         self.left_panel = wm_core.WaferMapPanel(
@@ -93,8 +92,7 @@ class WaferPlotPanel(wx.Panel):
         
         
         #retrive data before prediction
-        cursor.execute(f'SELECT DieX, DieY, HardwareBin, passing FROM temporary_data WHERE MasterID = ?', (mid,))
-        num_xyd = cursor.fetchall()
+        num_xyd = router.query(mid, 'SELECT DieX, DieY, HardwareBin, passing FROM {shard}.temporary_data WHERE MasterID = ?', (mid,))
     
         xyd = [(_x, _y, (str(_bin)+(" / PASS" if _passing == 1 else " / FAIL"))) for _x, _y, _bin, _passing in num_xyd]
         self.right_panel = wm_core.WaferMapPanel(
@@ -105,9 +103,6 @@ class WaferPlotPanel(wx.Panel):
             show_die_gridlines=False,
         )
         
-        cursor.close()
-        conn.close()
-        
         self.center_l.Bind(wx.EVT_BUTTON, self.on_center_l_click)
         self.center_r.Bind(wx.EVT_BUTTON, self.on_center_r_click)
 
@@ -204,7 +199,7 @@ class ModelPanel(wx.Panel):
         
         # Inputs
         lbl2 = wx.StaticText(self, label='Model inputs (Optional)')
-        self.kernel_txt = wx.TextCtrl(self)
+        self.kernel_txt = wx.ComboBox(self, choices=list(Model.KERNELS))  # exact OCSVM kernels and approximate detectors
         self.gamma_txt = wx.TextCtrl(self)
         self.nu_txt = wx.TextCtrl(self)
         
@@ -419,18 +414,13 @@ class SearchBarPanel(wx.Panel):
         self.SetSizer(hbox)
 
     def on_search(self, event):
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
         try:
             if self.search_ctrl.GetValue().strip():
-                cursor.execute('SELECT * FROM temporary_data WHERE MasterID = ? and DieID = ?',  (self.parent.mid, int(self.search_ctrl.GetValue().strip())))
-                data = cursor.fetchall()[0]
+                data = ShardRouter.get_router(self.db_name).query(self.parent.mid, 'SELECT * FROM {shard}.temporary_data WHERE MasterID = ? and DieID = ?',
+                                                                 (self.parent.mid, int(self.search_ctrl.GetValue().strip())))[0]
                 self.parent.main_panel.die_info_pan.Update(data) 
         except:
             wx.MessageBox(f"Die ID must be an INTEGER, and EXIST within wafer","Error", wx.ICON_ERROR)
-        finally:
-            cursor.close()    
-            conn.close()
       
 class PredictPanel(wx.Panel):
     def __init__(self, parent) -> None:
@@ -450,6 +440,10 @@ class WaferMapFrame(wx.Frame):
     def __init__(self):
         super().__init__(parent=None, title='Wafer Map Towards Die Yield Enhancement')
         self._db_name = "database.db"
+        self.load_error = None # Message shown once a load that gave no wafer finishes
+
+        # Predictions already made, kept across sessions in database.models/
+        self.model_cache = ModelCache.ModelCache(disk_store=True)
 
         # Panels
         self.predict_panel = PredictPanel(self)
@@ -520,7 +514,7 @@ class WaferMapFrame(wx.Frame):
 
     def on_open_folder(self, event):
         title = "Choose STDF File"
-        dlg = wx.FileDialog(self, title, wildcard="STDF files (*.stdf)|*.stdf",
+        dlg = wx.FileDialog(self, title, wildcard="STDF files (*.stdf;*.stdf.gz;*.stdf.bz2;*.stdf.xz)|*.stdf;*.stdf.gz;*.stdf.bz2;*.stdf.xz",
                        style=wx.FD_OPEN | wx.FD_FILE_MUST_EXIST)
         if dlg.ShowModal() == wx.ID_OK:
             self.save_file_dir(dlg.GetPath())
@@ -565,6 +559,13 @@ class WaferMapFrame(wx.Frame):
                 self.status_bar.SetStatusText("Done")
                 self.predict_panel.predict_btn.Enable()
                 self.MenuBar.Enable(self.open_file_menu_item.GetId(), True)
+
+                # Nothing was loaded, there is no wafer to display
+                if self.load_error:
+                    self.status_bar.SetStatusText("Load failed")
+                    wx.MessageBox(self.load_error, "Error", wx.ICON_ERROR)
+                    self.load_error = None
+                    return
             
                 try:
                     self.main_panel.model_pan.outlier_txt.SetValue(str(self.num_ouliers))
@@ -585,7 +586,12 @@ class WaferMapFrame(wx.Frame):
             self.predict_panel.predict_btn.Disable()
         
         
-            self.mid, self.lid,self.wid = WaferMap.main(self.file_path, self._db_name)
+            # Files may hold several wafers, the first one is displayed
+            IDs = WaferMap.main(self.file_path, self._db_name)
+            if not IDs:
+                self.load_error = f"No wafer was loaded from {self.file_path}: {WaferMap.ERROR or 'the file holds no wafer'}"
+                return
+            self.mid, self.lid,self.wid = IDs[0]
 
             self.predict()
             
@@ -630,14 +636,16 @@ class WaferMapFrame(wx.Frame):
             if self.main_panel.model_pan.nu_txt.GetValue().strip():
                 nu = float(self.main_panel.model_pan.nu_txt.GetValue().strip())
                 print('nu ', nu)
+
+            # e.g. nu above 0.5 with an IsolationForest, reported before any work is done
+            Model.check_detector(kernel, nu)
             
-            
-            self.num_ouliers, self.count_df, self.figure_list = Model.main(self._db_name, self.mid,kernel = kernel, gamma = gamma, nu = nu)            
+            self.num_ouliers, self.count_df, self.figure_list = self.model_cache.main(self._db_name, self.mid,kernel = kernel, gamma = gamma, nu = nu)            
 
-        except:
+        except Exception as e:
             kernel, gamma, nu = ('rbf', 'scale', 0.06)
-            wx.MessageBox(f"Model inputs unvalid. Prediction will happen with default values (kernael = {kernel} , gamma = {gamma} , nu = {nu}.","Error", wx.ICON_ERROR)
-            self.num_ouliers, self.count_df, self.figure_list = Model.main(self._db_name, self.mid,kernel = kernel, gamma = gamma, nu = nu)
+            wx.MessageBox(f"Model inputs unvalid: {e}\nPrediction will happen with default values (kernael = {kernel} , gamma = {gamma} , nu = {nu}.","Error", wx.ICON_ERROR)
+            self.num_ouliers, self.count_df, self.figure_list = self.model_cache.main(self._db_name, self.mid,kernel = kernel, gamma = gamma, nu = nu)
                 
     def save_file_dir(self, file_path):
         self.file_path = file_path
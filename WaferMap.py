@@ -1,21 +1,37 @@
 from threading import Thread, Lock
 from Loader import Loader
 from Parser import Parse
-from multiprocessing import Queue
+from Channel import BatchChannel
+from SharedMemoryChannel import SharedMemoryChannel
+from multiprocessing import Process
+from RecordIndex import fingerprint
+import IngestLedger
+import contextlib
+import sqlite3
 import threading
 import time
 
-# Global variable to hold the value of the all identifiers
-IDs = tuple()
+# Global variable to hold the identifiers of every wafer loaded: [(MasterID, LotID, WaferID), ...]
+IDs = list()
 
-def parse_file(file_name, record_queue):
+# Global flag set when the last insert_file loaded the whole file without error
+COMPLETE = False
+
+# Global flag set when the last main call found the file already loaded and unchanged
+UNCHANGED = False
+
+# Global message of the parse or load error that ended the last load early, None otherwise
+ERROR = None
+
+def parse_file(file_name, record_queue, parser_options=None):
     """
     Call read method to read and parse STDF files using a ParseFile instance 
     returned from create_parser method.
     
     Args:
     file_name [string]: file path
-    record_queue [Queue object]
+    record_queue [BatchChannel or SharedMemoryChannel]
+    parser_options [dict]: keyword arguments forwarded to create_parser (e.g. {"scanner": "mmap"})
     """
     
     start_time = time.time()
@@ -25,63 +41,151 @@ def parse_file(file_name, record_queue):
         parseFile = Parse()
         
         # The method create_parser returns a ParseFile instance
-        parseFile = parseFile.create_parser(file_name, record_queue)
+        parseFile = parseFile.create_parser(file_name, record_queue, **(parser_options or {}))
         
         # Parse STDF file
         parseFile.read()
         
     except Exception as e:
         print(f'Corrupted or incomplete:  {e}')
+        # Tell the loader the stream is incomplete
+        record_queue.put(("parse_error", str(e)))
+    finally:
+        # End of stream for the loader, also after a failure
+        record_queue.close()
     print(f"parse_file() took {time.time() - start_time} seconds")
 
         
     
 
-def insert_file(parse_thread, record_queue, db_name):
+def insert_file(record_queue, db_name, test_filter=None, loader_options=None, write_lock=None):
     """
     Pop data from queue then insert into the database via insert_data function from Loader class.
     
     Args:
-    parse_thread [Thread]
-    record_queue [Queue object]
+    record_queue [BatchChannel or SharedMemoryChannel]
     db_name [string]
+    test_filter [set]: test numbers kept by the parser, None for all tests
+    loader_options [dict]: keyword arguments forwarded to Loader (e.g. {"bulk": True})
+    write_lock [Lock]: held while loading, the parser keeps filling the channel meanwhile
     """
-    global IDs
+    global IDs, COMPLETE, ERROR
     start_time = time.time()
+    COMPLETE = False
 
     # Reset Loader instance into None to avoid issues at corrupted files
     Loader.reset_instance()
     
     try:
-        # Create a Loader instance
-        loader = Loader(parse_thread, record_queue, db_name)
-        
-        # Insert data
-        loader.insert_data()
+        with write_lock or contextlib.nullcontext():
+            # Create a Loader instance
+            loader = Loader(record_queue, db_name, test_filter=test_filter, **(loader_options or {}))
+
+            # Insert data
+            IDs = loader.insert_data()
+            COMPLETE = loader.complete
+            ERROR = loader.error
         
     except Exception as e:
         print(f'Corrupted or incomplete:  {e}')
+        ERROR = str(e)
+    finally:
+        # Never leave the parser blocked on a full channel
+        record_queue.cancel()
 
     print(f"insert_file() took {time.time() - start_time} seconds")
 
-def main(file_name, db_name):
-        
-    global IDs
+def main(file_name, db_name, parser_options=None, loader_options=None, channel_options=None, execution="thread", force=False, resume=True, write_lock=None):
+    """
+    Parse an STDF file and load it into the database, one committed unit per wafer.
+
+    Args:
+    file_name [string]: file path
+    db_name [string]: database path
+    parser_options [dict]: parser settings, e.g. {"scanner": "mmap"} to benchmark the memory-mapped scanner,
+                           {"skip_ptr": True} for bin maps only, {"test_filter": {...}} for a subset of tests
+                           or {"follow": True} to load a file while the tester is still writing it;
+                           {"checkpoint_bytes": 1 << 26} commits about every 64 MiB so a failed load can resume
+    loader_options [dict]: loader settings, e.g. {"bulk": True} for batched inserts with ingest PRAGMAs,
+                           {"test_storage": "npy"} for columnar test result blocks (see TestStore),
+                           {"merge": True} to merge a retest file into the stored wafer
+    channel_options [dict]: parser to loader handoff settings, {"maxsize": batches, "batch_size": records},
+                            or {"slots": blocks, "slot_size": bytes} in process execution
+    execution [string]: "thread" parses in a thread of this process, "process" parses in its own process
+                        and hands dies to the loader through shared memory blocks
+    force [bool]: reload the file even if the ingest ledger shows it is already loaded and unchanged
+    resume [bool]: continue an interrupted checkpointed load of the file from its last checkpoint
+    write_lock [Lock]: serializes the database writes of concurrent loads into the same database
+                       (see IngestDaemon), parsing is not held back by it
+
+    Returns:
+    IDs [list]: (MasterID, LotID, WaferID) of every wafer in the file
+    """
+    global IDs, UNCHANGED, ERROR
+    IDs = list()
+    UNCHANGED = False
+    ERROR = None
+
+    # Carry the parser's test selection through to the loader
+    parser_options = parser_options or {}
+    test_filter = set() if parser_options.get("skip_ptr") else parser_options.get("test_filter")
+
+    # Skip files that are already loaded and unchanged
+    try:
+        file_fingerprint = fingerprint(file_name)
+    except OSError:
+        file_fingerprint = None
+    content = IngestLedger.content_key(test_filter, (loader_options or {}).get("test_storage"), (loader_options or {}).get("merge", False))
+    if file_fingerprint and not force:
+        try:
+            # A concurrent load into the same database may hold its write lock
+            with write_lock or contextlib.nullcontext():
+                loaded = IngestLedger.lookup(db_name, file_name, file_fingerprint, content)
+        except sqlite3.OperationalError as e:
+            print(f"Ingest ledger unavailable ({e}), loading {file_name}")
+            loaded = None
+        if loaded:
+            print(f"{file_name} is unchanged since it was loaded, using wafers {[wafer[0] for wafer in loaded]}")
+            UNCHANGED = True
+            return loaded
+
+    # Record checkpoints with the rows they commit, and resume from the last one
+    if file_fingerprint and (parser_options.get("checkpoint_bytes") or parser_options.get("follow")):
+        loader_options = dict(loader_options or {}, source=IngestLedger.source(file_name))
+        saved = None
+        if resume and not force:
+            try:
+                with write_lock or contextlib.nullcontext():
+                    saved = IngestLedger.load_checkpoint(db_name, file_name)
+            except sqlite3.OperationalError as e:
+                print(f"Checkpoint unavailable ({e}), loading {file_name} from the start")
+        if saved:
+            parser_options = dict(parser_options, resume=saved[0])
+            loader_options["resume"] = saved[1]
+            print(f"Resuming {file_name} at byte {saved[0]['offset']}")
     
-    # Instantiate a Queue
-    record_queue = Queue()
+    # Bounded channel between parser and loader
+    if execution == "process":
+        record_queue = SharedMemoryChannel(**(channel_options or {}))
+        parse_worker = Process
+    else:
+        record_queue = BatchChannel(**(channel_options or {}))
+        parse_worker = Thread
 
-    # Start parse_file in a new Thread
-    parse_thread = Thread(target=parse_file, args=(file_name, record_queue, ))
+    # Start parse_file in a new Thread or Process
+    parse_thread = parse_worker(target=parse_file, args=(file_name, record_queue, parser_options, ))
     
     # Insure no termination untill parsing is over
     parse_thread.daemon = False
     
     # Start parse_thread
     parse_thread.start()
+    if execution == "process":
+        # A parser process killed before closing the channel must not block the loader
+        record_queue.watch(parse_thread)
 
     # Start insert_file in a new Thread
-    insert_thread = Thread(target=insert_file, args=(parse_thread, record_queue, db_name, ))
+    insert_thread = Thread(target=insert_file, args=(record_queue, db_name, test_filter, loader_options, write_lock, ))
     
     # Insure no termination untill insertion is over
     insert_thread.daemon = False
@@ -92,6 +196,24 @@ def main(file_name, db_name):
     # Join threads to main_thread when excecution is over
     parse_thread.join()
     insert_thread.join()
+    print(f"channel metrics: {record_queue.metrics()}")
+    if execution == "process":
+        record_queue.release()
+
+    # A followed file grew while it was loaded
+    if parser_options.get("follow"):
+        try:
+            file_fingerprint = fingerprint(file_name)
+        except OSError:
+            file_fingerprint = None
+
+    # Remember complete loads only, a partial one is reloaded next time
+    if IDs and file_fingerprint:
+        with write_lock or contextlib.nullcontext():
+            if COMPLETE:
+                IngestLedger.record(db_name, file_name, file_fingerprint, IDs, content)
+            else:
+                IngestLedger.forget(db_name, file_name, IDs)
 
     #print("Done!")
     return IDs
@@ -0,0 +1,112 @@
+"""
+
+Shared fixtures: small synthetic STDF files and fresh databases.
+
+The STDF files hold a FAR, MIR and WCR, then per wafer a WIR, round wafers of
+dies tested four sites at a time (PIR, PTRs, PRR) and a WRR, and a final MRR.
+Every 7th test of a die is a short PTR without limits; about 10% of the dies fail.
+
+"""
+import os
+import sys
+import struct
+import random
+import sqlite3
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import Schema
+import ShardRouter
+from Loader import Loader
+
+
+def _record(record_type, sub_type, body):
+    return struct.pack('<HBB', len(body), record_type, sub_type) + body
+
+
+def _cn(text):
+    text = text.encode()
+    return bytes([len(text)]) + text
+
+
+def _ptr(test_num, site, flag, result, short=False):
+    body = struct.pack('<IBBBBf', test_num, 1, site, 0, flag, result)
+    if short:
+        return _record(15, 10, body + _cn('') + _cn(''))
+    return _record(15, 10, body + _cn(f'test{test_num}') + _cn('') + bytes(4) + struct.pack('<ff', 0.0, 1.0))
+
+
+def wafer_records(wafer_id, radius=6, tests=5, seed=1):
+    """
+    Records of one wafer, WIR to WRR.
+
+    Returns:
+    records [list]: bytes of every record
+    dies [int]: dies of the wafer
+    """
+    rng = random.Random(seed)
+    records = [_record(2, 10, struct.pack('<BBI', 1, 255, 0) + _cn(wafer_id))]
+    coords = [(x, y) for x in range(-radius, radius + 1) for y in range(-radius, radius + 1) if x * x + y * y <= radius * radius]
+    for i in range(0, len(coords), 4):
+        group = coords[i:i + 4]
+        records += [_record(5, 10, bytes([1, site])) for site in range(len(group))]
+        for test in range(tests):
+            records += [_ptr(1000 + test, site, rng.choice([0, 0, 0, 0x80]), rng.random(), short=test % 7 == 3)
+                        for site in range(len(group))]
+        for site, (x, y) in enumerate(group):
+            bad = rng.random() < 0.1
+            records.append(_record(5, 20, struct.pack('<BBBHHHhh', 1, site, 8 if bad else 0, tests, 2 if bad else 1, 2 if bad else 1, x, y)
+                                   + struct.pack('<I', 0) + b'\x00\x00'))
+    records.append(_record(2, 20, struct.pack('<BBII', 1, 255, 0, 0) + _cn(wafer_id)))
+    return records, len(coords)
+
+
+def stdf_bytes(lot_id='LOT1', wafers=('W1',), radius=6, tests=5):
+    """ A whole STDF file with the given wafers. """
+    records = [_record(0, 10, bytes([2, 4])),
+               _record(1, 10, struct.pack('<IIB', 0, 0, 1) + b'PNN' + struct.pack('<H', 0) + b' ' + _cn(lot_id)),
+               _record(2, 30, struct.pack('<fffB', 200.0, 5.0, 4.0, 3) + b'D' + struct.pack('<hh', 0, 0) + b'RU')]
+    for seed, wafer_id in enumerate(wafers, 1):
+        records += wafer_records(wafer_id, radius, tests, seed)[0]
+    records.append(_record(1, 20, struct.pack('<I', 0)))
+    return b''.join(records)
+
+
+@pytest.fixture(autouse=True)
+def _isolated(tmp_path, monkeypatch):
+    # ParseFile logs next to the working directory, Loader is a per-process singleton
+    # and routers are shared per database
+    monkeypatch.chdir(tmp_path)
+    Loader.reset_instance()
+    yield
+    Loader.reset_instance()
+    ShardRouter.close_router()
+
+
+@pytest.fixture
+def make_stdf(tmp_path):
+    """ Write an STDF file into the test directory, see stdf_bytes for the arguments. """
+    def make(name='wafers.stdf', **kwargs):
+        path = tmp_path / name
+        path.write_bytes(stdf_bytes(**kwargs))
+        return str(path)
+    return make
+
+
+@pytest.fixture
+def db_name(tmp_path):
+    """ Path of an empty database at the current schema. """
+    path = str(tmp_path / "database.db")
+    Schema.migrate(path)
+    return path
+
+
+def rows(db_name, query, args=()):
+    """ All rows of a query, in a stable order. """
+    conn = sqlite3.connect(db_name)
+    try:
+        return sorted(conn.execute(query, args).fetchall(), key=repr)
+    finally:
+        conn.close()
@@ -0,0 +1,75 @@
+import sqlite3
+import threading
+
+import pytest
+
+import Schema
+import WaferMap
+import IngestLedger
+from IngestDaemon import IngestDaemon
+
+from conftest import rows
+
+
+def _quick_busy_timeout(monkeypatch):
+    # Give up on a locked database at once instead of after sqlite's 5 seconds
+    def connect(db_name):
+        conn = sqlite3.connect(db_name, timeout=0.05)
+        Schema.migrate(conn)
+        return conn
+    monkeypatch.setattr(IngestLedger, "_connect", connect)
+
+
+def test_ledger_lookup_waits_for_a_concurrent_load(monkeypatch, make_stdf, db_name):
+    file_name = make_stdf()
+    IDs = WaferMap.main(file_name, db_name)
+    _quick_busy_timeout(monkeypatch)
+
+    # Another job of the daemon is writing: it holds the write lock and an exclusive transaction
+    write_lock = threading.Lock()
+    write_lock.acquire()
+    writer = sqlite3.connect(db_name, check_same_thread=False)
+    writer.execute("BEGIN EXCLUSIVE")
+
+    def finish():
+        writer.rollback()
+        writer.close()
+        write_lock.release()
+    timer = threading.Timer(0.3, finish)
+    timer.start()
+    try:
+        assert WaferMap.main(file_name, db_name, write_lock=write_lock) == IDs
+        assert WaferMap.UNCHANGED
+    finally:
+        timer.join()
+
+
+@pytest.mark.parametrize("resume", [False, True])
+def test_locked_ledger_falls_back_to_a_load(monkeypatch, make_stdf, db_name, resume):
+    file_name = make_stdf()
+    WaferMap.main(file_name, db_name)
+
+    def locked(*args):
+        raise sqlite3.OperationalError("database is locked")
+    monkeypatch.setattr(IngestLedger, "lookup", locked)
+    monkeypatch.setattr(IngestLedger, "load_checkpoint", locked)
+
+    IDs = WaferMap.main(file_name, db_name, parser_options={"checkpoint_bytes": 4000}, resume=resume)
+    assert IDs and WaferMap.COMPLETE and not WaferMap.UNCHANGED
+
+
+def test_daemon_loads_a_folder_into_one_database(tmp_path, make_stdf, db_name):
+    folder = tmp_path / "drop"
+    folder.mkdir()
+    for i in range(4):
+        (folder / f"lot{i}.stdf").write_bytes(open(make_stdf(f"lot{i}.stdf", lot_id=f"LOT{i}", wafers=('W1', 'W2')), "rb").read())
+
+    options = dict(workers=2, poll_interval=0.05, settle=0.05, report_interval=60.0)
+    status = IngestDaemon({str(folder): db_name}, **options).run(until_idle=True)
+    assert status["states"]["done"] == 4 and status["states"]["failed"] == 0
+    assert rows(db_name, "SELECT COUNT(*) FROM wafer_info") == [(8,)]
+
+    # A restart finds every file in the ingest ledger
+    status = IngestDaemon({str(folder): db_name}, **options).run(until_idle=True)
+    assert status["states"]["unchanged"] == 4
+
@@ -0,0 +1,45 @@
+import sqlite3
+
+import pytest
+
+import WaferMap
+from Channel import BatchChannel
+from Loader import Loader
+
+from conftest import rows
+
+TABLES = ("wafer_config", "die_info", "test_results")
+
+
+def _dump(db_name):
+    return {table: rows(db_name, f"SELECT * FROM {table}") for table in TABLES}
+
+
+@pytest.mark.parametrize("loader_options", [{"bulk": True}, {"bulk": True, "batch_size": 7}])
+def test_bulk_load_matches_row_by_row_load(tmp_path, make_stdf, loader_options):
+    file_name = make_stdf(wafers=('W1', 'W2'))
+    row_db, bulk_db = str(tmp_path / "rows.db"), str(tmp_path / "bulk.db")
+    WaferMap.main(file_name, row_db)
+    WaferMap.main(file_name, bulk_db, loader_options=loader_options)
+    assert WaferMap.COMPLETE
+    assert _dump(bulk_db) == _dump(row_db)
+
+
+@pytest.mark.parametrize("bulk", [False, True])
+def test_load_error_closes_connections(db_name, bulk):
+    channel = BatchChannel()
+    channel.put(("wafer_info", "LOT1", "W1"))
+    channel.put(("die_info", None))
+    channel.close()
+
+    loader = Loader(channel, db_name, bulk=bulk)
+    loader.insert_data()
+    assert not loader.complete and loader.error
+    with pytest.raises(sqlite3.ProgrammingError):
+        loader._conn.execute("SELECT 1")
+
+    # No lock is left behind on the database
+    conn = sqlite3.connect(db_name, timeout=0)
+    conn.execute("BEGIN EXCLUSIVE")
+    conn.rollback()
+    conn.close()
@@ -0,0 +1,56 @@
+import sqlite3
+
+import numpy as np
+import pytest
+
+import Model
+import ModelBenchmark
+
+
+@pytest.fixture
+def wafer(db_name):
+    conn = sqlite3.connect(db_name)
+    mid = ModelBenchmark.synthetic_wafer(conn, 2000, np.random.default_rng(0))
+    conn.close()
+    return db_name, mid
+
+
+@pytest.mark.parametrize("kernel", Model.KERNELS)
+def test_every_detector_fits_and_predicts(kernel):
+    features = np.random.default_rng(0).random((200, 2))
+    detector = Model.make_detector(kernel, gamma=1.0, nu=0.1, samples=len(features))
+    predictions = detector.fit(features).predict(features)
+    assert set(np.unique(predictions)) <= {-1, 1}
+    assert (predictions == -1).any()
+
+
+@pytest.mark.parametrize("nu", [0.6, 1.0])
+def test_iforest_rejects_nu_above_half(nu):
+    with pytest.raises(ValueError, match="at most 0.5 with 'iforest'"):
+        Model.make_detector('iforest', nu=nu)
+    with pytest.raises(ValueError, match="at most 0.5"):
+        Model.check_detector('iforest', nu)
+    # The One-Class SVM takes any nu up to 1
+    Model.check_detector('rbf', nu)
+    Model.check_detector('nystroem', nu)
+
+
+@pytest.mark.parametrize("kernel, nu", [('unknown', 0.1), ('rbf', 0.0), ('rbf', 1.5)])
+def test_check_detector_rejects_invalid_inputs(kernel, nu):
+    with pytest.raises(ValueError):
+        Model.check_detector(kernel, nu)
+
+
+def test_iforest_with_nu_above_half_fails_before_fitting(wafer):
+    db_name, mid = wafer
+    with pytest.raises(ValueError, match="at most 0.5"):
+        Model.main(db_name, mid, kernel='iforest', nu=0.7)
+    assert Model.main(db_name, mid, kernel='iforest', nu=0.5)[0] > 0
+
+
+def test_benchmark_compares_detectors_to_the_exact_svm(wafer):
+    db_name, mid = wafer
+    results = {result['kernel']: result for result in ModelBenchmark.benchmark(db_name, mid, ['rbf', 'nystroem', 'iforest'])}
+    assert results['rbf']['agreement'] == 1.0
+    assert all(0.5 < result['agreement'] <= 1.0 for result in results.values())
+    assert all(result['dies'] == results['rbf']['dies'] for result in results.values())
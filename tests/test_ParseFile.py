@@ -0,0 +1,78 @@
+import os
+import queue
+import threading
+
+import pytest
+
+from ParseFile import ParseFile
+
+
+def _records(record_queue):
+    return [record_queue.get() for _ in range(record_queue.qsize())]
+
+
+def _follow(file_name, **options):
+    record_queue = queue.SimpleQueue()
+    ParseFile(file_name, record_queue, follow=True, poll_interval=0.01, follow_timeout=1.0, **options).read()
+    return _records(record_queue)
+
+
+@pytest.fixture
+def stdf_file(make_stdf):
+    return make_stdf(wafers=('W1', 'W2'), radius=10)
+
+
+@pytest.mark.parametrize("chunk_size, checkpoint_bytes", [(1000, 4000), (8000, 1000), (1 << 23, 3000)])
+def test_follow_checkpoints_every_checkpoint_bytes(monkeypatch, stdf_file, chunk_size, checkpoint_bytes):
+    monkeypatch.setattr(ParseFile, "CHUNK_SIZE", chunk_size)
+    size = os.path.getsize(stdf_file)
+    checkpoints = [record for record in _follow(stdf_file, checkpoint_bytes=checkpoint_bytes) if record[0] == "checkpoint"]
+
+    # Every checkpoint but the one of the reader catching up is taken with no part open, so it can resume
+    offsets = [0] + [state["offset"] for _, _, state in checkpoints[:-1]]
+    gaps = [b - a for a, b in zip(offsets, offsets[1:])]
+    # A checkpoint is taken at the last record boundary before the interval, or waits for the
+    # parts open there to close, at most one group of sites
+    assert all(checkpoint_bytes - 100 <= gap < checkpoint_bytes + 2000 for gap in gaps)
+    assert len(checkpoints) >= size // (checkpoint_bytes + 2000)
+
+
+def test_follow_without_checkpoint_bytes_checkpoints_when_caught_up(stdf_file):
+    checkpoints = [record for record in _follow(stdf_file) if record[0] == "checkpoint"]
+    assert len(checkpoints) == 1
+
+
+def test_follow_reads_a_growing_file(tmp_path, stdf_file):
+    data = open(stdf_file, "rb").read()
+    growing = tmp_path / "growing.stdf"
+    growing.write_bytes(data[:len(data) // 3 + 1])
+
+    def write_rest():
+        with open(growing, "ab") as f:
+            f.write(data[len(data) // 3 + 1:])
+    writer = threading.Timer(0.2, write_rest)
+    writer.start()
+    records = _follow(str(growing))
+    writer.join()
+
+    dies = [record[1] for record in records if record[0] == "die_info"]
+    expected = [record[1] for record in (_records_of(stdf_file)) if record[0] == "die_info"]
+    assert [die.get_info() for die in dies] == [die.get_info() for die in expected]
+    assert sum(record[0] == "checkpoint" for record in records) >= 2
+
+
+def _records_of(file_name):
+    record_queue = queue.SimpleQueue()
+    ParseFile(file_name, record_queue).read()
+    return _records(record_queue)
+
+
+def test_follow_checkpoints_resume_where_they_were_taken(stdf_file):
+    full = _follow(stdf_file, checkpoint_bytes=5000)
+    dies = [(record[1].get_number(), record[1].get_info()) for record in full if record[0] == "die_info"]
+    states = [record[2] for record in full if record[0] == "checkpoint" and record[2]]
+
+    for state in states[1::4]:
+        resumed = _follow(stdf_file, checkpoint_bytes=5000, resume=state)
+        rest = [(record[1].get_number(), record[1].get_info()) for record in resumed if record[0] == "die_info"]
+        assert rest == dies[state["dies_counter"]:]
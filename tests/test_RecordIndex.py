@@ -0,0 +1,66 @@
+import queue
+
+import pytest
+
+from RecordIndex import RecordIndex
+
+
+def _dies(record_queue):
+    dies = {}
+    while not record_queue.empty():
+        record = record_queue.get()
+        if record[0] == "die_info":
+            die = record[1]
+            dies[die.get_number()] = (die.get_info(), sorted(result[0] for result in die.get_test_results()))
+    return dies
+
+
+@pytest.fixture
+def index(make_stdf):
+    return RecordIndex.load(make_stdf(wafers=('W1', 'W2')))
+
+
+def test_sidecar_is_reused_until_the_file_changes(index):
+    assert RecordIndex.load(index.file_name, rebuild=False) is not None
+    with open(index.file_name, "ab") as f:
+        f.write(b"\x00")
+    assert RecordIndex.load(index.file_name, rebuild=False) is None
+
+
+def test_find_die_per_wafer(index):
+    assert len(index.offsets("WIR")) == 2
+    first, second = index.find_die(0, 0, wafer=0), index.find_die(0, 0, wafer=1)
+    assert len(first) == len(second) == 1
+    assert set(index.find_die(0, 0)) == {first[0], second[0]}
+
+
+def test_read_dies_matches_full_parse(index):
+    numbers = [1, 2, 7, len(index.parts)]
+    record_queue = queue.SimpleQueue()
+    index.read_dies(numbers, record_queue)
+    dies = _dies(record_queue)
+    assert sorted(dies) == numbers
+    assert all(tests == [1000, 1001, 1002, 1003, 1004] for _, tests in dies.values())
+
+
+@pytest.mark.parametrize("ptr_batch", [False, True])
+def test_read_dies_with_skip_ptr(index, ptr_batch):
+    record_queue = queue.SimpleQueue()
+    index.read_dies([3, 4, 5], record_queue, skip_ptr=True, ptr_batch=ptr_batch)
+    dies = _dies(record_queue)
+    assert sorted(dies) == [3, 4, 5]
+    assert all(info is not None and tests == [] for info, tests in dies.values())
+
+
+def test_read_dies_with_test_filter(index):
+    record_queue = queue.SimpleQueue()
+    index.read_dies([3, 4], record_queue, test_filter={1001, 1003})
+    assert all(tests == [1001, 1003] for _, tests in _dies(record_queue).values())
+
+
+def test_read_dies_into_die_store(index):
+    record_queue = queue.SimpleQueue()
+    index.read_dies([1, 2, 3], record_queue, die_store=True, skip_ptr=True)
+    records = [record_queue.get() for _ in range(record_queue.qsize())]
+    stores = [record[1] for record in records if record[0] == "die_store"]
+    assert sum(len(store) for store in stores) == 3
@@ -0,0 +1,75 @@
+import queue
+import sqlite3
+import threading
+
+import pytest
+
+import WaferMap
+import ShardRouter
+import IngestDaemon
+from Channel import BatchChannel
+from Loader import Loader
+
+from conftest import rows
+
+
+@pytest.fixture
+def catalog(db_name):
+    router = ShardRouter.ShardRouter(db_name)
+    router.enable("lot")
+    router.close()
+    return db_name
+
+
+def test_wafers_are_loaded_into_their_lot_shard(make_stdf, catalog):
+    first = WaferMap.main(make_stdf("lot1.stdf", lot_id="LOT1", wafers=('W1', 'W2')), catalog)
+    second = WaferMap.main(make_stdf("lot2.stdf", lot_id="LOT2"), catalog)
+
+    router = ShardRouter.ShardRouter(catalog)
+    try:
+        assert [(name, wafers) for name, _, wafers, _ in router.shards()] == [("LOT1", 2), ("LOT2", 1)]
+        for mid, lot_id, _ in first + second:
+            assert router.path(mid).endswith(f"{lot_id}.db")
+            assert router.query(mid, "SELECT COUNT(*) FROM {shard}.die_info WHERE MasterID = ?", (mid,))[0][0] > 0
+    finally:
+        router.close()
+    assert rows(catalog, "SELECT COUNT(*) FROM die_info") == [(0,)]
+
+
+def test_close_router_drops_the_shared_router(catalog):
+    router = ShardRouter.get_router(catalog)
+    assert ShardRouter.get_router(catalog) is router
+
+    ShardRouter.close_router(catalog)
+    with pytest.raises(sqlite3.ProgrammingError):
+        router.by
+    assert ShardRouter.get_router(catalog) is not router
+    ShardRouter.close_router()
+    assert not ShardRouter._routers
+
+
+def test_load_error_closes_shard_connections(catalog):
+    channel = BatchChannel()
+    channel.put(("wafer_info", "LOT1", "W1"))
+    channel.put(("die_info", None))
+    channel.close()
+    Loader(channel, catalog).insert_data()
+
+    shard = ShardRouter.ShardRouter(catalog)
+    path = shard.shards()[0][1]
+    shard.close()
+    for db in (catalog, path):
+        conn = sqlite3.connect(db, timeout=0)
+        conn.execute("BEGIN EXCLUSIVE")
+        conn.rollback()
+        conn.close()
+
+
+def test_daemon_job_closes_the_shared_router(make_stdf, catalog):
+    IngestDaemon._init_worker({catalog: threading.Lock()}, queue.Queue())
+    file_name = make_stdf()
+    WaferMap.main(file_name, catalog)
+    # The ledger lookup of an unchanged file goes through the shared router
+    result = IngestDaemon._run_job(file_name, catalog, {}, False, {})
+    assert result["unchanged"]
+    assert catalog not in ShardRouter._routers
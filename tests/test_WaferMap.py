@@ -0,0 +1,33 @@
+import WaferMap
+
+from conftest import rows, wafer_records
+
+
+def test_every_wafer_is_loaded(make_stdf, db_name):
+    IDs = WaferMap.main(make_stdf(wafers=('W1', 'W2')), db_name)
+    assert [wafer[1:] for wafer in IDs] == [('LOT1', 'W1'), ('LOT1', 'W2')]
+    assert WaferMap.COMPLETE and WaferMap.ERROR is None
+    dies = wafer_records('W1')[1]
+    for mid, _, _ in IDs:
+        assert rows(db_name, "SELECT COUNT(*) FROM die_info WHERE MasterID = ?", (mid,)) == [(dies,)]
+        assert rows(db_name, "SELECT COUNT(*) FROM test_results WHERE MasterID = ?", (mid,)) == [(dies * 5,)]
+
+
+def test_empty_file_loads_no_wafer(tmp_path, db_name):
+    empty = tmp_path / "empty.stdf"
+    empty.write_bytes(b"")
+    assert WaferMap.main(str(empty), db_name) == []
+    assert rows(db_name, "SELECT COUNT(*) FROM wafer_info") == [(0,)]
+
+
+def test_truncated_file_keeps_committed_wafers(tmp_path, make_stdf, db_name):
+    data = open(make_stdf(wafers=('W1', 'W2')), "rb").read()
+    cut = tmp_path / "cut.stdf"
+    cut.write_bytes(data[:len(data) * 3 // 4])
+
+    IDs = WaferMap.main(str(cut), db_name)
+    assert not WaferMap.COMPLETE
+    assert WaferMap.ERROR
+    # The first wafer was committed whole before the parser failed in the second
+    assert rows(db_name, "SELECT COUNT(*) FROM die_info WHERE MasterID = ?", (IDs[0][0],)) == [(wafer_records('W1')[1],)]
+